@@ -7,6 +7,7 @@ from log_config import setup_logger
 from async_worker import async_worker # Import instance global
 from flask_migrate import Migrate # Thêm import
 from .config import Config
+import atexit
 import os
 
 
@@ -14,14 +15,28 @@ db = SQLAlchemy()
 bootstrap = Bootstrap5()
 csrf = CSRFProtect() # <-- Khởi tạo đối tượng CSRFProtect
 migrate = Migrate() # Khởi tạo đối tượng Migrate
+_shutdown_registered = False
 
 
+def _shutdown_runtime():
+    """Dừng runtime OPC UA khi tiến trình Flask (chạy gộp, không COLLECTOR_SOCKET) thoát."""
+    from .delivery import delivery_pipeline # Import ở đây để tránh circular
+    from .iec104 import iec104_outstation
+    delivery_pipeline.stop() # Ghi nốt hàng đợi xuống outbox và lưu offset đã gửi
+    iec104_outstation.stop()
+    async_worker.stop()
 
-def create_app(config_class=Config):
+
+def create_app(config_class=Config, start_runtime=True):
+    """
+    start_runtime=False: không khởi động AsyncWorker, delivery pipeline, outstation IEC-104... trong tiến trình này.
+    Dùng cho tiến trình cha của Werkzeug reloader (chỉ theo dõi file), để outbox không bị hai dispatcher gửi lại
+    cùng lúc và cổng IEC-104 không bị tiến trình không có subscription chiếm. Do nơi gọi quyết định (xem run.py)
+    vì app.debug chưa được đặt khi create_app chạy.
+    """
     app = Flask(__name__)
-    logger = setup_logger(__name__)
-    
     app.config.from_object(config_class)
+    logger = setup_logger(__name__, app.config)
 
     db.init_app(app)
     migrate.init_app(app, db) # Gắn Migrate vào app và db
@@ -29,18 +44,55 @@ def create_app(config_class=Config):
 
     csrf.init_app(app) # <-- Kích hoạt CSRF protection cho app
 
-    if not async_worker.loop or not async_worker.loop.is_running():
-        app.logger.info("Starting AsyncWorker from create_app...")
-        async_worker.start()
-    else:
-        app.logger.info("AsyncWorker already running.")
-
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
-             # Chỉ chạy khi là tiến trình chính của Werkzeug hoặc không ở chế độ debug
-             from .opcua_client import try_auto_reconnect_servers # Import ở đây để tránh circular
-             try_auto_reconnect_servers(app)
-    elif app.debug:
-             app.logger.info("Chế độ debug, bỏ qua auto-reconnect trong create_app để tránh chạy nhiều lần do reloader.")
+    # Runtime OPC UA (session, subscription, pipeline gửi dữ liệu) chỉ chạy trong một tiến trình: collector
+    # (run_collector.py), hoặc chính tiến trình Flask khi không cấu hình COLLECTOR_SOCKET.
+    # Các tiến trình Flask còn lại điều khiển collector qua Unix socket (app/collector.py).
+    owns_runtime = app.config['IS_COLLECTOR'] or not app.config['COLLECTOR_SOCKET']
+
+    from .collector import collector
+    collector.init_app(app, owns_runtime=owns_runtime)
+    runs_runtime = owns_runtime and start_runtime
+
+    if runs_runtime:
+        async_worker.configure(default_timeout_s=app.config['ASYNC_JOB_TIMEOUT_S'],
+                               max_concurrent_per_key=app.config['ASYNC_JOBS_PER_SERVER'],
+                               shard_count=app.config['ASYNC_WORKER_SHARDS'])
+        if not async_worker.loop or not async_worker.loop.is_running():
+            app.logger.info("Starting AsyncWorker from create_app...")
+            async_worker.start()
+        else:
+            app.logger.info("AsyncWorker already running.")
+
+        from .delivery import delivery_pipeline # Pipeline gửi dữ liệu tới API datapoint theo lô
+        delivery_pipeline.init_app(app)
+
+        from .iec104 import iec104_outstation # Outstation IEC-104 (khi IEC104_ENABLED) phát giá trị theo ioa_mapping
+        iec104_outstation.init_app(app)
+
+        global _shutdown_registered
+        if not app.config['IS_COLLECTOR'] and not _shutdown_registered: # run_collector.py tự dừng khi nhận SIGTERM
+            atexit.register(_shutdown_runtime)
+            _shutdown_registered = True
+
+        from .change_log import change_log # Ring buffer các thay đổi theo seq cho GET /api/values
+        change_log.init_app(app)
+
+    from .datatype_cache import datatype_cache # Cache tên DataType theo server, lưu trong bảng opc_data_types
+    datatype_cache.init_app(app)
+
+    if runs_runtime:
+        from .browse_jobs import browse_jobs # Job duyệt node chạy nền
+        browse_jobs.init_app(app)
+
+        from .connection_supervisor import connection_supervisor # Tự kết nối lại và khôi phục subscription khi mất kết nối
+        connection_supervisor.init_app(app)
+
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
+                 # Chỉ chạy khi là tiến trình chính của Werkzeug hoặc không ở chế độ debug
+                 from .opcua_client import try_auto_reconnect_servers # Import ở đây để tránh circular
+                 try_auto_reconnect_servers(app) # Chỉ lên lịch trên AsyncWorker, không chờ kết nối xong
+        elif app.debug:
+                 app.logger.info("Chế độ debug, bỏ qua auto-reconnect trong create_app để tránh chạy nhiều lần do reloader.")
 
     # Đăng ký các routes
     from .routes import register_routes # Import hàm đăng ký routes
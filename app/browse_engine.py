@@ -0,0 +1,320 @@
+# app/browse_engine.py
+import asyncio
+import logging
+
+from asyncua import ua
+from asyncua import Client as AsyncuaClient
+
+logger = logging.getLogger(__name__)
+
+# Số request Browse/Read được gửi song song tới một server khi duyệt
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# Các thuộc tính đọc cho mỗi node khi duyệt, theo đúng thứ tự ReadValueId trong request Read
+BROWSE_READ_ATTRIBUTES = (
+    ua.AttributeIds.BrowseName,
+    ua.AttributeIds.DisplayName,
+    ua.AttributeIds.NodeClass,
+    ua.AttributeIds.Description,
+    ua.AttributeIds.DataType,
+)
+
+
+def _data_value_or_none(data_value: ua.DataValue):
+    if data_value is None or not data_value.StatusCode.is_good() or data_value.Value is None:
+        return None
+    return data_value.Value.Value
+
+
+class BrowseEngine:
+    """
+    Duyệt Address Space theo chiều rộng (BFS), từng mức một:
+      - thuộc tính của cả mức được đọc bằng các request Read nhiều node (chunk theo MaxNodesPerRead),
+      - con của mọi Object/View trong mức được lấy bằng các request Browse nhiều node
+        (chunk theo MaxNodesPerBrowse), có xử lý continuation point bằng BrowseNext,
+      - các chunk được gửi song song, tối đa max_in_flight request cùng lúc.
+    browse() yield các dict node_info giống hệt start_server_browse trước đây (node cha luôn trước node con).
+    """
+    def __init__(self, client: AsyncuaClient, server_db_id: int, max_depth: int = 5,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 max_nodes_per_read: int = 1000, max_nodes_per_browse: int = 1000,
+                 max_references_per_node: int = 0, should_stop=None, datatype_cache=None, progress: dict = None):
+        self.client = client
+        self.server_db_id = server_db_id
+        self.max_depth = max_depth
+        self.max_in_flight = max(1, int(max_in_flight))
+        # Mỗi node cần len(BROWSE_READ_ATTRIBUTES) ReadValueId
+        self.max_nodes_per_read = max(1, int(max_nodes_per_read))
+        self.max_nodes_per_browse = max(1, int(max_nodes_per_browse))
+        self.max_references_per_node = max(0, int(max_references_per_node)) # 0: server tự quyết định
+        self.should_stop = should_stop
+        self.datatype_cache = datatype_cache # Xem app/datatype_cache.py, None: luôn đọc tên DataType từ server
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        # Dict tiến độ dùng chung với người gọi (có thể đọc từ thread khác): depth, frontier, nodes_visited
+        self.progress = progress if progress is not None else {}
+
+        self.stats = {
+            "levels": 0,
+            "nodes": 0,
+            "read_requests": 0,
+            "browse_requests": 0,
+            "browse_next_requests": 0,
+        }
+
+    def stopped(self) -> bool:
+        return bool(self.should_stop and self.should_stop())
+
+    async def browse(self, start_node_ids, parent_node_id_str: str = None):
+        """
+        Duyệt từ các node bắt đầu (list ua.NodeId), yield node_info theo từng mức.
+        Dừng ở ranh giới chunk tiếp theo khi should_stop() trả về True.
+        """
+        processed_node_ids = set()
+        level = [(node_id, parent_node_id_str) for node_id in start_node_ids]
+        depth = 0
+
+        while level:
+            if self.stopped():
+                logger.info(f"Dừng duyệt (cờ): ServerID={self.server_db_id}, Depth={depth}")
+                return
+
+            level_nodes = []
+            for node_id, parent_str in level:
+                node_id_str = node_id.to_string()
+                if node_id_str in processed_node_ids:
+                    logger.debug(f"Node đã xử lý: ServerID={self.server_db_id}, Node='{node_id_str}'. Bỏ qua.")
+                    continue
+                processed_node_ids.add(node_id_str)
+                level_nodes.append((node_id, node_id_str, parent_str))
+            if not level_nodes:
+                return
+
+            self.stats["levels"] += 1
+            # frontier: số node đã biết nhưng chưa yield (các mức sâu hơn chưa được khám phá)
+            self.progress.update({"depth": depth, "frontier": len(level_nodes)})
+            logger.debug(f"Duyệt mức {depth}: {len(level_nodes)} node. ServerID={self.server_db_id}.")
+            containers = []
+            for node_id, node_info, node_class_obj in await self._read_level(level_nodes):
+                self.progress["frontier"] -= 1
+                if node_info is None:
+                    continue
+                self.stats["nodes"] += 1
+                self.progress["nodes_visited"] = self.stats["nodes"]
+                yield node_info
+                if node_class_obj in [ua.NodeClass.Object, ua.NodeClass.View] and depth < self.max_depth:
+                    containers.append((node_id, node_info['node_id_string']))
+
+            if not containers or self.stopped():
+                return
+            level = await self._browse_children(containers)
+            depth += 1
+
+    async def _run_chunks(self, worker, items, chunk_size):
+        """Chạy worker(chunk) cho từng chunk song song, trả về list kết quả theo thứ tự chunk."""
+        chunks = [items[offset:offset + chunk_size] for offset in range(0, len(items), chunk_size)]
+        return await asyncio.gather(*(worker(chunk) for chunk in chunks))
+
+    async def _read(self, read_targets):
+        params = ua.ReadParameters()
+        for node_id, attribute_id in read_targets:
+            rv = ua.ReadValueId()
+            rv.NodeId = node_id
+            rv.AttributeId = attribute_id
+            params.NodesToRead.append(rv)
+        async with self._semaphore:
+            self.stats["read_requests"] += 1
+            return await self.client.uaclient.read(params)
+
+    async def _read_chunk(self, chunk):
+        if self.stopped():
+            return None
+        try:
+            return await self._read([(node_id, attribute_id) for node_id, _, _ in chunk
+                                     for attribute_id in BROWSE_READ_ATTRIBUTES])
+        except Exception as e_read:
+            logger.error(f"Lỗi khi đọc thuộc tính {len(chunk)} node (từ '{chunk[0][1]}'): {str(e_read)}. "
+                         f"ServerID={self.server_db_id}.", exc_info=True)
+            return None
+
+    async def _read_level(self, level_nodes):
+        """
+        Đọc thuộc tính của cả mức, trả về list (node_id, node_info, node_class_obj).
+        node_info là None nếu node bị bỏ qua (không đọc được BrowseName/NodeClass hoặc chunk lỗi/bị dừng).
+        """
+        n_attrs = len(BROWSE_READ_ATTRIBUTES)
+        chunk_size = max(1, self.max_nodes_per_read // n_attrs)
+        chunk_results = await self._run_chunks(self._read_chunk, level_nodes, chunk_size)
+
+        level = []
+        datatype_nodeids = {}
+        for chunk_index, data_values in enumerate(chunk_results):
+            chunk = level_nodes[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+            for i, (node_id, node_id_str, parent_str) in enumerate(chunk):
+                if data_values is None:
+                    level.append((node_id, None, None))
+                    continue
+                node_info, node_class_obj = self._make_node_info(node_id_str, parent_str,
+                                                                 data_values[i * n_attrs:(i + 1) * n_attrs],
+                                                                 datatype_nodeids)
+                level.append((node_id, node_info, node_class_obj))
+
+        if datatype_nodeids:
+            await self._resolve_datatype_names(level, datatype_nodeids)
+        return level
+
+    def _make_node_info(self, node_id_str: str, parent_str: str, data_values, datatype_nodeids: dict):
+        bn_dv, dn_dv, nc_dv, desc_dv, dt_dv = data_values
+
+        browse_name_obj = _data_value_or_none(bn_dv)
+        if browse_name_obj is None:
+            logger.warning(f"Lỗi đọc BrowseName: ServerID={self.server_db_id}, Node='{node_id_str}', Code={bn_dv.StatusCode.name}. Bỏ qua node.")
+            return None, None
+        browse_name_str = f"{browse_name_obj.NamespaceIndex}:{browse_name_obj.Name}" if browse_name_obj.NamespaceIndex != 0 else browse_name_obj.Name
+
+        display_name_str = browse_name_str # Fallback
+        display_name_obj = _data_value_or_none(dn_dv)
+        if display_name_obj and display_name_obj.Text:
+            display_name_str = display_name_obj.Text
+
+        node_class_value = _data_value_or_none(nc_dv)
+        if node_class_value is None:
+            logger.warning(f"Lỗi đọc NodeClass: ServerID={self.server_db_id}, Node='{node_id_str}', Code={nc_dv.StatusCode.name}. Bỏ qua node.")
+            return None, None
+        try:
+            node_class_obj = ua.NodeClass(node_class_value)
+            node_class_str = node_class_obj.name
+        except ValueError:
+            node_class_obj = None
+            node_class_str = "UnknownNodeClass"
+
+        description_obj = _data_value_or_none(desc_dv)
+        description_str = description_obj.Text if description_obj and description_obj.Text else None
+
+        data_type_str = None
+        if node_class_obj == ua.NodeClass.Variable:
+            datatype_nodeid = _data_value_or_none(dt_dv)
+            if not dt_dv.StatusCode.is_good():
+                logger.debug(f"Lỗi Status Code khi đọc DataType: ServerID={self.server_db_id}, VariableNode='{node_id_str}', Code={dt_dv.StatusCode.name}. Gán là 'UnknownDataType'.")
+                data_type_str = "UnknownDataType"
+            elif datatype_nodeid is None or datatype_nodeid.is_null():
+                data_type_str = "DataTypeNotSet"
+            else:
+                # Tên DataType được phân giải cho cả mức ở bước sau
+                datatype_nodeids[datatype_nodeid.to_string()] = datatype_nodeid
+                data_type_str = datatype_nodeid
+
+        node_info = {
+            'server_id': self.server_db_id,
+            'node_id_string': node_id_str,
+            'browse_name': browse_name_str,
+            'display_name': display_name_str,
+            'node_class_str': node_class_str,
+            'parent_node_id_string': parent_str,
+            'data_type': data_type_str,
+            'description': description_str,
+        }
+        return node_info, node_class_obj
+
+    async def _read_chunked(self, read_targets):
+        chunk_results = await self._run_chunks(self._read, read_targets, self.max_nodes_per_read)
+        return [data_value for chunk in chunk_results for data_value in chunk]
+
+    async def _resolve_datatype_names(self, level, datatype_nodeids: dict):
+        """Cố gắng lấy tên dễ đọc của các DataType trong mức, nếu không thì dùng NodeId của nó."""
+        datatype_names = {}
+        if self.datatype_cache is not None:
+            # Chỉ các DataType chưa có trong cache mới phải đọc từ server
+            datatype_names = await self.datatype_cache.resolve(self.client, self.server_db_id, datatype_nodeids,
+                                                               read=self._read_chunked)
+        else:
+            datatype_keys = list(datatype_nodeids.keys())
+            try:
+                name_values = await self._read_chunked([(datatype_nodeids[key], ua.AttributeIds.DisplayName)
+                                                        for key in datatype_keys])
+                for key, data_value in zip(datatype_keys, name_values):
+                    name_obj = _data_value_or_none(data_value)
+                    if name_obj and name_obj.Text:
+                        datatype_names[key] = name_obj.Text
+            except Exception as e_dt_resolve:
+                logger.debug(f"Không thể phân giải tên DataType ({len(datatype_keys)} kiểu) cho ServerID={self.server_db_id}: {e_dt_resolve}. Dùng NodeId.")
+
+        for _, node_info, _ in level:
+            if node_info and isinstance(node_info['data_type'], ua.NodeId):
+                key = node_info['data_type'].to_string()
+                node_info['data_type'] = datatype_names.get(key, key)
+
+    async def _browse_children(self, containers):
+        """
+        Lấy con (HierarchicalReferences, chiều Forward) của các node trong containers (list (node_id, node_id_str)).
+        Trả về list (child_node_id, parent_node_id_str) theo thứ tự node cha.
+        """
+        chunk_results = await self._run_chunks(self._browse_chunk, containers, self.max_nodes_per_browse)
+        return [child for chunk_children in chunk_results for child in chunk_children]
+
+    async def _browse_chunk(self, chunk):
+        if self.stopped():
+            return []
+
+        params = ua.BrowseParameters()
+        params.View.Timestamp = ua.get_win_epoch()
+        params.RequestedMaxReferencesPerNode = self.max_references_per_node
+        for node_id, _ in chunk:
+            desc = ua.BrowseDescription()
+            desc.NodeId = node_id
+            desc.BrowseDirection = ua.BrowseDirection.Forward
+            desc.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+            desc.IncludeSubtypes = True
+            desc.NodeClassMask = ua.NodeClass.Unspecified
+            desc.ResultMask = ua.BrowseResultMask.All
+            params.NodesToBrowse.append(desc)
+
+        try:
+            async with self._semaphore:
+                self.stats["browse_requests"] += 1
+                results = await self.client.uaclient.browse(params)
+        except Exception as e_browse:
+            logger.error(f"Lỗi Browse {len(chunk)} node (từ '{chunk[0][1]}'): {str(e_browse)}. ServerID={self.server_db_id}.",
+                         exc_info=True)
+            return []
+
+        references = [[] for _ in chunk]
+        pending = {} # index trong chunk -> continuation point
+        for index, ((_, node_id_str), result) in enumerate(zip(chunk, results)):
+            if not result.StatusCode.is_good():
+                logger.warning(f"Không thể lấy con của node '{node_id_str}': Code={result.StatusCode.name}. ServerID={self.server_db_id}.")
+                continue
+            references[index].extend(result.References)
+            if result.ContinuationPoint:
+                pending[index] = result.ContinuationPoint
+
+        # Server trả về tối đa RequestedMaxReferencesPerNode (hoặc giới hạn riêng của nó) reference mỗi node,
+        # phần còn lại lấy bằng BrowseNext với tất cả continuation point của chunk trong cùng một request.
+        while pending:
+            indexes = list(pending.keys())
+            next_params = ua.BrowseNextParameters()
+            next_params.ContinuationPoints = [pending[index] for index in indexes]
+            next_params.ReleaseContinuationPoints = self.stopped() # Giải phóng trên server nếu đã bị dừng
+            try:
+                async with self._semaphore:
+                    self.stats["browse_next_requests"] += 1
+                    next_results = await self.client.uaclient.browse_next(next_params)
+            except Exception as e_next:
+                logger.error(f"Lỗi BrowseNext cho {len(indexes)} node: {str(e_next)}. ServerID={self.server_db_id}.", exc_info=True)
+                break
+            if next_params.ReleaseContinuationPoints:
+                break
+            pending = {}
+            for index, result in zip(indexes, next_results):
+                if not result.StatusCode.is_good():
+                    logger.warning(f"BrowseNext lỗi cho node '{chunk[index][1]}': Code={result.StatusCode.name}. ServerID={self.server_db_id}.")
+                    continue
+                references[index].extend(result.References)
+                if result.ContinuationPoint:
+                    pending[index] = result.ContinuationPoint
+
+        children = []
+        for (_, node_id_str), node_references in zip(chunk, references):
+            if node_references:
+                logger.debug(f"Node '{node_id_str}' có {len(node_references)} con. ServerID={self.server_db_id}.")
+            children.extend((reference.NodeId, node_id_str) for reference in node_references)
+        return children
@@ -0,0 +1,163 @@
+# app/browse_jobs.py
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from app import metrics
+from app.node_store import browse_and_stream_to_db
+from app.opcua_client import browse_stop_flags
+
+logger = logging.getLogger(__name__)
+
+# Số job đã kết thúc được giữ lại để tra cứu tiến độ/kết quả
+MAX_FINISHED_JOBS = 50
+
+
+class BrowseJob:
+    """Một lần duyệt + lưu node chạy nền cho một server."""
+    def __init__(self, server_id: int, max_depth: int, incremental: bool):
+        self.job_id = uuid.uuid4().hex
+        self.server_id = server_id
+        self.max_depth = max_depth
+        self.incremental = incremental
+        self.status = "queued" # queued, running, completed, cancelled, failed
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        self.progress = {} # Được browse_and_stream_to_db và browse engine cập nhật tại chỗ
+        self._started_monotonic = None
+        self._finished_monotonic = None
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def to_dict(self) -> dict:
+        elapsed_s = 0.0
+        if self._started_monotonic is not None:
+            elapsed_s = (self._finished_monotonic or time.monotonic()) - self._started_monotonic
+        nodes_visited = self.progress.get("nodes_visited", 0)
+        rate = nodes_visited / elapsed_s if elapsed_s > 0 else 0.0
+        frontier = max(0, self.progress.get("frontier", 0))
+        # ETA chỉ tính theo frontier đã biết (các mức sâu hơn chưa được khám phá), nên là cận dưới
+        eta_s = round(frontier / rate, 1) if self.is_active and rate > 0 else None
+
+        return {
+            "job_id": self.job_id,
+            "server_id": self.server_id,
+            "status": self.status,
+            "max_depth": self.max_depth,
+            "incremental": self.incremental,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "elapsed_s": round(elapsed_s, 1),
+            "nodes_visited": nodes_visited,
+            "nodes_saved": self.progress.get("nodes_saved", 0),
+            "depth": self.progress.get("depth", 0),
+            "frontier": frontier,
+            "rate_nodes_per_s": round(rate, 1),
+            "eta_s": eta_s,
+            "inserted": self.progress.get("inserted"),
+            "updated": self.progress.get("updated"),
+            "unchanged": self.progress.get("unchanged"),
+            "marked_stale": self.progress.get("marked_stale"),
+            "error": self.progress.get("error"),
+        }
+
+
+class BrowseJobManager:
+    """
+    Quản lý các job duyệt node chạy nền: việc duyệt chạy trên AsyncWorker, việc ghi DB chạy trên
+    một thread riêng của job (có app context), nên request HTTP trả về ngay với job_id.
+    Mỗi server chỉ có tối đa một job đang chạy; các server khác nhau có thể duyệt đồng thời.
+    """
+    def __init__(self):
+        self._app = None
+        self._jobs = {} # job_id -> BrowseJob
+        self._lock = threading.Lock()
+
+    def init_app(self, app_instance):
+        self._app = app_instance
+
+    def start(self, server_id: int, max_depth: int, incremental: bool = True) -> BrowseJob:
+        """Tạo và khởi động job. Raise ValueError nếu server đang có job duyệt chạy."""
+        if self._app is None:
+            raise RuntimeError("BrowseJobManager chưa được init_app.")
+        with self._lock:
+            active = self.active_job_for_server(server_id)
+            if active is not None:
+                raise ValueError(f"Server ID {server_id} đang được duyệt (job {active.job_id}).")
+            job = BrowseJob(server_id, max_depth, incremental)
+            self._jobs[job.job_id] = job
+            self._prune_locked()
+            browse_stop_flags.pop(server_id, None) # Xóa cờ dừng còn sót từ lần trước
+
+        thread = threading.Thread(target=self._run, args=(job,), name=f"browse-job-{server_id}", daemon=True)
+        thread.start()
+        logger.info(f"Đã tạo job duyệt {job.job_id} cho server ID {server_id} (max_depth={max_depth}, incremental={incremental}).")
+        return job
+
+    def _run(self, job: BrowseJob):
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        job._started_monotonic = time.monotonic()
+        try:
+            with self._app.app_context():
+                if job.cancel_requested:
+                    job.status = "cancelled"
+                    return
+                browse_and_stream_to_db(job.server_id, job.max_depth,
+                                        chunk_size=self._app.config.get('BROWSE_SAVE_CHUNK_SIZE', 1000),
+                                        progress=job.progress, incremental=job.incremental)
+            if job.progress.get("error"):
+                job.status = "failed"
+            elif job.cancel_requested or job.progress.get("stopped_by_user"):
+                job.status = "cancelled"
+            else:
+                job.status = "completed"
+        except Exception as e:
+            logger.error(f"Job duyệt {job.job_id} (server ID {job.server_id}) lỗi: {e}", exc_info=True)
+            job.progress["error"] = str(e)
+            job.status = "failed"
+        finally:
+            browse_stop_flags.pop(job.server_id, None)
+            metrics.browse_nodes.inc((job.server_id,), job.progress.get("nodes_visited", 0))
+            job.finished_at = datetime.utcnow()
+            job._finished_monotonic = time.monotonic()
+            logger.info(f"Job duyệt {job.job_id} (server ID {job.server_id}) kết thúc: {job.status}. {job.progress}")
+
+    def cancel(self, job_id: str) -> bool:
+        """Yêu cầu dừng job, việc duyệt sẽ dừng ở ranh giới chunk tiếp theo. Trả về False nếu job không còn chạy."""
+        job = self.get(job_id)
+        if job is None or not job.is_active:
+            return False
+        job.cancel_requested = True
+        browse_stop_flags[job.server_id] = True
+        logger.info(f"Đã yêu cầu hủy job duyệt {job_id} (server ID {job.server_id}).")
+        return True
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def active_job_for_server(self, server_id: int):
+        for job in list(self._jobs.values()):
+            if job.server_id == server_id and job.is_active:
+                return job
+        return None
+
+    def list_jobs(self, server_id: int = None):
+        jobs = [job for job in list(self._jobs.values()) if server_id is None or job.server_id == server_id]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def _prune_locked(self):
+        finished = sorted((job for job in self._jobs.values() if not job.is_active), key=lambda job: job.created_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self._jobs.pop(job.job_id, None)
+
+
+# Instance global, được gắn app trong create_app
+browse_jobs = BrowseJobManager()
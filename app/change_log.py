@@ -0,0 +1,101 @@
+# app/change_log.py
+import datetime
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeLog:
+    """
+    Ring buffer trong bộ nhớ của các thay đổi giá trị đã chuyển tiếp (sau deadband), mỗi thay đổi được gán một seq
+    tăng dần. Consumer đọc theo kiểu pull qua GET /api/values?since=<seq>: lấy mọi thay đổi có seq > since theo
+    lô lớn với tốc độ của mình, và khi kết nối lại thì đọc tiếp từ seq cuối đã xử lý mà không mất dữ liệu, miễn
+    là chưa bị ring buffer ghi đè (khi đó kết quả có gap=true và lost là số thay đổi đã mất).
+    MappingRoute gọi append() trên event loop của AsyncWorker, các route Flask/IPC gọi read() (có thể chờ long-poll).
+    epoch đổi sau mỗi lần khởi động: seq bắt đầu lại từ 1, consumer nên đọc lại từ đầu khi thấy epoch khác.
+    """
+    def __init__(self, capacity: int = 200000):
+        self.capacity = capacity
+        self.enabled = False # Chỉ bật sau init_app (đã cấp phát ring buffer)
+        self.epoch = None
+        self.last_seq = 0
+        self._entries = []
+        self._changed = threading.Condition()
+
+    def init_app(self, app_instance):
+        self.capacity = app_instance.config.get('CHANGE_LOG_CAPACITY', self.capacity)
+        self.enabled = self.capacity > 0
+        with self._changed:
+            self._entries = [None] * self.capacity
+            self.last_seq = 0
+            self.epoch = f"{time.time():.6f}"
+        if self.enabled:
+            logger.info(f"Change log: Ring buffer {self.capacity} thay đổi cho /api/values.")
+        else:
+            logger.info("Change log: Tắt (CHANGE_LOG_CAPACITY=0), /api/values không khả dụng.")
+
+    def append(self, ioa, mapping_id, value, status, source_ts):
+        """Ghi một thay đổi (status: None nếu Good, ngược lại tên StatusCode). Trả về seq được gán."""
+        with self._changed:
+            seq = self.last_seq + 1
+            self._entries[seq % self.capacity] = (seq, ioa, mapping_id, value, status, source_ts)
+            self.last_seq = seq
+            self._changed.notify_all()
+        return seq
+
+    def read(self, since: int, max_items: int, wait_s: float = 0.0):
+        """
+        Các thay đổi có seq > since (tối đa max_items, theo thứ tự seq). Nếu chưa có thay đổi nào thì chờ tối đa
+        wait_s giây. since lớn hơn seq cuối (consumer đọc từ lần chạy trước) được coi như đọc lại từ đầu.
+        """
+        with self._changed:
+            if since > self.last_seq:
+                since = 0
+                reset = True
+            else:
+                reset = False
+            if wait_s > 0 and self.last_seq <= since:
+                self._changed.wait_for(lambda: self.last_seq > since, wait_s)
+            last_seq = self.last_seq
+            first_seq = max(1, last_seq - self.capacity + 1)
+            start = max(since + 1, first_seq)
+            end = min(last_seq, start + max_items - 1)
+            entries = [self._entries[seq % self.capacity] for seq in range(start, end + 1)]
+
+        # Chuyển sang JSON ngoài lock để không chặn append() trên event loop
+        lost = start - since - 1 # Các seq đã bị ghi đè trước khi consumer kịp đọc
+        return {
+            "epoch": self.epoch,
+            "since": since,
+            "next": start - 1 + len(entries), # since cho lần đọc tiếp theo
+            "first_seq": first_seq if last_seq else 0,
+            "last_seq": last_seq,
+            "gap": reset or lost > 0,
+            "lost": lost,
+            "changes": [{"seq": seq, "ioa": ioa, "mapping_id": mapping_id, "value": _json_value(value),
+                         "status": status, "source_ts": source_ts}
+                        for seq, ioa, mapping_id, value, status, source_ts in entries],
+        }
+
+    def __len__(self):
+        return min(self.last_seq, self.capacity)
+
+
+def _json_value(value):
+    """Giá trị OPC UA sang kiểu JSON (kiểu phức tạp dùng str, giống delivery pipeline)."""
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    return str(value)
+
+
+# Instance global, dùng chung giữa MappingRoute (AsyncWorker) và route /api/values
+change_log = ChangeLog()
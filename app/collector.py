@@ -0,0 +1,370 @@
+# app/collector.py
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from async_worker import get_async_worker
+
+logger = logging.getLogger(__name__)
+
+
+class CollectorError(RuntimeError):
+    """Lỗi khi gọi collector qua IPC (collector không chạy, socket lỗi, hoặc thao tác lỗi phía collector)."""
+
+
+class CollectorService:
+    """
+    Các thao tác trên runtime OPC UA (session, subscription, browse, đọc giá trị) mà giao diện Flask cần.
+    Chỉ tiến trình sở hữu runtime (collector, hoặc chính tiến trình Flask khi chạy gộp) tạo instance này.
+    Tham số và kết quả của mọi thao tác đều là kiểu JSON (dict dùng key chuỗi) để gọi được qua Unix socket.
+    """
+    # Các thao tác được phép gọi qua IPC
+    OPERATIONS = frozenset({
+        "connected_server_ids", "is_server_connected", "supervisor_status", "connect_server", "disconnect_server",
+        "node_attributes", "read_node_value", "read_node_values", "get_job",
+        "subscribed_mapping_ids", "is_mapping_subscribed", "subscribe_mapping", "unsubscribe_mapping",
+        "subscribe_all", "unsubscribe_all",
+        "start_browse", "browse_jobs", "browse_job", "active_browse_job", "cancel_browse_job", "stop_browse",
+        "worker_status", "metrics_text", "changes_since",
+    })
+    # Các thao tác theo lô trên toàn bộ mapping, chạy với deadline ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S
+    BULK_OPERATIONS = frozenset({"subscribe_all", "unsubscribe_all"})
+
+    def __init__(self, app_instance):
+        self._app = app_instance
+
+    # --- Kết nối ---
+    def connected_server_ids(self):
+        from app.opcua_client import active_clients, is_server_connected # Import ở đây để tránh circular
+        return [server_id for server_id in list(active_clients) if is_server_connected(server_id)]
+
+    def is_server_connected(self, server_id):
+        from app.opcua_client import is_server_connected
+        return is_server_connected(server_id)
+
+    def supervisor_status(self, server_id):
+        from app.connection_supervisor import connection_supervisor
+        return connection_supervisor.status(server_id)
+
+    def connect_server(self, server_id):
+        from app import db
+        from app.models import OpcServer
+        from app.opcua_client import connect_server
+        with self._app.app_context():
+            server_config = OpcServer.query.get(server_id)
+            if server_config is None:
+                raise ValueError(f"Server ID {server_id} không tồn tại.")
+            db.session.expunge(server_config) # Dùng trên thread của AsyncWorker sau khi app context kết thúc
+        return get_async_worker().run_coroutine(connect_server(server_config), key=server_id)
+
+    def disconnect_server(self, server_id):
+        from app.opcua_client import disconnect_server
+        return get_async_worker().run_coroutine(disconnect_server(server_id), key=server_id)
+
+    # --- Đọc node ---
+    def node_attributes(self, server_id, node_id_str, timeout_s=None):
+        from app.opcua_client import get_opcua_node_all_attributes
+        return get_async_worker().run_coroutine(get_opcua_node_all_attributes(server_id, node_id_str),
+                                                timeout=timeout_s, key=server_id)
+
+    def read_node_value(self, server_id, node_id_str, max_age_s, timeout_s=None):
+        """Giá trị từ cache subscription nếu đủ mới, ngược lại Read trực tiếp server."""
+        from app.opcua_client import async_get_node_data_value
+        from app.value_cache import value_cache
+        cached_value = value_cache.get(server_id, node_id_str, max_age_s)
+        if cached_value is not None:
+            logger.debug(f"Collector: Trả giá trị node '{node_id_str}' từ cache (tuổi {cached_value['ValueAge_s']}s).")
+            return cached_value
+        value_details = get_async_worker().run_coroutine(async_get_node_data_value(server_id, node_id_str),
+                                                         timeout=timeout_s, key=server_id)
+        if value_details and not value_details.get("error"):
+            value_details["ValueSource"] = "live"
+        return value_details
+
+    def read_node_values(self, nodes, errors=None, max_age_s=5.0, timeout_s=None, async_job=False):
+        """
+        Đọc giá trị nhiều node: nodes là list [node_db_id, server_id, node_id_string] (node Variable),
+        errors là {node_db_id: thông báo lỗi} cho các node route đã loại. Trả về
+        {"values": {node_db_id: value_details}, "servers": {server_id: thống kê}, "elapsed_ms": ...}
+        (key chuỗi), hoặc thông tin job nếu async_job (kết quả lấy qua get_job).
+        """
+        from app.opcua_client import async_read_node_values, is_server_connected
+        from app.value_cache import value_cache
+        started = time.perf_counter()
+        values = {str(node_db_id): {"error": message} for node_db_id, message in (errors or {}).items()}
+        server_stats = {}
+        to_read = {} # server_id -> [node_id_string]
+        node_db_ids_by_key = {} # (server_id, node_id_string) -> [node_db_id]
+
+        for node_db_id, server_id, node_id_string in nodes:
+            stats = server_stats.setdefault(str(server_id), {"requested": 0, "from_cache": 0, "read": 0})
+            stats["requested"] += 1
+            if not is_server_connected(server_id):
+                values[str(node_db_id)] = {"error": "Server chưa kết nối"}
+                continue
+            cached_value = value_cache.get(server_id, node_id_string, max_age_s)
+            if cached_value is not None:
+                values[str(node_db_id)] = cached_value
+                stats["from_cache"] += 1
+                continue
+            key = (server_id, node_id_string)
+            if key not in node_db_ids_by_key:
+                to_read.setdefault(server_id, []).append(node_id_string)
+            node_db_ids_by_key.setdefault(key, []).append(str(node_db_id))
+
+        async def read_and_assemble():
+            if to_read:
+                read_results = await async_read_node_values(to_read)
+                for server_id, server_values in read_results.items():
+                    server_stats[str(server_id)]["read"] = len(server_values)
+                    for node_id_string, value_details in server_values.items():
+                        if "error" not in value_details:
+                            value_details["ValueSource"] = "live"
+                        for node_db_id in node_db_ids_by_key.get((server_id, node_id_string), []):
+                            values[node_db_id] = value_details
+            elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+            logger.info(f"Collector Batch Read: {len(values)} node, {len(server_stats)} server, {elapsed_ms}ms. {server_stats}")
+            return {"values": values, "servers": server_stats, "elapsed_ms": elapsed_ms}
+
+        worker = get_async_worker()
+        if async_job:
+            # Không giữ thread của request: trả job_id ngay, client poll get_job
+            job = worker.submit(read_and_assemble(), timeout=timeout_s, name="batch_read_node_values")
+            return {"job_id": job.job_id, "status": job.status}
+        return worker.run_coroutine(read_and_assemble(), timeout=timeout_s)
+
+    def get_job(self, job_id, wait_s=0.0):
+        """Trạng thái job AsyncWorker (kèm "result" khi đã xong), chờ tối đa wait_s giây. None nếu không có job."""
+        job = get_async_worker().get_job(job_id)
+        if job is None:
+            return None
+        if wait_s and not job.done():
+            try:
+                job.result(wait=wait_s)
+            except Exception:
+                pass # Trạng thái/lỗi được trả qua to_dict()
+        data = job.to_dict()
+        if data["status"] == "completed":
+            data["result"] = job.future.result()
+        return data
+
+    # --- Subscription ---
+    def subscribed_mapping_ids(self):
+        from app.opcua_client import active_opcua_subscriptions
+        return list(active_opcua_subscriptions)
+
+    def is_mapping_subscribed(self, mapping_id):
+        from app.opcua_client import active_opcua_subscriptions
+        return mapping_id in active_opcua_subscriptions
+
+    def subscribe_mapping(self, server_id, node_id_str, ioa_value, sampling_ms, publishing_ms, mapping_db_id,
+                          deadband_type="None", deadband_value=0.0, heartbeat_interval_s=0):
+        from app.opcua_client import actual_subscribe_opcua_node
+        return get_async_worker().run_coroutine(
+            actual_subscribe_opcua_node(server_id=server_id, node_id_str=node_id_str, ioa_value=ioa_value,
+                                        sampling_ms=sampling_ms, publishing_ms=publishing_ms,
+                                        mapping_db_id=mapping_db_id, deadband_type=deadband_type,
+                                        deadband_value=deadband_value, heartbeat_interval_s=heartbeat_interval_s),
+            key=server_id
+        )
+
+    def unsubscribe_mapping(self, mapping_id, server_id=None):
+        from app.opcua_client import unsubscribe_from_mapping
+        return get_async_worker().run_coroutine(unsubscribe_from_mapping(mapping_id), key=server_id)
+
+    def subscribe_all(self):
+        from app.opcua_client import subscribe_all_active_mappings_runtime
+        return subscribe_all_active_mappings_runtime(self._app, timeout_s=self._app.config['ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S'])
+
+    def unsubscribe_all(self):
+        from app.opcua_client import unsubscribe_all_runtime_subscriptions_opcua
+        return unsubscribe_all_runtime_subscriptions_opcua(timeout_s=self._app.config['ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S'])
+
+    # --- Duyệt node ---
+    def start_browse(self, server_id, max_depth, incremental=True):
+        """Khởi động job duyệt. Raise ValueError nếu server đang được duyệt."""
+        from app.browse_jobs import browse_jobs
+        return browse_jobs.start(server_id, max_depth, incremental=incremental).to_dict()
+
+    def browse_jobs(self, server_id=None):
+        from app.browse_jobs import browse_jobs
+        return [job.to_dict() for job in browse_jobs.list_jobs(server_id)]
+
+    def browse_job(self, job_id):
+        from app.browse_jobs import browse_jobs
+        job = browse_jobs.get(job_id)
+        return job.to_dict() if job is not None else None
+
+    def active_browse_job(self, server_id):
+        from app.browse_jobs import browse_jobs
+        job = browse_jobs.active_job_for_server(server_id)
+        return job.to_dict() if job is not None else None
+
+    def cancel_browse_job(self, job_id):
+        from app.browse_jobs import browse_jobs
+        job = browse_jobs.get(job_id)
+        if job is None:
+            return None
+        cancelled = browse_jobs.cancel(job_id)
+        return {"cancel_requested": cancelled, **job.to_dict()}
+
+    def stop_browse(self, server_id):
+        """Dừng job duyệt đang chạy của server, hoặc đặt cờ dừng cho lần duyệt không qua job."""
+        from app.browse_jobs import browse_jobs
+        from app.opcua_client import browse_stop_flags
+        job = browse_jobs.active_job_for_server(server_id)
+        if job is not None:
+            return browse_jobs.cancel(job.job_id)
+        browse_stop_flags[server_id] = True
+        return True
+
+    # --- Thay đổi giá trị theo seq ---
+    def changes_since(self, since, max_items, wait_s=0.0):
+        """Các thay đổi có seq > since từ ring buffer (xem ChangeLog.read), None nếu change log tắt."""
+        from app.change_log import change_log
+        if not change_log.enabled:
+            return None
+        return change_log.read(since, max_items, wait_s)
+
+    # --- Giám sát ---
+    def metrics_text(self):
+        from app.metrics import render_metrics
+        return render_metrics()
+
+    def worker_status(self):
+        worker = get_async_worker()
+        return {"shards": worker.shard_stats(),
+                "servers": {str(server_id): worker.shard_index(server_id) for server_id in self.connected_server_ids()}}
+
+
+class CollectorClient:
+    """
+    Gọi CollectorService của tiến trình collector qua Unix socket. Giao thức: mỗi request là một dòng JSON
+    {"op": ..., "args": {...}}, mỗi response là một dòng JSON {"ok": true, "result": ...} hoặc
+    {"ok": false, "error": ..., "error_type": ...}. Mỗi lần gọi dùng một kết nối (Unix socket kết nối rất rẻ),
+    nên client dùng được từ nhiều thread/tiến trình Flask cùng lúc.
+    """
+    def __init__(self, socket_path: str, timeout_s: float, bulk_timeout_s: float = None):
+        self.socket_path = socket_path
+        self.timeout_s = timeout_s
+        self.bulk_timeout_s = bulk_timeout_s or timeout_s # Cho BULK_OPERATIONS
+
+    def call(self, op: str, **kwargs):
+        if op not in CollectorService.OPERATIONS:
+            raise AttributeError(f"Collector không hỗ trợ thao tác '{op}'.")
+        request_line = json.dumps({"op": op, "args": kwargs}).encode("utf-8") + b"\n"
+        timeout_s = self.bulk_timeout_s if op in CollectorService.BULK_OPERATIONS else self.timeout_s
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout_s)
+                sock.connect(self.socket_path)
+                sock.sendall(request_line)
+                with sock.makefile("rb") as stream:
+                    response_line = stream.readline()
+        except socket.timeout:
+            raise TimeoutError(f"Collector không trả lời thao tác '{op}' sau {timeout_s}s.")
+        except OSError as e:
+            raise CollectorError(f"Không kết nối được collector tại {self.socket_path}: {e}")
+        if not response_line:
+            raise CollectorError(f"Collector đóng kết nối khi thực hiện '{op}'.")
+
+        response = json.loads(response_line)
+        if response.get("ok"):
+            return response.get("result")
+        error_type = response.get("error_type")
+        message = response.get("error") or "Lỗi không xác định"
+        if error_type == "TimeoutError":
+            raise TimeoutError(message)
+        if error_type == "ValueError":
+            raise ValueError(message)
+        raise CollectorError(f"{error_type}: {message}")
+
+    def __getattr__(self, name):
+        if name not in CollectorService.OPERATIONS:
+            raise AttributeError(name)
+        return lambda **kwargs: self.call(name, **kwargs)
+
+
+class _CollectorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for request_line in self.rfile:
+            try:
+                request = json.loads(request_line)
+                op = request.get("op")
+                if op not in CollectorService.OPERATIONS:
+                    raise ValueError(f"Thao tác không hợp lệ: {op}")
+                result = getattr(self.server.service, op)(**(request.get("args") or {}))
+                response = {"ok": True, "result": result}
+            except Exception as e:
+                if not isinstance(e, (TimeoutError, ValueError)):
+                    logger.error(f"Collector IPC: Lỗi khi xử lý request: {e}", exc_info=True)
+                response = {"ok": False, "error": str(e), "error_type": type(e).__name__}
+            self.wfile.write(json.dumps(response, default=str).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class CollectorIpcServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server phục vụ CollectorService, mỗi kết nối một thread (các thao tác đều blocking)."""
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, service: CollectorService):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path) # Socket còn sót từ lần chạy trước
+        super().__init__(socket_path, _CollectorRequestHandler)
+        os.chmod(socket_path, 0o660) # Chỉ user/group của collector và UI được gọi
+        self.socket_path = socket_path
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class Collector:
+    """
+    Điểm truy cập runtime OPC UA cho các route. Khi tiến trình sở hữu runtime (collector, hoặc Flask chạy gộp
+    khi không cấu hình COLLECTOR_SOCKET) các thao tác gọi thẳng CollectorService; ngược lại chúng được gửi
+    tới tiến trình collector qua Unix socket, nên có thể chạy nhiều tiến trình Flask mà chỉ có một bộ session.
+    """
+    def __init__(self):
+        self._backend = None
+        self.is_remote = False
+
+    def init_app(self, app_instance, owns_runtime: bool):
+        if owns_runtime:
+            self._backend = CollectorService(app_instance)
+            self.is_remote = False
+        else:
+            # Chờ lâu hơn deadline của collector (như COLLECTOR_IPC_TIMEOUT_S so với ASYNC_JOB_TIMEOUT_S)
+            # để collector tự báo timeout thay vì socket bị đóng giữa chừng
+            ipc_margin_s = max(0.0, app_instance.config['COLLECTOR_IPC_TIMEOUT_S'] - app_instance.config['ASYNC_JOB_TIMEOUT_S'])
+            self._backend = CollectorClient(app_instance.config['COLLECTOR_SOCKET'],
+                                            app_instance.config['COLLECTOR_IPC_TIMEOUT_S'],
+                                            app_instance.config['ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S'] + ipc_margin_s)
+            self.is_remote = True
+            logger.info(f"Runtime OPC UA được điều khiển qua collector tại {app_instance.config['COLLECTOR_SOCKET']}.")
+
+    def serve(self, socket_path: str):
+        """Chạy IPC server trên một thread nền (chỉ dùng trong tiến trình collector). Trả về server để đóng khi dừng."""
+        if self.is_remote or self._backend is None:
+            raise RuntimeError("Chỉ tiến trình sở hữu runtime OPC UA mới phục vụ được IPC.")
+        server = CollectorIpcServer(socket_path, self._backend)
+        threading.Thread(target=server.serve_forever, name="collector-ipc", daemon=True).start()
+        logger.info(f"Collector IPC đang lắng nghe tại {socket_path}.")
+        return server
+
+    def __getattr__(self, name):
+        if name not in CollectorService.OPERATIONS:
+            raise AttributeError(name)
+        if self._backend is None:
+            raise CollectorError("Collector chưa được init_app.")
+        return getattr(self._backend, name)
+
+
+# Instance global, được gắn app trong create_app
+collector = Collector()
@@ -8,4 +8,82 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'MaxElectric@2025' # Rất quan trọng cho production
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'opcua_app.db') # Đường dẫn tới file DB SQLite
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # --- Logging (log_config.py) ---
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO' # DEBUG để xem từng DataChange (đã được lấy mẫu theo mapping)
+    LOG_FILE = os.environ.get('LOG_FILE') or 'opcua_client_maxelectric.txt'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024) # Xoay file khi vượt dung lượng này
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 5)
+    LOG_TO_CONSOLE = (os.environ.get('LOG_TO_CONSOLE') or '1') != '0'
+    LOG_RATE_LIMIT_INTERVAL_S = float(os.environ.get('LOG_RATE_LIMIT_INTERVAL_S') or 10) # Mỗi loại log lặp lại của một mapping tối đa một lần trong khoảng này
+
+    # --- Pipeline gửi giá trị thay đổi tới API datapoint (app/delivery.py) ---
+    DATAPOINT_API_ENABLED = (os.environ.get('DATAPOINT_API_ENABLED') or '1') != '0' # 0: chỉ xuất qua IEC-104, không gửi HTTP
+    DATAPOINT_API_URL = os.environ.get('DATAPOINT_API_URL') or 'http://localhost:5001/api/v1/datapoint-value'
+    DATAPOINT_API_METHOD = os.environ.get('DATAPOINT_API_METHOD') or 'PUT' # PUT hoặc POST, body là list các {ioa, value}
+    DELIVERY_BATCH_SIZE = int(os.environ.get('DELIVERY_BATCH_SIZE') or 500) # Số item tối đa mỗi request
+    DELIVERY_LINGER_MS = int(os.environ.get('DELIVERY_LINGER_MS') or 50) # Thời gian chờ gom lô
+    DELIVERY_QUEUE_MAXSIZE = int(os.environ.get('DELIVERY_QUEUE_MAXSIZE') or 100000)
+    DELIVERY_SENDER_THREADS = int(os.environ.get('DELIVERY_SENDER_THREADS') or 2) # Cũng là kích thước connection pool
+    DELIVERY_REQUEST_TIMEOUT_S = float(os.environ.get('DELIVERY_REQUEST_TIMEOUT_S') or 10)
+    DELIVERY_RETRY_INTERVAL_S = float(os.environ.get('DELIVERY_RETRY_INTERVAL_S') or 5) # Chờ trước khi gửi lại outbox sau khi API lỗi
+    DELIVERY_OUTBOX_ENABLED = (os.environ.get('DELIVERY_OUTBOX_ENABLED') or '1') != '0' # Ghi mọi giá trị xuống outbox trên đĩa trước khi gửi
+    DELIVERY_OUTBOX_PATH = os.environ.get('DELIVERY_OUTBOX_PATH') or os.path.join(basedir, 'delivery_outbox.db') # File SQLite (WAL) riêng, không dùng DB của ứng dụng
+    DELIVERY_OUTBOX_COMMIT_INTERVAL_MS = int(os.environ.get('DELIVERY_OUTBOX_COMMIT_INTERVAL_MS') or 20) # Gom giá trị cho một lần commit
+    DELIVERY_OUTBOX_MAX_ROWS = int(os.environ.get('DELIVERY_OUTBOX_MAX_ROWS') or 5000000) # Số giá trị chưa gửi tối đa, vượt thì bỏ giá trị cũ nhất
+    DELIVERY_OUTBOX_RETENTION_S = float(os.environ.get('DELIVERY_OUTBOX_RETENTION_S') or 7 * 24 * 3600) # Giá trị chưa gửi quá lâu thì bỏ
+    DELIVERY_OUTBOX_SYNCHRONOUS = os.environ.get('DELIVERY_OUTBOX_SYNCHRONOUS') or 'NORMAL' # FULL để an toàn cả khi mất điện (chậm hơn)
+
+    # --- Outstation IEC 60870-5-104 xuất giá trị theo ioa_mapping (app/iec104.py) ---
+    IEC104_ENABLED = (os.environ.get('IEC104_ENABLED') or '0') != '0'
+    IEC104_HOST = os.environ.get('IEC104_HOST') or '0.0.0.0'
+    IEC104_PORT = int(os.environ.get('IEC104_PORT') or 2404)
+    IEC104_COMMON_ADDRESS = int(os.environ.get('IEC104_COMMON_ADDRESS') or 1) # Địa chỉ chung (CA) của ASDU
+    IEC104_K = int(os.environ.get('IEC104_K') or 12) # Số I-frame gửi tối đa chưa được master xác nhận
+    IEC104_W = int(os.environ.get('IEC104_W') or 8) # Gửi S-frame xác nhận sau chừng này I-frame nhận được
+    IEC104_T1_S = float(os.environ.get('IEC104_T1_S') or 15) # Chờ xác nhận tối đa trước khi đóng kết nối
+    IEC104_T2_S = float(os.environ.get('IEC104_T2_S') or 10) # Xác nhận I-frame đã nhận chậm nhất sau chừng này
+    IEC104_T3_S = float(os.environ.get('IEC104_T3_S') or 20) # Gửi TESTFR khi kết nối im lặng quá lâu
+    IEC104_TIME_TAG = (os.environ.get('IEC104_TIME_TAG') or '1') != '0' # Dữ liệu tự phát dùng M_ME_TF_1/M_SP_TB_1 kèm CP56Time2a
+    IEC104_MAX_OBJECTS_PER_ASDU = int(os.environ.get('IEC104_MAX_OBJECTS_PER_ASDU') or 127) # Còn bị giới hạn bởi độ dài APDU
+    IEC104_FLUSH_INTERVAL_MS = int(os.environ.get('IEC104_FLUSH_INTERVAL_MS') or 10) # Chu kỳ gom giá trị thành ASDU
+    IEC104_MAX_PENDING = int(os.environ.get('IEC104_MAX_PENDING') or 100000) # Giá trị chờ gom / ASDU chờ gửi của mỗi kết nối
+
+    # --- API pull các thay đổi theo seq (app/change_log.py, GET /api/values) ---
+    CHANGE_LOG_CAPACITY = int(os.environ.get('CHANGE_LOG_CAPACITY') or 200000) # Số thay đổi gần nhất giữ trong ring buffer, 0 = tắt
+    VALUES_API_MAX_ITEMS = int(os.environ.get('VALUES_API_MAX_ITEMS') or 10000) # Số thay đổi tối đa mỗi response
+    VALUES_API_MAX_WAIT_S = float(os.environ.get('VALUES_API_MAX_WAIT_S') or 25) # Thời gian long-poll tối đa khi chưa có thay đổi mới
+
+    # --- Kết nối ---
+    AUTO_RECONNECT_CONCURRENCY = int(os.environ.get('AUTO_RECONNECT_CONCURRENCY') or 8) # Số server được tự động kết nối lại đồng thời khi khởi động
+    SUPERVISOR_CHECK_INTERVAL_S = float(os.environ.get('SUPERVISOR_CHECK_INTERVAL_S') or 5) # Chu kỳ kiểm tra session (đọc ServerStatus)
+    SUPERVISOR_HEALTH_TIMEOUT_S = float(os.environ.get('SUPERVISOR_HEALTH_TIMEOUT_S') or 5)
+    SUPERVISOR_BACKOFF_INITIAL_S = float(os.environ.get('SUPERVISOR_BACKOFF_INITIAL_S') or 1) # Thời gian chờ trước lần kết nối lại thứ 2, nhân đôi mỗi lần
+    SUPERVISOR_BACKOFF_MAX_S = float(os.environ.get('SUPERVISOR_BACKOFF_MAX_S') or 60)
+
+    # --- Collector (tiến trình giữ session OPC UA, xem run_collector.py) ---
+    COLLECTOR_SOCKET = os.environ.get('COLLECTOR_SOCKET') or '' # Unix socket của collector; để trống thì Flask tự giữ runtime OPC UA
+    COLLECTOR_IPC_TIMEOUT_S = float(os.environ.get('COLLECTOR_IPC_TIMEOUT_S') or 120) # Lớn hơn ASYNC_JOB_TIMEOUT_S để collector tự báo timeout
+    IS_COLLECTOR = False
+
+    # --- AsyncWorker ---
+    ASYNC_JOB_TIMEOUT_S = float(os.environ.get('ASYNC_JOB_TIMEOUT_S') or 60) # Deadline mặc định của một thao tác OPC UA
+    ASYNC_READ_TIMEOUT_S = float(os.environ.get('ASYNC_READ_TIMEOUT_S') or 10) # Deadline của các thao tác đọc từ giao diện
+    ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S = float(os.environ.get('ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S') or 600) # Deadline của Subscribe All/Unsubscribe All (mọi server, mọi chunk)
+    ASYNC_JOBS_PER_SERVER = int(os.environ.get('ASYNC_JOBS_PER_SERVER') or 4) # Số thao tác chạy đồng thời tối đa trên một server
+    ASYNC_JOB_MAX_WAIT_S = float(os.environ.get('ASYNC_JOB_MAX_WAIT_S') or 25) # Thời gian long-poll tối đa của /async_jobs/<job_id>
+    ASYNC_WORKER_SHARDS = int(os.environ.get('ASYNC_WORKER_SHARDS') or 1) # Số event loop (thread), server được gán cố định theo server_id % số shard
+
+    # --- Đọc giá trị ---
+    VALUE_CACHE_MAX_AGE_S = float(os.environ.get('VALUE_CACHE_MAX_AGE_S') or 5) # Tuổi tối đa của giá trị từ subscription được dùng thay cho Read trực tiếp
+    NODE_VALUES_MAX_IDS = int(os.environ.get('NODE_VALUES_MAX_IDS') or 5000) # Số node tối đa trong một request đọc giá trị theo lô
+
+    # --- Duyệt node ---
+    BROWSE_SAVE_CHUNK_SIZE = int(os.environ.get('BROWSE_SAVE_CHUNK_SIZE') or 1000) # Số node ghi xuống DB mỗi lần (streaming)
+    NODE_TREE_PAGE_SIZE = int(os.environ.get('NODE_TREE_PAGE_SIZE') or 500) # Số node con tối đa trả về mỗi lần mở một nhánh trong cây node
+    NODE_SEARCH_MAX_RESULTS = int(os.environ.get('NODE_SEARCH_MAX_RESULTS') or 100) # Số node khớp tối đa của ô tìm kiếm cây node (tìm trong DB)
+
+
+class CollectorConfig(Config):
+    IS_COLLECTOR = True # Tiến trình collector luôn giữ runtime OPC UA và phục vụ IPC tại COLLECTOR_SOCKET
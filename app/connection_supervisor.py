@@ -0,0 +1,252 @@
+# app/connection_supervisor.py
+import asyncio
+import logging
+import random
+import time
+
+from asyncua import ua
+from asyncua.ua.ua_binary import struct_from_binary
+
+from app import opcua_client
+from app.subscription_manager import subscription_manager
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionSupervisor:
+    """
+    Giám sát kết nối của các server: mỗi server đang kết nối có một task trên event loop của AsyncWorker,
+    định kỳ đọc ServerStatus.State để kiểm tra session. Khi mất kết nối, task kết nối lại với exponential backoff
+    có jitter, thử TransferSubscriptions để giữ nguyên các subscription cũ trên server (mất kết nối ngắn),
+    subscription nào không chuyển được thì được tạo lại theo lô từ các mapping đã subscribe trước đó.
+    Mọi phương thức (trừ status) phải được gọi trên event loop của AsyncWorker.
+    """
+    def __init__(self):
+        self._app = None
+        self._tasks = {} # server_id -> asyncio.Task giám sát
+        self._states = {} # server_id -> dict trạng thái, xem status()
+
+    def init_app(self, app_instance):
+        self._app = app_instance
+
+    def _config(self, key, default):
+        return self._app.config.get(key, default) if self._app is not None else default
+
+    def watch(self, server_id: int):
+        """Bắt đầu giám sát server. Không làm gì nếu server đang được giám sát (kể cả khi đang kết nối lại)."""
+        task = self._tasks.get(server_id)
+        if task is not None and not task.done():
+            return
+        self._states[server_id] = {"state": "CONNECTED", "attempts": 0, "reconnects": 0,
+                                   "transferred_subscriptions": 0, "recreated_subscriptions": 0,
+                                   "last_error": None, "since": time.time()}
+        self._tasks[server_id] = asyncio.get_running_loop().create_task(self._supervise(server_id))
+        logger.info(f"Supervisor: Bắt đầu giám sát kết nối Server ID {server_id}.")
+
+    def unwatch(self, server_id: int):
+        """Dừng giám sát server (khi người dùng ngắt kết nối hoặc xóa server)."""
+        task = self._tasks.pop(server_id, None)
+        self._states.pop(server_id, None)
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            logger.info(f"Supervisor: Dừng giám sát kết nối Server ID {server_id}.")
+
+    def status(self, server_id: int):
+        """Bản sao trạng thái giám sát của server (an toàn khi gọi từ thread Flask), None nếu không giám sát."""
+        state = self._states.get(server_id)
+        return dict(state) if state is not None else None
+
+    async def _supervise(self, server_id: int):
+        check_interval_s = self._config('SUPERVISOR_CHECK_INTERVAL_S', 5.0)
+        try:
+            while True:
+                await asyncio.sleep(check_interval_s)
+                client = opcua_client.get_client_by_server_id(server_id)
+                if client is None:
+                    logger.info(f"Supervisor: Server ID {server_id} không còn client kết nối, dừng giám sát.")
+                    return
+                error = await self._check_health(client)
+                if error is None:
+                    continue
+                logger.warning(f"Supervisor: Server ID {server_id} mất kết nối ({error}). Bắt đầu kết nối lại.")
+                if not await self._recover(server_id, client, error):
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Supervisor: Lỗi không mong muốn khi giám sát Server ID {server_id}: {e}", exc_info=True)
+        finally:
+            if self._tasks.get(server_id) is asyncio.current_task():
+                self._tasks.pop(server_id, None)
+                self._states.pop(server_id, None)
+
+    async def _check_health(self, client):
+        """Đọc ServerStatus.State (có timeout). Trả về None nếu session còn tốt, ngược lại là lỗi."""
+        try:
+            state = await asyncio.wait_for(client.nodes.server_state.read_value(),
+                                           self._config('SUPERVISOR_HEALTH_TIMEOUT_S', 5.0))
+        except asyncio.TimeoutError:
+            return "timeout khi đọc ServerStatus"
+        except Exception as e:
+            return e
+        if state != ua.ServerState.Running:
+            return f"ServerState={state}"
+        return None
+
+    async def _recover(self, server_id: int, old_client, error) -> bool:
+        """Kết nối lại và khôi phục subscription. Trả về False nếu phải dừng giám sát (server không còn cần kết nối)."""
+        loop = asyncio.get_running_loop()
+        state = self._states.setdefault(server_id, {})
+        state.update({"state": "RECONNECTING", "attempts": 0, "last_error": str(error), "since": time.time()})
+
+        # Route thấy server chưa kết nối trong lúc kết nối lại; client cũ bị bỏ mà không CloseSession
+        # để các subscription còn sống trên server cho TransferSubscriptions
+        if opcua_client.active_clients.get(server_id) is old_client:
+            opcua_client.active_clients.pop(server_id, None)
+        _abandon_client(old_client)
+        subscription_manager.suspend_server(server_id) # Không heartbeat giá trị cũ như còn hợp lệ trong lúc mất kết nối
+        opcua_client.server_operation_limits.pop(server_id, None) # Server có thể đã khởi động lại với cấu hình khác
+
+        initial_s = self._config('SUPERVISOR_BACKOFF_INITIAL_S', 1.0)
+        max_s = self._config('SUPERVISOR_BACKOFF_MAX_S', 60.0)
+        attempt = 0
+        while server_id not in opcua_client.active_clients:
+            server_config = await loop.run_in_executor(None, self._load_server_config, server_id)
+            if server_config is None or server_config.connection_status != "CONNECTED":
+                logger.info(f"Supervisor: Server ID {server_id} không còn được đánh dấu 'CONNECTED', dừng kết nối lại.")
+                opcua_client.forget_server_runtime_state(server_id)
+                return False
+            attempt += 1
+            state["attempts"] = attempt
+            if await opcua_client.connect_server(server_config):
+                break
+            delay_s = _backoff_delay(attempt, initial_s, max_s)
+            logger.warning(f"Supervisor: Kết nối lại Server ID {server_id} lần {attempt} thất bại, thử lại sau {delay_s:.1f}s.")
+            await asyncio.sleep(delay_s)
+
+        new_client = opcua_client.active_clients[server_id]
+        state["reconnects"] = state.get("reconnects", 0) + 1
+        logger.info(f"Supervisor: Đã kết nối lại Server ID {server_id} sau {attempt} lần thử.")
+
+        groups = subscription_manager.groups_for_server(server_id)
+        transferred_keys = await self._transfer_subscriptions(server_id, groups, new_client)
+        lost_keys = [key for key, _ in groups if key not in transferred_keys]
+        recreated = await self._recreate_subscriptions(server_id, lost_keys) if lost_keys else 0
+
+        state["transferred_subscriptions"] = state.get("transferred_subscriptions", 0) + len(transferred_keys)
+        state["recreated_subscriptions"] = state.get("recreated_subscriptions", 0) + len(lost_keys)
+        state.update({"state": "CONNECTED", "attempts": 0, "since": time.time()})
+        logger.info(f"Supervisor: Khôi phục Server ID {server_id} xong: {len(transferred_keys)} subscription được chuyển, "
+                    f"{len(lost_keys)} subscription được tạo lại ({recreated} mapping).")
+        return True
+
+    async def _transfer_subscriptions(self, server_id: int, groups, new_client):
+        """Chuyển các subscription cũ sang session mới. Trả về set key của các subscription chuyển thành công."""
+        if not groups:
+            return set()
+        subscription_ids = [group.subscription_id for _, group in groups]
+        try:
+            results = await _transfer_subscriptions_request(new_client, subscription_ids)
+        except Exception as e_transfer:
+            logger.info(f"Supervisor: TransferSubscriptions không khả dụng cho Server ID {server_id} ({e_transfer}), "
+                        f"sẽ tạo lại {len(groups)} subscription.")
+            return set()
+
+        transferred_keys = set()
+        for (key, group), result in zip(groups, results):
+            if result.StatusCode.is_good():
+                _rebind_subscription(group.subscription, new_client)
+                group.resume()
+                transferred_keys.add(key)
+            else:
+                logger.info(f"Supervisor: Không chuyển được SubId {group.subscription_id} của Server ID {server_id}: "
+                            f"{result.StatusCode.name}.")
+        return transferred_keys
+
+    async def _recreate_subscriptions(self, server_id: int, keys) -> int:
+        """Tạo lại theo lô các mapping của những subscription không chuyển được. Trả về số mapping subscribe lại thành công."""
+        mapping_ids = subscription_manager.drop_groups(keys)
+        for mapping_id in mapping_ids:
+            opcua_client.pop_active_route(mapping_id)
+        if not mapping_ids:
+            return 0
+        specs = await asyncio.get_running_loop().run_in_executor(None, self._load_mapping_specs, mapping_ids)
+        if not specs:
+            return 0
+        success_count, failed_count, _ = await opcua_client.bulk_subscribe_server_mappings(server_id, specs)
+        if failed_count:
+            logger.warning(f"Supervisor: {failed_count}/{len(specs)} mapping của Server ID {server_id} không subscribe lại được.")
+        return success_count
+
+    def _load_server_config(self, server_id: int):
+        from app import db
+        from app.models import OpcServer # Import ở đây để tránh circular
+        with self._app.app_context():
+            server_config = OpcServer.query.get(server_id)
+            if server_config is not None:
+                db.session.expunge(server_config) # Dùng trên thread của AsyncWorker sau khi app context kết thúc
+            return server_config
+
+    def _load_mapping_specs(self, mapping_ids):
+        from app import db
+        from app.models import SubscriptionMapping, OpcNode # Import ở đây để tránh circular
+        with self._app.app_context():
+            rows = (db.session.query(SubscriptionMapping.id, SubscriptionMapping.ioa_mapping,
+                                     SubscriptionMapping.sampling_interval_ms, SubscriptionMapping.publishing_interval_ms,
+                                     SubscriptionMapping.deadband_type, SubscriptionMapping.deadband_value,
+                                     SubscriptionMapping.heartbeat_interval_s, OpcNode.node_id_string)
+                    .join(OpcNode, SubscriptionMapping.opc_node_db_id == OpcNode.id)
+                    .filter(SubscriptionMapping.id.in_(mapping_ids), SubscriptionMapping.is_active == True)
+                    .all())
+        return [{"mapping_id": mapping_id, "node_id_str": node_id_str, "ioa": ioa,
+                 "sampling_ms": sampling_ms, "publishing_ms": publishing_ms,
+                 "deadband_type": deadband_type, "deadband_value": deadband_value,
+                 "heartbeat_interval_s": heartbeat_interval_s}
+                for mapping_id, ioa, sampling_ms, publishing_ms, deadband_type, deadband_value, heartbeat_interval_s,
+                    node_id_str in rows]
+
+
+def _backoff_delay(attempt: int, initial_s: float, max_s: float) -> float:
+    """Exponential backoff có jitter: một nửa cố định, một nửa ngẫu nhiên để các server không kết nối lại cùng lúc."""
+    delay_s = min(max_s, initial_s * (2 ** (attempt - 1)))
+    return delay_s / 2 + random.uniform(0, delay_s / 2)
+
+
+def _abandon_client(client):
+    """
+    Bỏ client đã mất kết nối mà không gửi CloseSession (CloseSession sẽ xóa subscription trên server):
+    dừng các task nền của asyncua (watchdog, gia hạn channel, publish) và đóng socket.
+    """
+    client._closing = True
+    client.uaclient._closing = True
+    for task in (client._monitor_server_task, client._renew_channel_task, client.uaclient._publish_task):
+        if task is not None and not task.done():
+            task.cancel()
+    try:
+        client.disconnect_socket()
+    except Exception:
+        pass
+
+
+async def _transfer_subscriptions_request(client, subscription_ids):
+    """Gửi TransferSubscriptions trên session của client (asyncua 1.1 chưa hỗ trợ: UaClient.transfer_subscriptions raise NotImplementedError)."""
+    request = ua.TransferSubscriptionsRequest()
+    request.Parameters.SubscriptionIds = list(subscription_ids)
+    request.Parameters.SendInitialValues = True
+    data = await client.uaclient.protocol.send_request(request)
+    response = struct_from_binary(ua.TransferSubscriptionsResponse, data)
+    response.ResponseHeader.ServiceResult.check()
+    return response.Parameters.Results
+
+
+def _rebind_subscription(subscription, new_client):
+    """Gắn asyncua Subscription đã được chuyển vào UaClient mới để nhận Publish trên session mới."""
+    uaclient = new_client.uaclient
+    subscription.server = uaclient
+    uaclient._subscription_callbacks[subscription.subscription_id] = subscription.publish_callback
+    if not uaclient._publish_task or uaclient._publish_task.done():
+        uaclient._publish_task = asyncio.create_task(uaclient._publish_loop())
+
+
+# Instance global, được gắn app trong create_app
+connection_supervisor = ConnectionSupervisor()
@@ -0,0 +1,138 @@
+# app/datatype_cache.py
+import asyncio
+import logging
+import threading
+
+from asyncua import ua
+
+logger = logging.getLogger(__name__)
+
+
+class DataTypeCache:
+    """
+    Cache tên DataType (NodeId dạng chuỗi -> DisplayName) theo từng server.
+    Một server chỉ có vài chục DataType khác nhau nên tên được đọc từ server một lần khi gặp lần đầu,
+    sau đó lưu vào bảng opc_data_types để dùng lại cho các lần duyệt, xem chi tiết node và form mapping.
+    """
+    def __init__(self):
+        self._app = None
+        self._names = {} # server_id -> {datatype_node_id_str: display_name}
+        self._lock = threading.Lock() # Được dùng từ cả thread Flask và thread của AsyncWorker
+
+    def init_app(self, app_instance):
+        """Giữ app để đọc/ghi DB (cần app_context) từ thread của AsyncWorker."""
+        self._app = app_instance
+
+    def _load_server(self, server_id: int) -> dict:
+        """Nạp cache của server từ DB (một lần). Trả về dict tên DataType của server."""
+        with self._lock:
+            names = self._names.get(server_id)
+        if names is not None:
+            return names
+
+        names = {}
+        if self._app is not None:
+            from app.models import OpcDataType # Import ở đây để tránh circular
+            try:
+                with self._app.app_context():
+                    rows = OpcDataType.query.with_entities(OpcDataType.node_id_string, OpcDataType.display_name)\
+                                            .filter_by(server_id=server_id).all()
+                names = {node_id_string: display_name for node_id_string, display_name in rows}
+                logger.info(f"Đã nạp {len(names)} DataType từ DB cho server ID {server_id}.")
+            except Exception as e:
+                logger.error(f"Lỗi khi nạp DataType từ DB cho server ID {server_id}: {e}", exc_info=True)
+
+        with self._lock:
+            return self._names.setdefault(server_id, names)
+
+    def _persist(self, server_id: int, new_names: dict):
+        if self._app is None or not new_names:
+            return
+        from app import db
+        from app.models import OpcDataType
+        try:
+            with self._app.app_context():
+                existing = {row.node_id_string: row for row in
+                            OpcDataType.query.filter(OpcDataType.server_id == server_id,
+                                                     OpcDataType.node_id_string.in_(list(new_names.keys()))).all()}
+                for node_id_string, display_name in new_names.items():
+                    row = existing.get(node_id_string)
+                    if row is None:
+                        db.session.add(OpcDataType(server_id=server_id, node_id_string=node_id_string,
+                                                   display_name=display_name))
+                    elif row.display_name != display_name:
+                        row.display_name = display_name
+                db.session.commit()
+            logger.info(f"Đã lưu {len(new_names)} DataType mới vào DB cho server ID {server_id}.")
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu DataType vào DB cho server ID {server_id}: {e}", exc_info=True)
+
+    def get_name(self, server_id: int, datatype_node_id_str: str):
+        """Tra tên DataType (đồng bộ, dùng trong route). Trả về None nếu chưa có trong cache."""
+        if not datatype_node_id_str:
+            return None
+        return self._load_server(server_id).get(datatype_node_id_str)
+
+    def display(self, server_id: int, data_type_str: str):
+        """Tên hiển thị cho giá trị data_type đã lưu (có thể là tên hoặc NodeId chưa phân giải)."""
+        return self.get_name(server_id, data_type_str) or data_type_str
+
+    async def resolve(self, client, server_id: int, datatype_nodeids: dict, read=None) -> dict:
+        """
+        Trả về dict {datatype_node_id_str: display_name} cho các DataType trong datatype_nodeids
+        ({datatype_node_id_str: ua.NodeId}). Các DataType chưa có trong cache được đọc trong một request Read
+        (qua read(targets) nếu được truyền vào, mặc định là client.uaclient.read) rồi lưu vào DB.
+        DataType không đọc được tên sẽ không có trong kết quả.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            names = self._names.get(server_id)
+        if names is None:
+            # Truy vấn DB không được chạy trực tiếp trên event loop
+            names = await loop.run_in_executor(None, self._load_server, server_id)
+
+        result = {key: names[key] for key in datatype_nodeids if key in names}
+        missing = [key for key in datatype_nodeids if key not in names]
+        if not missing:
+            return result
+
+        targets = [(datatype_nodeids[key], ua.AttributeIds.DisplayName) for key in missing]
+        if read is None:
+            read = lambda read_targets: _read_targets(client, read_targets)
+        try:
+            data_values = await read(targets)
+        except Exception as e_read:
+            logger.debug(f"Không thể phân giải tên DataType ({len(missing)} kiểu) cho ServerID={server_id}: {e_read}.")
+            return result
+
+        new_names = {}
+        for key, data_value in zip(missing, data_values):
+            if data_value.StatusCode.is_good() and data_value.Value is not None:
+                name_obj = data_value.Value.Value
+                if name_obj and getattr(name_obj, "Text", None):
+                    new_names[key] = name_obj.Text
+        if new_names:
+            with self._lock:
+                self._names.setdefault(server_id, {}).update(new_names)
+            result.update(new_names)
+            await loop.run_in_executor(None, self._persist, server_id, new_names)
+        return result
+
+    def forget_server(self, server_id: int):
+        """Bỏ cache trong bộ nhớ của server (ví dụ khi server bị xóa)."""
+        with self._lock:
+            self._names.pop(server_id, None)
+
+
+async def _read_targets(client, read_targets):
+    params = ua.ReadParameters()
+    for node_id, attribute_id in read_targets:
+        rv = ua.ReadValueId()
+        rv.NodeId = node_id
+        rv.AttributeId = attribute_id
+        params.NodesToRead.append(rv)
+    return await client.uaclient.read(params)
+
+
+# Instance global, được gắn app trong create_app
+datatype_cache = DataTypeCache()
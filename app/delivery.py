@@ -0,0 +1,376 @@
+# app/delivery.py
+import json
+import logging
+import math
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import metrics
+from app.outbox import DeliveryOutbox
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_COMMIT_ITEMS = 5000 # Số giá trị tối đa ghi vào outbox trong một transaction
+OUTBOX_MAINTENANCE_INTERVAL_S = 1.0 # Chu kỳ lưu offset, xóa giá trị đã gửi và áp dụng retention
+
+# Kết quả gửi một lô
+SENT = "sent"
+RETRY = "retry" # Lỗi tạm thời (mạng, timeout, 5xx, 408, 429): outbox gửi lại sau DELIVERY_RETRY_INTERVAL_S
+REJECTED = "rejected" # API từ chối vĩnh viễn (4xx khác) hoặc không serialize được: bỏ lô, không chặn các lô sau
+
+RETRYABLE_CLIENT_ERRORS = frozenset((408, 429))
+
+
+class DeliveryPipeline:
+    """
+    Pipeline gửi giá trị thay đổi tới API datapoint.
+    MappingRoute chỉ đẩy (ioa, value) vào hàng đợi trong bộ nhớ (không chặn event loop),
+    các sender thread gom thành lô (list các {ioa, value}) và gửi qua một
+    requests.Session dùng chung (connection pool keep-alive).
+    Khi có outbox (DELIVERY_OUTBOX_ENABLED), thread writer ghi hàng đợi xuống outbox trên đĩa theo nhóm,
+    thread dispatcher đọc outbox từ offset đã gửi thành các lô cho sender thread; lô gửi lỗi không bị bỏ mà
+    được gửi lại (tua về offset đã xác nhận) sau DELIVERY_RETRY_INTERVAL_S, kể cả sau khi khởi động lại.
+    """
+    def __init__(self):
+        self.enabled = True # False (DATAPOINT_API_ENABLED=0): không khởi động, MappingRoute không gửi vào pipeline
+        self.api_url = "http://localhost:5001/api/v1/datapoint-value"
+        self.http_method = "PUT"
+        self.batch_size = 500 # Số item tối đa trong một request
+        self.linger_ms = 50 # Thời gian tối đa chờ gom thêm item sau item đầu tiên của lô
+        self.max_queue_size = 100000
+        self.sender_threads = 2 # Số request gửi song song (cũng là kích thước connection pool)
+        self.request_timeout_s = 10.0
+        self.retry_interval_s = 5.0 # Thời gian chờ trước khi gửi lại outbox sau một lô lỗi
+        self.outbox_commit_interval_ms = 20 # Thời gian chờ gom thêm giá trị cho một lần commit outbox
+        self.outbox = None # DeliveryOutbox, None: chỉ dùng hàng đợi trong bộ nhớ
+
+        self._queue = None
+        self._batches = None # Chế độ outbox: (seq đầu, seq cuối, lô) từ dispatcher cho sender thread
+        self._stopping = threading.Event()
+        self._send_failed = threading.Event()
+        self._session = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # Bộ đếm chỉ được cộng dồn, nhưng từ nhiều thread (submit trên các shard AsyncWorker, writer, dispatcher,
+        # các sender): "+=" trên dict không nguyên tử nên mọi lần cộng đi qua _count() dưới _stats_lock.
+        # Đọc bằng stats_snapshot().
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "submitted": 0,
+            "dropped": 0,
+            "delivered": 0,
+            "failed": 0,
+            "rejected": 0, # Giá trị bị API từ chối vĩnh viễn, đã bỏ (không gửi lại)
+            "batches_sent": 0,
+            "batches_failed": 0,
+            "replays": 0, # Số lần tua outbox để gửi lại sau lỗi
+        }
+
+    def init_app(self, app_instance):
+        """Đọc cấu hình từ app.config và khởi động các sender thread."""
+        cfg = app_instance.config
+        self.enabled = bool(cfg.get('DATAPOINT_API_ENABLED', True))
+        if not self.enabled:
+            logger.info("Delivery pipeline tắt (DATAPOINT_API_ENABLED=0), không gửi giá trị tới API datapoint.")
+            return
+        self.api_url = cfg.get('DATAPOINT_API_URL', self.api_url)
+        self.http_method = (cfg.get('DATAPOINT_API_METHOD', self.http_method) or "PUT").upper()
+        self.batch_size = max(1, int(cfg.get('DELIVERY_BATCH_SIZE', self.batch_size)))
+        self.linger_ms = max(0, int(cfg.get('DELIVERY_LINGER_MS', self.linger_ms)))
+        self.max_queue_size = max(1, int(cfg.get('DELIVERY_QUEUE_MAXSIZE', self.max_queue_size)))
+        self.sender_threads = max(1, int(cfg.get('DELIVERY_SENDER_THREADS', self.sender_threads)))
+        self.request_timeout_s = float(cfg.get('DELIVERY_REQUEST_TIMEOUT_S', self.request_timeout_s))
+        self.retry_interval_s = float(cfg.get('DELIVERY_RETRY_INTERVAL_S', self.retry_interval_s))
+        if cfg.get('DELIVERY_OUTBOX_ENABLED', False):
+            self.outbox = DeliveryOutbox(cfg['DELIVERY_OUTBOX_PATH'],
+                                         max_rows=int(cfg.get('DELIVERY_OUTBOX_MAX_ROWS', 5000000)),
+                                         retention_s=float(cfg.get('DELIVERY_OUTBOX_RETENTION_S', 7 * 24 * 3600)),
+                                         synchronous=cfg.get('DELIVERY_OUTBOX_SYNCHRONOUS', 'NORMAL'))
+            self.outbox_commit_interval_ms = max(0, int(cfg.get('DELIVERY_OUTBOX_COMMIT_INTERVAL_MS',
+                                                                self.outbox_commit_interval_ms)))
+        self.start()
+
+    def is_running(self) -> bool:
+        return any(t.is_alive() for t in self._threads)
+
+    def start(self):
+        with self._lock:
+            if self.is_running():
+                logger.info("Delivery pipeline đã chạy.")
+                return
+
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.sender_threads, max_retries=0)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+            self._session.headers.update({'Content-Type': 'application/json'})
+
+            self._stopping = threading.Event()
+            self._send_failed = threading.Event()
+            self._threads = []
+            if self.outbox is not None:
+                self.outbox.open()
+                self._batches = queue.Queue(maxsize=self.sender_threads)
+                self._start_thread(self._outbox_writer_loop, "delivery-outbox-writer")
+                self._start_thread(self._dispatch_loop, "delivery-dispatcher")
+                for i in range(self.sender_threads):
+                    self._start_thread(self._outbox_sender_loop, f"delivery-sender-{i}")
+            else:
+                for i in range(self.sender_threads):
+                    self._start_thread(self._sender_loop, f"delivery-sender-{i}")
+            logger.info(f"Delivery pipeline đã khởi động: URL={self.api_url}, Method={self.http_method}, "
+                        f"BatchSize={self.batch_size}, Linger={self.linger_ms}ms, Threads={self.sender_threads}, "
+                        f"Outbox={self.outbox.path if self.outbox else 'tắt'}")
+
+    def _start_thread(self, target, name):
+        t = threading.Thread(target=target, name=name, daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Dừng các sender thread sau khi gửi nốt các item còn trong hàng đợi.
+        Chế độ outbox: ghi nốt hàng đợi xuống outbox rồi dừng, phần chưa gửi được gửi ở lần khởi động sau.
+        """
+        with self._lock:
+            if not self._threads:
+                return
+            if self.outbox is not None:
+                # _threads: writer, dispatcher rồi tới các sender (xem start)
+                self._queue.put(None) # Writer commit nốt hàng đợi rồi đặt _stopping cho dispatcher
+                for t in self._threads[:2]:
+                    self._join(t, timeout)
+                for _ in self._threads[2:]:
+                    self._batches.put(None)
+                for t in self._threads[2:]:
+                    self._join(t, timeout)
+                self.outbox.close()
+            else:
+                for _ in self._threads:
+                    self._queue.put(None) # Sentinel, chặn nếu hàng đợi đầy để không làm mất dữ liệu
+                for t in self._threads:
+                    self._join(t, timeout)
+            self._threads = []
+            if self._session:
+                self._session.close()
+                self._session = None
+            logger.info("Delivery pipeline đã dừng.")
+
+    @staticmethod
+    def _join(thread, timeout):
+        thread.join(timeout=timeout)
+        if thread.is_alive():
+            logger.warning(f"Thread {thread.name} không dừng kịp.")
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def outbox_backlog(self) -> int:
+        """Số giá trị trong outbox chưa được API xác nhận (0 nếu không dùng outbox)."""
+        return self.outbox.backlog() if self.outbox is not None else 0
+
+    def submit(self, ioa: int, value, source_timestamp: float = None) -> bool:
+        """
+        Đưa một giá trị vào hàng đợi gửi. An toàn khi gọi từ bất kỳ thread/event loop nào,
+        không bao giờ chặn. Trả về False nếu item bị bỏ do hàng đợi đầy hoặc pipeline chưa chạy.
+        source_timestamp (epoch giây) dùng để đo độ trễ end-to-end khi API xác nhận.
+        """
+        if self._queue is None:
+            self._count("dropped")
+            return False
+        try:
+            self._queue.put_nowait((ioa, value, time.monotonic(), source_timestamp))
+        except queue.Full:
+            dropped = self._count("dropped")
+            if dropped % 1000 == 1:
+                logger.warning(f"Hàng đợi delivery đầy ({self.max_queue_size}), đã bỏ {dropped} item.")
+            return False
+        self._count("submitted")
+        return True
+
+    def _count(self, key: str, amount: int = 1) -> int:
+        with self._stats_lock:
+            self.stats[key] += amount
+            return self.stats[key]
+
+    def stats_snapshot(self) -> dict:
+        """Bản sao nhất quán của các bộ đếm (cho /metrics)."""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _sender_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            stop_after_send = False
+            deadline = time.monotonic() + self.linger_ms / 1000.0
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    # Khi tải cao hàng đợi luôn có sẵn item nên lô đầy ngay, không phải chờ linger
+                    next_item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_item is None:
+                    stop_after_send = True
+                    break
+                batch.append(next_item)
+
+            self._send_batch(batch)
+            if stop_after_send:
+                return
+
+    def _outbox_writer_loop(self):
+        next_maintenance = time.monotonic() + OUTBOX_MAINTENANCE_INTERVAL_S
+        stopping = False
+        while not stopping:
+            items = []
+            try:
+                item = self._queue.get(timeout=OUTBOX_MAINTENANCE_INTERVAL_S)
+                if item is None:
+                    stopping = True
+                else:
+                    items.append(item)
+                    # Group commit: gom các giá trị đến trong commit interval vào một transaction
+                    deadline = time.monotonic() + self.outbox_commit_interval_ms / 1000.0
+                    while len(items) < OUTBOX_MAX_COMMIT_ITEMS:
+                        remaining = deadline - time.monotonic()
+                        try:
+                            next_item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if next_item is None:
+                            stopping = True
+                            break
+                        items.append(next_item)
+            except queue.Empty:
+                pass
+
+            if items:
+                try:
+                    self.outbox.append(items)
+                except Exception as e:
+                    self._count("dropped", len(items))
+                    logger.error(f"Delivery: Không ghi được {len(items)} giá trị vào outbox: {e}", exc_info=True)
+            if stopping or time.monotonic() >= next_maintenance:
+                next_maintenance = time.monotonic() + OUTBOX_MAINTENANCE_INTERVAL_S
+                try:
+                    self._count("dropped", self.outbox.maintain())
+                except Exception as e:
+                    logger.error(f"Delivery: Lỗi khi bảo trì outbox: {e}", exc_info=True)
+        self._stopping.set()
+
+    def _dispatch_loop(self):
+        reader = self.outbox.connect()
+        cursor = self.outbox.delivered_seq
+        try:
+            while not self._stopping.is_set():
+                if self._send_failed.is_set():
+                    self._batches.join() # Chờ các lô đang gửi xong trước khi tua lại
+                    self._send_failed.clear()
+                    if self._stopping.wait(self.retry_interval_s):
+                        break
+                    cursor = self.outbox.delivered_seq
+                    self._count("replays")
+                    logger.warning(f"Delivery: Gửi lại outbox từ seq {cursor + 1} ({self.outbox.backlog()} giá trị chưa gửi).")
+                    continue
+                if not self.outbox.wait_for_rows(cursor, timeout=0.5):
+                    continue
+                last_committed = self.outbox.last_seq
+                rows = self.outbox.read_after(reader, cursor, self.batch_size)
+                if not rows:
+                    cursor = last_committed # Các giá trị đã bị xóa (retention)
+                    continue
+                wall_offset = time.time() - time.monotonic()
+                batch = [(ioa, value, enqueued_at - wall_offset, source_ts) for _, ioa, value, enqueued_at, source_ts in rows]
+                # Khoảng seq của lô tính từ cursor để các lô liền nhau, kể cả khi có seq đã bị xóa ở giữa
+                self._batches.put((cursor + 1, rows[-1][0], batch))
+                cursor = rows[-1][0]
+        except Exception as e:
+            logger.error(f"Delivery: Dispatcher outbox dừng do lỗi: {e}", exc_info=True)
+        finally:
+            reader.close()
+
+    def _outbox_sender_loop(self):
+        while True:
+            item = self._batches.get()
+            try:
+                if item is None:
+                    return
+                first_seq, last_seq, batch = item
+                if self._send_batch(batch) == RETRY:
+                    self._send_failed.set()
+                else: # Lô bị từ chối vĩnh viễn cũng được xác nhận để không chặn outbox tới hết retention
+                    self.outbox.ack(first_seq, last_seq)
+            finally:
+                self._batches.task_done()
+
+    def _send_batch(self, batch):
+        """Gửi một lô, trả về SENT, RETRY hoặc REJECTED."""
+        payload = [{"ioa": ioa, "value": _json_safe(value)} for ioa, value, _, _ in batch]
+        try:
+            body = json.dumps(payload, default=str, allow_nan=False)
+        except (TypeError, ValueError) as e:
+            return self._reject(batch, f"không serialize được JSON: {e}")
+        try:
+            response = self._session.request(self.http_method, self.api_url, data=body,
+                                             timeout=self.request_timeout_s)
+            status_code = response.status_code
+            if 400 <= status_code < 500 and status_code not in RETRYABLE_CLIENT_ERRORS:
+                return self._reject(batch, f"API trả về mã lỗi {status_code}: {response.text[:200]}")
+            if status_code >= 300:
+                self._count("failed", len(batch))
+                self._count("batches_failed")
+                logger.warning(f"Delivery: API trả về mã lỗi {response.status_code} cho lô {len(batch)} item: "
+                               f"{response.text[:200]}")
+                return RETRY
+            self._count("delivered", len(batch))
+            self._count("batches_sent")
+            self._observe_latency(batch)
+            logger.debug("Delivery: Đã gửi lô %d item, Status: %s", len(batch), response.status_code)
+            return SENT
+        except requests.exceptions.Timeout:
+            logger.error(f"Delivery: Timeout khi gọi API {self.api_url} (lô {len(batch)} item).")
+        except requests.exceptions.RequestException as req_e:
+            logger.error(f"Delivery: Lỗi RequestException khi gọi API {self.api_url} (lô {len(batch)} item): {req_e}")
+        except Exception as e:
+            logger.error(f"Delivery: Lỗi không xác định khi gửi lô {len(batch)} item: {e}", exc_info=True)
+        self._count("failed", len(batch))
+        self._count("batches_failed")
+        return RETRY
+
+    def _reject(self, batch, reason):
+        self._count("rejected", len(batch))
+        self._count("batches_failed")
+        ioas = [ioa for ioa, _, _, _ in batch[:20]]
+        logger.error(f"Delivery: Bỏ lô {len(batch)} item ({reason}). IOA: {ioas}{'...' if len(batch) > 20 else ''}")
+        return REJECTED
+
+    def _observe_latency(self, batch):
+        acked_monotonic = time.monotonic()
+        acked_wall = time.time()
+        metrics.delivery_queue_latency.observe_many([acked_monotonic - enqueued for _, _, enqueued, _ in batch])
+        metrics.end_to_end_latency.observe_many([max(0.0, acked_wall - source_ts)
+                                                 for _, _, _, source_ts in batch if source_ts is not None])
+
+
+def _json_safe(value):
+    """NaN/Infinity không phải JSON hợp lệ: gửi dưới dạng chuỗi (giống GET /api/values)."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    return value
+
+
+# Instance global, được cấu hình và khởi động trong create_app
+delivery_pipeline = DeliveryPipeline()
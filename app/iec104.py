@@ -0,0 +1,499 @@
+# app/iec104.py
+import asyncio
+import collections
+import logging
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from log_config import log_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# --- APCI ---
+START_BYTE = 0x68
+MAX_APDU_LENGTH = 253 # Độ dài tối đa sau byte length (4 byte control + ASDU)
+MAX_ASDU_LENGTH = MAX_APDU_LENGTH - 4
+SEQ_MODULO = 32768
+
+STARTDT_ACT = 0x07
+STARTDT_CON = 0x0B
+STOPDT_ACT = 0x13
+STOPDT_CON = 0x23
+TESTFR_ACT = 0x43
+TESTFR_CON = 0x83
+
+# --- Type ID ---
+M_SP_NA_1 = 1 # Single point
+M_ME_NC_1 = 13 # Giá trị đo, số thực ngắn
+M_SP_TB_1 = 30 # Single point kèm CP56Time2a
+M_ME_TF_1 = 36 # Số thực ngắn kèm CP56Time2a
+C_IC_NA_1 = 100 # General interrogation
+C_RD_NA_1 = 102 # Read
+C_CS_NA_1 = 103 # Clock synchronization
+
+# --- Cause of transmission ---
+COT_PERIODIC = 1
+COT_SPONTANEOUS = 3
+COT_REQUEST = 5
+COT_ACTIVATION = 6
+COT_ACTIVATION_CON = 7
+COT_ACTIVATION_TERM = 10
+COT_INTERROGATED_STATION = 20
+COT_UNKNOWN_TYPE = 44
+COT_UNKNOWN_CAUSE = 45
+COT_UNKNOWN_COMMON_ADDRESS = 46
+COT_UNKNOWN_IOA = 47
+COT_NEGATIVE = 0x40
+
+QOI_STATION = 20
+QUALITY_INVALID = 0x80 # Bit IV của QDS/SIQ
+QUALITY_OVERFLOW = 0x01 # Bit OV của QDS
+FLOAT_MAX = 3.4028234663852886e38
+BROADCAST_COMMON_ADDRESS = 0xFFFF
+
+ASDU_HEADER_LENGTH = 6 # type, VSQ, COT, originator, CA (2 byte)
+
+# Kích thước một information object (IOA 3 byte + phần tử) theo type
+_OBJECT_SIZES = {M_SP_NA_1: 4, M_SP_TB_1: 11, M_ME_NC_1: 8, M_ME_TF_1: 15}
+_FLOAT = struct.Struct("<f")
+
+
+def encode_cp56time2a(epoch_s: float) -> bytes:
+    """CP56Time2a (7 byte) theo UTC."""
+    dt = datetime.fromtimestamp(epoch_s, timezone.utc)
+    milliseconds = dt.second * 1000 + dt.microsecond // 1000
+    return bytes((milliseconds & 0xFF, milliseconds >> 8, dt.minute, dt.hour,
+                  dt.day | (dt.isoweekday() << 5), dt.month, dt.year % 100))
+
+
+def decode_cp56time2a(data: bytes) -> float:
+    """Đổi CP56Time2a (UTC, năm 2000-2099) về epoch giây."""
+    milliseconds = data[0] | (data[1] << 8)
+    dt = datetime(2000 + (data[6] & 0x7F), data[5] & 0x0F, data[4] & 0x1F, data[3] & 0x1F, data[2] & 0x3F,
+                  milliseconds // 1000, (milliseconds % 1000) * 1000, tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def i_frame(asdu: bytes, send_seq: int, recv_seq: int) -> bytes:
+    return bytes((START_BYTE, len(asdu) + 4, (send_seq << 1) & 0xFF, (send_seq >> 7) & 0xFF,
+                  (recv_seq << 1) & 0xFF, (recv_seq >> 7) & 0xFF)) + asdu
+
+
+def s_frame(recv_seq: int) -> bytes:
+    return bytes((START_BYTE, 4, 0x01, 0x00, (recv_seq << 1) & 0xFF, (recv_seq >> 7) & 0xFF))
+
+
+def u_frame(function: int) -> bytes:
+    return bytes((START_BYTE, 4, function, 0x00, 0x00, 0x00))
+
+
+def asdu_header(type_id: int, count: int, cot: int, common_address: int, originator: int = 0) -> bytes:
+    return bytes((type_id, count & 0x7F, cot, originator, common_address & 0xFF, common_address >> 8))
+
+
+def encode_object(type_id: int, ioa: int, value, quality: int, epoch_s) -> bytes:
+    """Một information object (SQ=0): IOA 3 byte + giá trị + chất lượng (+ CP56Time2a)."""
+    address = bytes((ioa & 0xFF, (ioa >> 8) & 0xFF, (ioa >> 16) & 0xFF))
+    if type_id in (M_SP_NA_1, M_SP_TB_1):
+        body = address + bytes(((1 if value else 0) | quality,))
+    else:
+        if abs(value) > FLOAT_MAX: # Ngoài phạm vi số thực ngắn: giữ dấu, đặt cờ OV
+            value = FLOAT_MAX if value > 0 else -FLOAT_MAX
+            quality |= QUALITY_OVERFLOW
+        body = address + _FLOAT.pack(value) + bytes((quality,))
+    if type_id in (M_SP_TB_1, M_ME_TF_1):
+        body += encode_cp56time2a(epoch_s if epoch_s is not None else time.time())
+    return body
+
+
+def point_type(value, time_tag: bool):
+    """Type ID dùng cho giá trị, None nếu không biểu diễn được (chuỗi, mảng, ...)."""
+    if isinstance(value, bool):
+        return M_SP_TB_1 if time_tag else M_SP_NA_1
+    if isinstance(value, (int, float)):
+        return M_ME_TF_1 if time_tag else M_ME_NC_1
+    return None
+
+
+def build_asdus(objects, cot: int, common_address: int, time_tag: bool, max_objects_per_asdu: int,
+                originator: int = 0):
+    """
+    Gom các điểm (ioa, value, quality, epoch_s) thành ASDU SQ=0, mỗi ASDU chứa nhiều IOA cùng type
+    (tối đa max_objects_per_asdu và không vượt độ dài APDU). Trả về (list (asdu, số object), số điểm bị bỏ).
+    """
+    by_type = {}
+    unsupported = 0
+    for ioa, value, quality, epoch_s in objects:
+        type_id = point_type(value, time_tag)
+        if type_id is None:
+            unsupported += 1
+            if log_rate_limiter.allow(("iec104_type", ioa)) is not None:
+                logger.warning("IEC-104: Bỏ qua IOA %s, kiểu giá trị %s không biểu diễn được.", ioa, type(value).__name__)
+            continue
+        by_type.setdefault(type_id, []).append(encode_object(type_id, ioa, value, quality, epoch_s))
+
+    asdus = []
+    for type_id, encoded in by_type.items():
+        per_asdu = max(1, min(max_objects_per_asdu, 127, (MAX_ASDU_LENGTH - ASDU_HEADER_LENGTH) // _OBJECT_SIZES[type_id]))
+        for offset in range(0, len(encoded), per_asdu):
+            chunk = encoded[offset:offset + per_asdu]
+            asdus.append((asdu_header(type_id, len(chunk), cot, common_address, originator) + b"".join(chunk), len(chunk)))
+    return asdus, unsupported
+
+
+class _MasterConnection:
+    """Một kết nối từ master (controlling station): cửa sổ k/w, bộ đếm N(S)/N(R) và các timer t1/t2/t3."""
+    def __init__(self, outstation, reader, writer):
+        self.outstation = outstation
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.started = False # STARTDT đã được kích hoạt: được gửi I-frame
+        self.send_seq = 0 # V(S)
+        self.recv_seq = 0 # V(R)
+        self.unacked = collections.deque() # (N(S), thời điểm gửi) của I-frame chưa được xác nhận
+        self.recv_unacked = 0 # Số I-frame đã nhận chưa xác nhận
+        self.recv_unacked_since = 0.0
+        self.last_rx = time.monotonic()
+        self.testfr_sent_at = None
+        self.outgoing = collections.deque() # (asdu, số object) chờ cửa sổ k
+        self.closed = False
+        self.task = None
+
+    def close(self, reason: str):
+        if self.closed:
+            return
+        self.closed = True
+        logger.info(f"IEC-104: Đóng kết nối {self.peer}: {reason}")
+        self.writer.close()
+
+    def enqueue(self, asdus):
+        for item in asdus:
+            if len(self.outgoing) >= self.outstation.max_pending:
+                _, dropped_objects = self.outgoing.popleft()
+                self.outstation.stats["dropped"] += dropped_objects
+            self.outgoing.append(item)
+        self.pump()
+
+    def pump(self):
+        """Gửi các ASDU đang chờ trong giới hạn cửa sổ k."""
+        if not self.started or self.closed:
+            return
+        now = time.monotonic()
+        k = self.outstation.k
+        stats = self.outstation.stats
+        while self.outgoing and len(self.unacked) < k:
+            asdu, object_count = self.outgoing.popleft()
+            self.writer.write(i_frame(asdu, self.send_seq, self.recv_seq))
+            self.unacked.append((self.send_seq, now))
+            self.send_seq = (self.send_seq + 1) % SEQ_MODULO
+            self.recv_unacked = 0 # I-frame gửi đi đã mang N(R)
+            stats["asdus_sent"] += 1
+            stats["objects_sent"] += object_count
+
+    def _acknowledge(self, recv_seq: int):
+        # Bỏ các I-frame có N(S) < N(R) của master
+        while self.unacked and 0 < (recv_seq - self.unacked[0][0]) % SEQ_MODULO <= len(self.unacked):
+            self.unacked.popleft()
+        self.pump()
+
+    async def run(self):
+        reader = self.reader
+        try:
+            while not self.closed:
+                header = await reader.readexactly(2)
+                if header[0] != START_BYTE or header[1] < 4:
+                    self.close(f"APDU không hợp lệ ({header.hex()})")
+                    return
+                body = await reader.readexactly(header[1])
+                self.last_rx = time.monotonic()
+                self.testfr_sent_at = None # Mọi frame nhận được đều chứng tỏ kết nối còn sống
+                self._handle_frame(body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close("master đóng kết nối")
+        except Exception as e:
+            logger.error(f"IEC-104: Lỗi xử lý kết nối {self.peer}: {e}", exc_info=True)
+            self.close("lỗi xử lý")
+
+    def _handle_frame(self, body: bytes):
+        control = body[0]
+        if control & 0x01 == 0: # I-frame
+            send_seq = (body[0] >> 1) | (body[1] << 7)
+            if send_seq != self.recv_seq:
+                self.close(f"N(S) không khớp (nhận {send_seq}, chờ {self.recv_seq})")
+                return
+            self.recv_seq = (self.recv_seq + 1) % SEQ_MODULO
+            if self.recv_unacked == 0:
+                self.recv_unacked_since = time.monotonic()
+            self.recv_unacked += 1
+            self._acknowledge((body[2] >> 1) | (body[3] << 7))
+            self.outstation.handle_asdu(self, body[4:])
+            if self.recv_unacked >= self.outstation.w:
+                self.writer.write(s_frame(self.recv_seq))
+                self.recv_unacked = 0
+        elif control & 0x03 == 0x01: # S-frame
+            self._acknowledge((body[2] >> 1) | (body[3] << 7))
+        elif control == STARTDT_ACT:
+            self.writer.write(u_frame(STARTDT_CON))
+            self.started = True
+            logger.info(f"IEC-104: STARTDT từ {self.peer}.")
+            self.pump()
+        elif control == STOPDT_ACT:
+            self.started = False
+            self.writer.write(u_frame(STOPDT_CON))
+            logger.info(f"IEC-104: STOPDT từ {self.peer}.")
+        elif control == TESTFR_ACT:
+            self.writer.write(u_frame(TESTFR_CON))
+
+    def check_timers(self, now: float):
+        outstation = self.outstation
+        if self.unacked and now - self.unacked[0][1] > outstation.t1_s:
+            self.close(f"t1: master không xác nhận I-frame sau {outstation.t1_s}s")
+            return
+        if self.testfr_sent_at is not None and now - self.testfr_sent_at > outstation.t1_s:
+            self.close(f"t1: không nhận được TESTFR con sau {outstation.t1_s}s")
+            return
+        if self.recv_unacked and now - self.recv_unacked_since > outstation.t2_s:
+            self.writer.write(s_frame(self.recv_seq))
+            self.recv_unacked = 0
+        if self.testfr_sent_at is None and now - self.last_rx > outstation.t3_s:
+            self.writer.write(u_frame(TESTFR_ACT))
+            self.testfr_sent_at = now
+
+
+class Iec104Outstation:
+    """
+    Outstation (slave) IEC 60870-5-104 trên TCP, chạy event loop riêng trên một thread nền.
+    MappingRoute gọi publish() (từ event loop của AsyncWorker, không chặn) với ioa_mapping của mapping;
+    giá trị được gom mỗi flush_interval_ms thành các ASDU nhiều IOA (SQ=0) và gửi tự phát (COT 3) tới mọi
+    master đã STARTDT. Bảng giá trị cuối theo IOA dùng để trả lời general interrogation (C_IC_NA_1, COT 20)
+    và lệnh đọc (C_RD_NA_1). Giá trị bool dùng single point, số dùng số thực ngắn; dữ liệu tự phát kèm
+    CP56Time2a (SourceTimestamp) khi time_tag bật.
+    """
+    def __init__(self):
+        self.host = "0.0.0.0"
+        self.port = 2404
+        self.common_address = 1
+        self.k = 12 # Số I-frame gửi tối đa chưa được xác nhận
+        self.w = 8 # Xác nhận (S-frame) sau chừng này I-frame nhận được
+        self.t1_s = 15.0
+        self.t2_s = 10.0
+        self.t3_s = 20.0
+        self.time_tag = True
+        self.max_objects_per_asdu = 127 # Còn bị giới hạn bởi độ dài APDU (253 byte)
+        self.flush_interval_ms = 10
+        self.max_pending = 100000 # Số giá trị chờ gom / số ASDU chờ cửa sổ k của một kết nối
+
+        self.running = False # Đọc trên đường dữ liệu (MappingRoute) trước khi gọi publish()
+        self._points = {} # ioa -> (value, quality, epoch_s): giá trị cuối cho general interrogation
+        self._pending = collections.deque() # (ioa, value, quality, epoch_s, cot) chờ gom thành ASDU
+        self._connections = set()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._stop_event = None
+        self._lock = threading.Lock()
+
+        # Bộ đếm đơn giản, chỉ được cộng dồn (không cần lock dưới GIL cho mục đích quan sát)
+        self.stats = {
+            "objects_sent": 0,
+            "asdus_sent": 0,
+            "dropped": 0, # Giá trị bị bỏ do hàng đợi đầy
+            "unsupported": 0, # Giá trị có kiểu không biểu diễn được bằng IEC-104
+            "interrogations": 0,
+        }
+
+    def init_app(self, app_instance):
+        """Đọc cấu hình IEC104_* từ app.config và khởi động outstation nếu IEC104_ENABLED."""
+        cfg = app_instance.config
+        if not cfg.get('IEC104_ENABLED', False):
+            return
+        self.host = cfg.get('IEC104_HOST', self.host)
+        self.port = int(cfg.get('IEC104_PORT', self.port))
+        self.common_address = int(cfg.get('IEC104_COMMON_ADDRESS', self.common_address))
+        self.k = max(1, int(cfg.get('IEC104_K', self.k)))
+        self.w = max(1, int(cfg.get('IEC104_W', self.w)))
+        self.t1_s = float(cfg.get('IEC104_T1_S', self.t1_s))
+        self.t2_s = float(cfg.get('IEC104_T2_S', self.t2_s))
+        self.t3_s = float(cfg.get('IEC104_T3_S', self.t3_s))
+        self.time_tag = bool(cfg.get('IEC104_TIME_TAG', self.time_tag))
+        self.max_objects_per_asdu = max(1, int(cfg.get('IEC104_MAX_OBJECTS_PER_ASDU', self.max_objects_per_asdu)))
+        self.flush_interval_ms = max(1, int(cfg.get('IEC104_FLUSH_INTERVAL_MS', self.flush_interval_ms)))
+        self.max_pending = max(1, int(cfg.get('IEC104_MAX_PENDING', self.max_pending)))
+        self.start()
+
+    def start(self, timeout_s: float = 10.0):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                logger.info("IEC-104 outstation đã chạy.")
+                return
+            self._ready.clear()
+            self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="iec104-outstation", daemon=True)
+            self._thread.start()
+        if not self._ready.wait(timeout_s) or self._server is None:
+            logger.error(f"IEC-104 outstation không khởi động được trên {self.host}:{self.port}.")
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            if self._thread is None:
+                return
+            self.running = False
+            if self._loop is not None and self._stop_event is not None:
+                self._loop.call_soon_threadsafe(self._stop_event.set)
+            self._thread.join(timeout)
+            self._thread = None
+            logger.info("IEC-104 outstation đã dừng.")
+
+    def connection_count(self, started_only: bool = False) -> int:
+        return sum(1 for c in list(self._connections) if c.started or not started_only)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def publish(self, ioa: int, value, good: bool = True, source_ts: float = None, cot: int = COT_SPONTANEOUS):
+        """
+        Ghi giá trị mới của một IOA (gọi từ bất kỳ thread nào, không chặn). good=False gửi kèm cờ IV
+        (giá trị cuối hợp lệ nếu value là None). source_ts: epoch giây, dùng cho CP56Time2a.
+        """
+        if not good:
+            if value is None:
+                previous = self._points.get(ioa)
+                value = previous[0] if previous else 0.0
+            quality = QUALITY_INVALID
+        else:
+            quality = 0
+        self._points[ioa] = (value, quality, source_ts)
+        if len(self._pending) >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+        self._pending.append((ioa, value, quality, source_ts, cot))
+
+    def forget(self, ioa: int):
+        """Gỡ IOA khỏi bảng giá trị cuối (mapping bị xóa/hủy)."""
+        self._points.pop(ioa, None)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        try:
+            self._server = await asyncio.start_server(self._on_connect, self.host, self.port)
+        except OSError as e:
+            logger.error(f"IEC-104: Không mở được cổng {self.host}:{self.port}: {e}")
+            self._server = None
+            self._ready.set()
+            return
+        self.running = True
+        logger.info(f"IEC-104 outstation đang nghe tại {self.host}:{self.port} (CA={self.common_address}, "
+                    f"k={self.k}, w={self.w}, TimeTag={'bật' if self.time_tag else 'tắt'}).")
+        self._ready.set()
+        flusher = asyncio.create_task(self._flush_loop())
+        timers = asyncio.create_task(self._timer_loop())
+        try:
+            await self._stop_event.wait()
+        finally:
+            self.running = False
+            flusher.cancel()
+            timers.cancel()
+            self._server.close()
+            tasks = [connection.task for connection in list(self._connections)]
+            for connection in list(self._connections):
+                connection.close("outstation dừng")
+            if tasks: # Chờ các kết nối đọc xong EOF thay vì bị hủy giữa chừng khi event loop đóng
+                await asyncio.wait(tasks, timeout=1.0)
+            await self._server.wait_closed()
+
+    async def _on_connect(self, reader, writer):
+        connection = _MasterConnection(self, reader, writer)
+        connection.task = asyncio.current_task()
+        self._connections.add(connection)
+        logger.info(f"IEC-104: Master kết nối từ {connection.peer}.")
+        try:
+            await connection.run()
+        finally:
+            self._connections.discard(connection)
+
+    async def _flush_loop(self):
+        interval = self.flush_interval_ms / 1000.0
+        pending = self._pending
+        while True:
+            await asyncio.sleep(interval)
+            if not pending:
+                continue
+            by_cot = {}
+            for _ in range(len(pending)):
+                ioa, value, quality, epoch_s, cot = pending.popleft()
+                by_cot.setdefault(cot, []).append((ioa, value, quality, epoch_s))
+            targets = [c for c in self._connections if c.started and not c.closed]
+            for cot, objects in by_cot.items():
+                asdus, unsupported = build_asdus(objects, cot, self.common_address, self.time_tag and cot == COT_SPONTANEOUS,
+                                                 self.max_objects_per_asdu)
+                self.stats["unsupported"] += unsupported
+                for connection in targets:
+                    connection.enqueue(asdus)
+
+    async def _timer_loop(self):
+        while True:
+            await asyncio.sleep(0.5)
+            now = time.monotonic()
+            for connection in list(self._connections):
+                connection.check_timers(now)
+
+    def handle_asdu(self, connection: _MasterConnection, asdu: bytes):
+        """Xử lý lệnh từ master (chạy trên event loop của outstation)."""
+        if len(asdu) < ASDU_HEADER_LENGTH + 3:
+            logger.warning(f"IEC-104: ASDU quá ngắn từ {connection.peer}: {asdu.hex()}")
+            return
+        type_id, cot, originator = asdu[0], asdu[2] & 0x3F, asdu[3]
+        common_address = asdu[4] | (asdu[5] << 8)
+
+        def mirror(new_cot):
+            # CA theo common_address hiện tại: sau khi kiểm tra là CA của outstation (kể cả lệnh gửi broadcast)
+            return (asdu[:2] + bytes((new_cot, originator, common_address & 0xFF, common_address >> 8))
+                    + asdu[ASDU_HEADER_LENGTH:], 0)
+
+        if type_id not in (C_IC_NA_1, C_RD_NA_1, C_CS_NA_1):
+            connection.enqueue([mirror(COT_UNKNOWN_TYPE | COT_NEGATIVE)])
+            return
+        if common_address not in (self.common_address, BROADCAST_COMMON_ADDRESS):
+            connection.enqueue([mirror(COT_UNKNOWN_COMMON_ADDRESS | COT_NEGATIVE)])
+            return
+        common_address = self.common_address # Master đối chiếu xác nhận/kết thúc với CA của station
+
+        if type_id == C_IC_NA_1:
+            if cot != COT_ACTIVATION:
+                connection.enqueue([mirror(COT_UNKNOWN_CAUSE | COT_NEGATIVE)])
+                return
+            if len(asdu) < ASDU_HEADER_LENGTH + 4: # Thiếu QOI: từ chối lệnh, không đóng kết nối
+                logger.warning(f"IEC-104: Lệnh interrogation thiếu QOI từ {connection.peer}: {asdu.hex()}")
+                connection.enqueue([mirror(COT_ACTIVATION_CON | COT_NEGATIVE)])
+                return
+            if asdu[ASDU_HEADER_LENGTH + 3] != QOI_STATION: # Chưa hỗ trợ interrogation theo nhóm
+                connection.enqueue([mirror(COT_ACTIVATION_CON | COT_NEGATIVE)])
+                return
+            self.stats["interrogations"] += 1
+            points = [(ioa, value, quality, epoch_s) for ioa, (value, quality, epoch_s) in list(self._points.items())]
+            asdus, _ = build_asdus(points, COT_INTERROGATED_STATION, self.common_address, False,
+                                   self.max_objects_per_asdu, originator)
+            logger.info(f"IEC-104: General interrogation từ {connection.peer}: {len(points)} IOA, {len(asdus)} ASDU.")
+            connection.enqueue([mirror(COT_ACTIVATION_CON)] + asdus + [mirror(COT_ACTIVATION_TERM)])
+        elif type_id == C_RD_NA_1:
+            ioa = asdu[6] | (asdu[7] << 8) | (asdu[8] << 16)
+            point = self._points.get(ioa)
+            if point is None:
+                connection.enqueue([mirror(COT_UNKNOWN_IOA | COT_NEGATIVE)])
+                return
+            asdus, _ = build_asdus([(ioa,) + point], COT_REQUEST, self.common_address, False, 1, originator)
+            connection.enqueue(asdus)
+        else: # C_CS_NA_1: xác nhận nhưng không chỉnh đồng hồ hệ thống
+            if cot != COT_ACTIVATION:
+                connection.enqueue([mirror(COT_UNKNOWN_CAUSE | COT_NEGATIVE)])
+                return
+            confirmation, _ = mirror(COT_ACTIVATION_CON)
+            connection.enqueue([(confirmation[:ASDU_HEADER_LENGTH + 3] + encode_cp56time2a(time.time()), 0)])
+
+
+# Instance global, khởi động trong create_app khi IEC104_ENABLED
+iec104_outstation = Iec104Outstation()
@@ -1,7 +1,7 @@
 # app/forms.py
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SelectField, PasswordField, SubmitField, IntegerField, BooleanField
-from wtforms.validators import DataRequired, Length, URL, Optional, NumberRange
+from wtforms import StringField, TextAreaField, SelectField, PasswordField, SubmitField, IntegerField, BooleanField, FloatField
+from wtforms.validators import DataRequired, Length, URL, Optional, NumberRange, ValidationError
 from wtforms_sqlalchemy.fields import QuerySelectField # Import từ thư viện mới
 from app.models import OpcServer, OpcNode # Import model
 
@@ -46,6 +46,24 @@ class SubscriptionMappingForm(FlaskForm):
                                           default=1000,
                                           validators=[DataRequired(), NumberRange(min=100, message="Publishing Interval phải ít nhất 100ms.")])
     
+    deadband_type = SelectField('Deadband',
+                                choices=[('None', 'Không dùng'), ('Absolute', 'Tuyệt đối'), ('Percent', 'Phần trăm (% EURange)')],
+                                default='None',
+                                description="Chỉ gửi khi giá trị thay đổi vượt ngưỡng. Server áp dụng nếu hỗ trợ, ngược lại client tự lọc.")
+
+    deadband_value = FloatField('Ngưỡng Deadband',
+                                default=0.0,
+                                validators=[Optional(), NumberRange(min=0, message="Ngưỡng deadband không được âm.")])
+
+    heartbeat_interval_s = IntegerField('Heartbeat (giây)',
+                                        default=0,
+                                        validators=[Optional(), NumberRange(min=0, message="Heartbeat không được âm.")],
+                                        description="Gửi lại giá trị cuối nếu không có thay đổi trong khoảng này. 0 = tắt.")
+
     is_active = BooleanField('Kích hoạt Subscription này?', default=True)
     
-    submit = SubmitField('Lưu Mapping')
\ No newline at end of file
+    submit = SubmitField('Lưu Mapping')
+
+    def validate_deadband_value(self, field):
+        if self.deadband_type.data == 'Percent' and field.data is not None and field.data > 100:
+            raise ValidationError("Deadband phần trăm phải trong khoảng 0-100.")
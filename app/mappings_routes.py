@@ -2,18 +2,11 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app 
 from app import db
 from app.models import OpcServer, OpcNode, SubscriptionMapping
-from app.opcua_client import (
-    actual_subscribe_opcua_node as async_subscribe_from_mapping, # <-- SỬA Ở ĐÂY
-    unsubscribe_from_mapping as async_unsubscribe_from_mapping, # Đảm bảo hàm này cũng có trong opcua_client.py
-    is_server_connected,
-    active_opcua_subscriptions, # Để kiểm tra trạng thái runtime
-    subscribe_all_active_mappings_runtime, # HÀM MỚI
-    unsubscribe_all_runtime_subscriptions_opcua # HÀM MỚI
-)
-from async_worker import get_async_worker
+from app.collector import collector, CollectorError # Subscribe/unsubscribe chạy trong tiến trình giữ runtime OPC UA
 from sqlalchemy.exc import IntegrityError
 from asyncua import ua # Để lấy NodeClass.Variable.name
 from app.mappings_form import SubscriptionMappingForm, opc_node_query
+from app.datatype_cache import datatype_cache
 
 
 mappings_bp = Blueprint('mappings', __name__, url_prefix='/mappings')
@@ -32,16 +25,18 @@ def list_mappings():
 
         mapping_runtime_states = {}
         server_states_for_template = {} # <-- KHỞI TẠO BIẾN NÀY
+        subscribed_mapping_ids = set(collector.subscribed_mapping_ids()) # Một lần gọi collector cho cả trang
+        live_server_ids = set(collector.connected_server_ids())
 
         for m in all_mappings:
             # Lấy trạng thái runtime của subscription
-            mapping_runtime_states[m.id] = m.id in active_opcua_subscriptions
+            mapping_runtime_states[m.id] = m.id in subscribed_mapping_ids
             
             # Lấy và lưu trạng thái kết nối của server cho mapping này (nếu chưa có)
             # Điều này cần thiết để template biết server có đang kết nối hay không
             # khi quyết định có disable nút "Sub" runtime hay không.
             if m.server_id is not None and m.server_id not in server_states_for_template:
-                server_states_for_template[m.server_id] = {"is_live": is_server_connected(m.server_id)}
+                server_states_for_template[m.server_id] = {"is_live": m.server_id in live_server_ids}
 
         logger.info(f"Runtime subscription states: {mapping_runtime_states}")
         logger.info(f"Server connection states for template: {server_states_for_template}")
@@ -122,6 +117,9 @@ def add_mapping():
             ioa_mapping=form.ioa_mapping.data,
             sampling_interval_ms=form.sampling_interval_ms.data,
             publishing_interval_ms=form.publishing_interval_ms.data,
+            deadband_type=form.deadband_type.data,
+            deadband_value=form.deadband_value.data or 0.0,
+            heartbeat_interval_s=form.heartbeat_interval_s.data or 0,
             is_active=form.is_active.data
         )
         try:
@@ -130,19 +128,19 @@ def add_mapping():
             logger.info(f"Đã thêm mapping mới ID: {new_mapping.id} cho IOA {new_mapping.ioa_mapping}")
             flash("Mapping mới đã được thêm thành công.", "success")
 
-            if new_mapping.is_active and is_server_connected(new_mapping.server_id):
+            if new_mapping.is_active and collector.is_server_connected(server_id=new_mapping.server_id):
                 logger.info(f"Mapping ID {new_mapping.id} is_active, thử subscribe...")
-                worker = get_async_worker()
                 try:
-                    success_sub = worker.run_coroutine(
-                        async_subscribe_from_mapping( # Đây là actual_subscribe_opcua_node
-                            server_id=new_mapping.server_id,
-                            node_id_str=selected_opc_node.node_id_string,
-                            ioa_value=new_mapping.ioa_mapping,
-                            sampling_ms=new_mapping.sampling_interval_ms,
-                            publishing_ms=new_mapping.publishing_interval_ms,
-                            mapping_db_id=new_mapping.id
-                        )
+                    success_sub = collector.subscribe_mapping(
+                        server_id=new_mapping.server_id,
+                        node_id_str=selected_opc_node.node_id_string,
+                        ioa_value=new_mapping.ioa_mapping,
+                        sampling_ms=new_mapping.sampling_interval_ms,
+                        publishing_ms=new_mapping.publishing_interval_ms,
+                        mapping_db_id=new_mapping.id,
+                        deadband_type=new_mapping.deadband_type,
+                        deadband_value=new_mapping.deadband_value,
+                        heartbeat_interval_s=new_mapping.heartbeat_interval_s
                     )
                     if success_sub:
                          flash(f"Đã kích hoạt subscription cho mapping IOA {new_mapping.ioa_mapping}.", "info")
@@ -184,7 +182,10 @@ def get_nodes_for_server_ajax(server_id):
     # Chỉ lấy các node là Variable và đã được duyệt/lưu vào DB
     nodes = OpcNode.query.filter_by(server_id=server_id, node_class_str=ua.NodeClass.Variable.name)\
                          .order_by(OpcNode.display_name).all()
-    nodes_data = [{"id": node.id, "text": f"{node.display_name or node.browse_name} ({node.node_id_string})"} for node in nodes]
+    nodes_data = [{"id": node.id,
+                   "text": f"{node.display_name or node.browse_name} ({node.node_id_string})"
+                           + (f" [{datatype_cache.display(server_id, node.data_type)}]" if node.data_type else "")}
+                  for node in nodes]
     return jsonify(nodes_data)
 
 
@@ -278,6 +279,7 @@ def edit_mapping(mapping_id):
         old_sampling_ms = mapping_to_edit.sampling_interval_ms
         old_publishing_ms = mapping_to_edit.publishing_interval_ms
         old_ioa_mapping = mapping_to_edit.ioa_mapping # IOA thay đổi cũng nên re-subscribe
+        old_filter_settings = (mapping_to_edit.deadband_type, mapping_to_edit.deadband_value, mapping_to_edit.heartbeat_interval_s)
 
         # Cập nhật thông tin cho mapping_to_edit
         mapping_to_edit.description = form.description.data
@@ -286,6 +288,9 @@ def edit_mapping(mapping_id):
         mapping_to_edit.ioa_mapping = form.ioa_mapping.data
         mapping_to_edit.sampling_interval_ms = form.sampling_interval_ms.data
         mapping_to_edit.publishing_interval_ms = form.publishing_interval_ms.data
+        mapping_to_edit.deadband_type = form.deadband_type.data
+        mapping_to_edit.deadband_value = form.deadband_value.data or 0.0
+        mapping_to_edit.heartbeat_interval_s = form.heartbeat_interval_s.data or 0
         mapping_to_edit.is_active = form.is_active.data
         
         try:
@@ -293,7 +298,6 @@ def edit_mapping(mapping_id):
             logger.info(f"Đã cập nhật mapping ID: {mapping_id}")
             flash("Mapping đã được cập nhật thành công.", "success")
 
-            worker = get_async_worker()
             
             # Kiểm tra xem có cần re-subscribe không
             params_changed = (
@@ -301,33 +305,36 @@ def edit_mapping(mapping_id):
                 old_opc_node_db_id != mapping_to_edit.opc_node_db_id or
                 old_sampling_ms != mapping_to_edit.sampling_interval_ms or
                 old_publishing_ms != mapping_to_edit.publishing_interval_ms or
-                old_ioa_mapping != mapping_to_edit.ioa_mapping # Nếu IOA thay đổi, handler cần thông tin mới
+                old_ioa_mapping != mapping_to_edit.ioa_mapping or # Nếu IOA thay đổi, handler cần thông tin mới
+                old_filter_settings != (mapping_to_edit.deadband_type, mapping_to_edit.deadband_value,
+                                        mapping_to_edit.heartbeat_interval_s) # Filter nằm trong monitored item
             )
 
             needs_unsubscribe = False
-            if mapping_id in active_opcua_subscriptions:
+            if collector.is_mapping_subscribed(mapping_id=mapping_id):
                 if not mapping_to_edit.is_active or params_changed:
                     needs_unsubscribe = True
             
             if needs_unsubscribe:
                 logger.info(f"Mapping ID {mapping_id}: Cần unsubscribe do is_active=False hoặc tham số thay đổi.")
-                worker.run_coroutine(async_unsubscribe_from_mapping(mapping_id))
+                collector.unsubscribe_mapping(mapping_id=mapping_id, server_id=old_server_id)
                 flash(f"Subscription cũ cho mapping (IOA: {old_ioa_mapping}) đã được hủy (nếu có).", "info")
             
-            if mapping_to_edit.is_active and is_server_connected(mapping_to_edit.server_id):
-                if needs_unsubscribe or (mapping_id not in active_opcua_subscriptions): # Re-subscribe nếu vừa unsub hoặc chưa có sub
+            if mapping_to_edit.is_active and collector.is_server_connected(server_id=mapping_to_edit.server_id):
+                if needs_unsubscribe or (not collector.is_mapping_subscribed(mapping_id=mapping_id)): # Re-subscribe nếu vừa unsub hoặc chưa có sub
                     logger.info(f"Mapping ID {mapping_id} is_active=True, thử subscribe/re-subscribe...")
                     current_opc_node_obj = OpcNode.query.get(mapping_to_edit.opc_node_db_id) # Lấy node object mới nhất
                     if current_opc_node_obj:
-                        success_sub = worker.run_coroutine(
-                            async_subscribe_from_mapping( 
-                                server_id=mapping_to_edit.server_id,
-                                node_id_str=current_opc_node_obj.node_id_string,
-                                ioa_value=mapping_to_edit.ioa_mapping,
-                                sampling_ms=mapping_to_edit.sampling_interval_ms,
-                                publishing_ms=mapping_to_edit.publishing_interval_ms,
-                                mapping_db_id=mapping_to_edit.id
-                            )
+                        success_sub = collector.subscribe_mapping(
+                            server_id=mapping_to_edit.server_id,
+                            node_id_str=current_opc_node_obj.node_id_string,
+                            ioa_value=mapping_to_edit.ioa_mapping,
+                            sampling_ms=mapping_to_edit.sampling_interval_ms,
+                            publishing_ms=mapping_to_edit.publishing_interval_ms,
+                            mapping_db_id=mapping_to_edit.id,
+                            deadband_type=mapping_to_edit.deadband_type,
+                            deadband_value=mapping_to_edit.deadband_value,
+                            heartbeat_interval_s=mapping_to_edit.heartbeat_interval_s
                         )
                         if success_sub:
                             flash(f"Đã (thử) kích hoạt/cập nhật subscription cho mapping IOA {mapping_to_edit.ioa_mapping}.", "info")
@@ -380,12 +387,10 @@ def delete_mapping(mapping_id):
     logger.info(f"Yêu cầu xóa {mapping_desc}")
     try:
         # 1. Hủy subscription OPC UA đang hoạt động (nếu có)
-        if mapping_id in active_opcua_subscriptions:
+        if collector.is_mapping_subscribed(mapping_id=mapping_id):
             logger.info(f"{mapping_desc} đang có active subscription. Thực hiện unsubscribe.")
-            worker = get_async_worker()
             try:
-                # Giả sử async_unsubscribe_from_mapping là tên hàm đúng
-                worker.run_coroutine(async_unsubscribe_from_mapping(mapping_id))
+                collector.unsubscribe_mapping(mapping_id=mapping_id, server_id=mapping_to_delete.server_id)
                 logger.info(f"Đã unsubscribe thành công cho {mapping_desc} trước khi xóa.")
             except Exception as e_unsub:
                 logger.error(f"Lỗi khi unsubscribe {mapping_desc} trước khi xóa: {e_unsub}", exc_info=True)
@@ -419,30 +424,33 @@ def runtime_subscribe_single_mapping(mapping_id):
         flash(f"Không tìm thấy thông tin OPC Node cho mapping ID {mapping.id}.", "danger")
         return redirect(url_for('mappings.list_mappings'))
 
-    if not is_server_connected(mapping.server_id):
-        flash(f"Server '{mapping.opc_server.name}' chưa kết nối. Không thể subscribe mapping IOA {mapping.ioa_mapping}.", "warning")
-        return redirect(url_for('mappings.list_mappings'))
+    try:
+        if not collector.is_server_connected(server_id=mapping.server_id):
+            flash(f"Server '{mapping.opc_server.name}' chưa kết nối. Không thể subscribe mapping IOA {mapping.ioa_mapping}.", "warning")
+            return redirect(url_for('mappings.list_mappings'))
 
-    if mapping.id in active_opcua_subscriptions:
-        flash(f"Mapping IOA {mapping.ioa_mapping} đã được subscribe runtime từ trước.", "info")
-        return redirect(url_for('mappings.list_mappings'))
+        if collector.is_mapping_subscribed(mapping_id=mapping.id):
+            flash(f"Mapping IOA {mapping.ioa_mapping} đã được subscribe runtime từ trước.", "info")
+            return redirect(url_for('mappings.list_mappings'))
 
-    try:
-        worker = get_async_worker()
-        success_sub = worker.run_coroutine(
-            async_subscribe_from_mapping( # Đây là actual_subscribe_opcua_node
-                server_id=mapping.server_id,
-                node_id_str=opc_node_obj.node_id_string,
-                ioa_value=mapping.ioa_mapping,
-                sampling_ms=mapping.sampling_interval_ms,
-                publishing_ms=mapping.publishing_interval_ms,
-                mapping_db_id=mapping.id
-            )
+        success_sub = collector.subscribe_mapping(
+            server_id=mapping.server_id,
+            node_id_str=opc_node_obj.node_id_string,
+            ioa_value=mapping.ioa_mapping,
+            sampling_ms=mapping.sampling_interval_ms,
+            publishing_ms=mapping.publishing_interval_ms,
+            mapping_db_id=mapping.id,
+            deadband_type=mapping.deadband_type,
+            deadband_value=mapping.deadband_value,
+            heartbeat_interval_s=mapping.heartbeat_interval_s
         )
         if success_sub:
             flash(f"Đã thực hiện subscribe runtime thành công cho Mapping IOA {mapping.ioa_mapping}.", "success")
         else:
             flash(f"Không thể thực hiện subscribe runtime cho Mapping IOA {mapping.ioa_mapping}. Kiểm tra log.", "danger")
+    except (CollectorError, TimeoutError) as e: # Collector (tiến trình riêng) không chạy hoặc không trả lời kịp
+        logger.error(f"Không gọi được collector khi subscribe Mapping ID {mapping.id}: {e}")
+        flash(f"Không liên lạc được collector: {str(e)}", "danger")
     except Exception as e:
         logger.error(f"Lỗi khi thực hiện runtime subscribe cho Mapping ID {mapping.id}: {e}", exc_info=True)
         flash(f"Lỗi khi thực hiện runtime subscribe: {str(e)}", "danger")
@@ -456,17 +464,19 @@ def runtime_unsubscribe_single_mapping(mapping_id):
     
     logger.info(f"Yêu cầu Runtime Unsubscribe cho Mapping ID: {mapping.id} (IOA: {mapping.ioa_mapping})")
 
-    if mapping.id not in active_opcua_subscriptions:
-        flash(f"Mapping IOA {mapping.ioa_mapping} không có subscription runtime đang hoạt động để hủy.", "info")
-        return redirect(url_for('mappings.list_mappings'))
-
     try:
-        worker = get_async_worker()
-        success_unsub = worker.run_coroutine(async_unsubscribe_from_mapping(mapping.id))
+        if not collector.is_mapping_subscribed(mapping_id=mapping.id):
+            flash(f"Mapping IOA {mapping.ioa_mapping} không có subscription runtime đang hoạt động để hủy.", "info")
+            return redirect(url_for('mappings.list_mappings'))
+
+        success_unsub = collector.unsubscribe_mapping(mapping_id=mapping.id, server_id=mapping.server_id)
         if success_unsub:
             flash(f"Đã thực hiện unsubscribe runtime thành công cho Mapping IOA {mapping.ioa_mapping}.", "success")
         else:
             flash(f"Có lỗi khi thực hiện unsubscribe runtime cho Mapping IOA {mapping.ioa_mapping}.", "warning")
+    except (CollectorError, TimeoutError) as e:
+        logger.error(f"Không gọi được collector khi unsubscribe Mapping ID {mapping.id}: {e}")
+        flash(f"Không liên lạc được collector: {str(e)}", "danger")
     except Exception as e:
         logger.error(f"Lỗi khi thực hiện runtime unsubscribe cho Mapping ID {mapping.id}: {e}", exc_info=True)
         flash(f"Lỗi khi thực hiện runtime unsubscribe: {str(e)}", "danger")
@@ -478,11 +488,14 @@ def runtime_unsubscribe_single_mapping(mapping_id):
 def subscribe_all_action():
     logger = get_logger()
     logger.info("Yêu cầu 'Subscribe All Active Mappings'.")
-    # Hàm subscribe_all_active_mappings_runtime cần app_context để query DB
-    # current_app là proxy đến app hiện tại, có thể dùng để lấy context
-    # hoặc truyền current_app._get_current_object()
-    results = subscribe_all_active_mappings_runtime(current_app._get_current_object())
-    
+    # subscribe_all_active_mappings_runtime chạy trong tiến trình giữ runtime, với app context của tiến trình đó
+    try:
+        results = collector.subscribe_all()
+    except (CollectorError, TimeoutError) as e:
+        logger.error(f"Không gọi được collector khi Subscribe All: {e}")
+        flash(f"Không liên lạc được collector: {str(e)}", "danger")
+        return redirect(url_for('mappings.list_mappings'))
+
     if results.get("error"):
         flash(f"Lỗi khi thực hiện Subscribe All: {results['error']}", "danger")
     else:
@@ -494,7 +507,12 @@ def subscribe_all_action():
 def unsubscribe_all_action():
     logger = get_logger()
     logger.info("Yêu cầu 'Unsubscribe All Runtime Subscriptions'.")
-    results = unsubscribe_all_runtime_subscriptions_opcua()
+    try:
+        results = collector.unsubscribe_all()
+    except (CollectorError, TimeoutError) as e:
+        logger.error(f"Không gọi được collector khi Unsubscribe All: {e}")
+        flash(f"Không liên lạc được collector: {str(e)}", "danger")
+        return redirect(url_for('mappings.list_mappings'))
 
     if results.get("error"):
         flash(f"Lỗi khi thực hiện Unsubscribe All: {results['error']}", "danger")
@@ -0,0 +1,196 @@
+# app/metrics.py
+import bisect
+import threading
+
+
+class Counter:
+    """
+    Bộ đếm theo nhãn. inc() được gọi từ nhiều thread (các shard AsyncWorker, job duyệt) và phép cộng
+    đọc-rồi-ghi trên dict không nguyên tử dưới GIL, nên được thực hiện dưới lock để không mất giá trị.
+    """
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {} # tuple giá trị nhãn -> số đếm
+        self._lock = threading.Lock()
+
+    def inc(self, labelvalues=(), amount=1):
+        with self._lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [(self.name, dict(zip(self.labelnames, labelvalues)), value) for labelvalues, value in items]
+
+
+class Histogram:
+    """Histogram có bucket cố định (giây). observe_many() ghi cả lô dưới một lần lấy lock."""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1) # Bucket cuối là +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe_many(self, values):
+        with self._lock:
+            for value in values:
+                self._counts[bisect.bisect_left(self.buckets, value)] += 1
+                self._sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+        samples = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append((f"{self.name}_bucket", {"le": _format_value(upper_bound)}, cumulative))
+        samples.append((f"{self.name}_sum", {}, total_sum))
+        samples.append((f"{self.name}_count", {}, cumulative))
+        return samples
+
+
+# --- Các metric được cập nhật trực tiếp trên đường dữ liệu ---
+notifications = Counter("opcua_notifications_total", "Số DataChange nhận được theo server và mapping.",
+                        ("server_id", "mapping_id"))
+end_to_end_latency = Histogram("opcua_end_to_end_latency_seconds",
+                               "Độ trễ từ SourceTimestamp của giá trị tới khi API datapoint xác nhận lô chứa giá trị.")
+delivery_queue_latency = Histogram("opcua_delivery_queue_latency_seconds",
+                                   "Thời gian từ lúc giá trị vào hàng đợi delivery tới khi API xác nhận.")
+deadband_suppressed = Counter("opcua_deadband_suppressed_total",
+                              "Số thay đổi không gửi đi do nằm trong deadband (lọc phía client) theo server.", ("server_id",))
+heartbeats = Counter("opcua_heartbeats_total", "Số lần gửi lại giá trị không đổi (heartbeat) theo server.", ("server_id",))
+browse_nodes = Counter("opcua_browse_nodes_total", "Số node đã duyệt theo server (cộng khi job duyệt kết thúc).",
+                       ("server_id",))
+
+
+def render_metrics() -> str:
+    """
+    Xuất toàn bộ metric theo định dạng text của Prometheus. Các giá trị trạng thái (hàng đợi, loop lag,
+    session, subscription, tốc độ duyệt) được đọc tại thời điểm scrape, không tốn gì trên đường dữ liệu.
+    """
+    from async_worker import get_async_worker
+    from app.browse_jobs import browse_jobs
+    from app.change_log import change_log
+    from app.delivery import delivery_pipeline
+    from app.iec104 import iec104_outstation
+    from app.opcua_client import active_clients, active_opcua_subscriptions # Import ở đây để tránh circular
+    from app.subscription_manager import subscription_manager
+
+    families = []
+
+    def family(name, metric_type, documentation, samples):
+        families.append((name, metric_type, documentation, samples))
+
+    # Thông báo: theo mapping, kèm tổng theo server
+    notification_samples = notifications.samples()
+    per_server = {}
+    for _, labels, value in notification_samples:
+        per_server[labels["server_id"]] = per_server.get(labels["server_id"], 0) + value
+    family(notifications.name, "counter", notifications.documentation, notification_samples)
+    family("opcua_server_notifications_total", "counter", "Số DataChange nhận được theo server.",
+           [("opcua_server_notifications_total", {"server_id": server_id}, value) for server_id, value in per_server.items()])
+
+    # Delivery
+    stats = delivery_pipeline.stats_snapshot()
+    family("opcua_delivery_items_total", "counter", "Số giá trị theo kết quả gửi tới API datapoint.",
+           [("opcua_delivery_items_total", {"result": result}, stats.get(key, 0))
+            for result, key in (("succeeded", "delivered"), ("failed", "failed"), ("rejected", "rejected"),
+                                ("dropped", "dropped"))])
+    family("opcua_delivery_batches_total", "counter", "Số request (lô) gửi tới API datapoint theo kết quả.",
+           [("opcua_delivery_batches_total", {"result": "succeeded"}, stats.get("batches_sent", 0)),
+            ("opcua_delivery_batches_total", {"result": "failed"}, stats.get("batches_failed", 0))])
+    family("opcua_delivery_queue_depth", "gauge", "Số giá trị đang chờ trong hàng đợi delivery.",
+           [("opcua_delivery_queue_depth", {}, delivery_pipeline.queue_depth())])
+    family("opcua_delivery_outbox_backlog", "gauge", "Số giá trị trong outbox trên đĩa chưa được API xác nhận.",
+           [("opcua_delivery_outbox_backlog", {}, delivery_pipeline.outbox_backlog())])
+    family("opcua_delivery_replays_total", "counter", "Số lần gửi lại outbox sau khi API lỗi.",
+           [("opcua_delivery_replays_total", {}, stats.get("replays", 0))])
+    family(end_to_end_latency.name, "histogram", end_to_end_latency.documentation, end_to_end_latency.samples())
+    family(delivery_queue_latency.name, "histogram", delivery_queue_latency.documentation, delivery_queue_latency.samples())
+
+    # IEC-104
+    iec104_stats = dict(iec104_outstation.stats)
+    family("opcua_iec104_connections", "gauge", "Số kết nối master IEC-104 (started: đã STARTDT).",
+           [("opcua_iec104_connections", {"state": "open"}, iec104_outstation.connection_count()),
+            ("opcua_iec104_connections", {"state": "started"}, iec104_outstation.connection_count(started_only=True))])
+    family("opcua_iec104_objects_total", "counter", "Số information object IEC-104 theo kết quả.",
+           [("opcua_iec104_objects_total", {"result": result}, iec104_stats.get(key, 0))
+            for result, key in (("sent", "objects_sent"), ("dropped", "dropped"), ("unsupported", "unsupported"))])
+    family("opcua_iec104_asdus_sent_total", "counter", "Số ASDU (I-frame) IEC-104 đã gửi.",
+           [("opcua_iec104_asdus_sent_total", {}, iec104_stats.get("asdus_sent", 0))])
+    family("opcua_iec104_interrogations_total", "counter", "Số lệnh general interrogation đã trả lời.",
+           [("opcua_iec104_interrogations_total", {}, iec104_stats.get("interrogations", 0))])
+    family("opcua_iec104_pending", "gauge", "Số giá trị chờ gom thành ASDU IEC-104.",
+           [("opcua_iec104_pending", {}, iec104_outstation.pending_count())])
+
+    # Change log (GET /api/values)
+    family("opcua_change_log_last_seq", "counter", "Seq của thay đổi gần nhất trong change log.",
+           [("opcua_change_log_last_seq", {}, change_log.last_seq)])
+    family("opcua_change_log_entries", "gauge", "Số thay đổi đang giữ trong ring buffer của change log.",
+           [("opcua_change_log_entries", {}, len(change_log))])
+
+    family(deadband_suppressed.name, "counter", deadband_suppressed.documentation, deadband_suppressed.samples())
+    family(heartbeats.name, "counter", heartbeats.documentation, heartbeats.samples())
+
+    # AsyncWorker
+    shard_stats = get_async_worker().shard_stats()
+    family("opcua_async_worker_loop_lag_seconds", "gauge", "Độ trễ event loop của từng shard AsyncWorker (mẫu gần nhất).",
+           [("opcua_async_worker_loop_lag_seconds", {"shard": str(s["shard"])}, s["lag_ms"] / 1000.0) for s in shard_stats])
+    family("opcua_async_worker_loop_lag_max_seconds", "gauge", "Độ trễ event loop lớn nhất trong cửa sổ đo gần nhất.",
+           [("opcua_async_worker_loop_lag_max_seconds", {"shard": str(s["shard"])}, s["max_lag_ms"] / 1000.0) for s in shard_stats])
+    family("opcua_async_worker_tasks", "gauge", "Số asyncio task trên event loop của từng shard.",
+           [("opcua_async_worker_tasks", {"shard": str(s["shard"])}, s["tasks"]) for s in shard_stats])
+
+    # Duyệt node
+    family(browse_nodes.name, "counter", browse_nodes.documentation, browse_nodes.samples())
+    family("opcua_browse_nodes_per_second", "gauge", "Tốc độ duyệt của các job đang chạy.",
+           [("opcua_browse_nodes_per_second", {"server_id": str(job["server_id"])}, job["rate_nodes_per_s"])
+            for job in (job.to_dict() for job in browse_jobs.list_jobs()) if job["status"] == "running"])
+
+    # Session và subscription
+    groups = list(subscription_manager.groups.values())
+    subscriptions_by_server = {}
+    items_by_server = {}
+    for group in groups:
+        subscriptions_by_server[group.server_id] = subscriptions_by_server.get(group.server_id, 0) + 1
+        items_by_server[group.server_id] = items_by_server.get(group.server_id, 0) + len(group.items_by_mapping)
+    family("opcua_sessions_active", "gauge", "Số session OPC UA đang mở.",
+           [("opcua_sessions_active", {}, len(active_clients))])
+    family("opcua_subscriptions_active", "gauge", "Số subscription OPC UA theo server.",
+           [("opcua_subscriptions_active", {"server_id": str(server_id)}, count)
+            for server_id, count in subscriptions_by_server.items()])
+    family("opcua_monitored_items_active", "gauge", "Số monitored item (mapping đang subscribe) theo server.",
+           [("opcua_monitored_items_active", {"server_id": str(server_id)}, count)
+            for server_id, count in items_by_server.items()])
+    family("opcua_mappings_subscribed", "gauge", "Số mapping đang có subscription runtime.",
+           [("opcua_mappings_subscribed", {}, len(active_opcua_subscriptions))])
+
+    lines = []
+    for name, metric_type, documentation, samples in families:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample_name, labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape_label(str(val))}"' for key, val in labels.items())
+            lines.append(f"{sample_name}{{{label_text}}} {_format_value(value)}" if label_text
+                         else f"{sample_name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -85,11 +85,14 @@ class OpcNode(db.Model):
     # Mô tả của node (từ thuộc tính Description của node)
     description = db.Column(db.Text, nullable=True)
 
+    # Node không còn thấy trong lần duyệt incremental gần nhất. Node không bị xóa để giữ FK của SubscriptionMapping,
+    # và sẽ được bỏ đánh dấu nếu xuất hiện lại ở lần duyệt sau.
+    is_stale = db.Column(db.Boolean, default=False, nullable=False)
+
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    # updated_at có thể không cần thiết cho node nếu thông tin của nó ít thay đổi sau khi duyệt
-    # nhưng có thể hữu ích nếu bạn cập nhật thông tin node sau này
-    # updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Chỉ thay đổi khi lần duyệt incremental thấy thông tin node khác với bản đã lưu
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Mối quan hệ với OpcServer (tùy chọn, để dễ truy cập server từ node)
     # server = db.relationship('OpcServer', backref=db.backref('nodes', lazy='dynamic'))
@@ -103,6 +106,28 @@ class OpcNode(db.Model):
         return f'<OpcNode Srv:{self.server_id} ID:{self.node_id_string} Name:{self.browse_name}>'
     
 
+class OpcDataType(db.Model):
+    __tablename__ = 'opc_data_types'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Mỗi server có tập DataType riêng (cùng NodeId có thể mang tên khác nhau trên các server)
+    server_id = db.Column(db.Integer, db.ForeignKey('opc_servers.id'), nullable=False, index=True)
+
+    # NodeId (dạng chuỗi) của DataType, ví dụ "i=11" hoặc "ns=2;i=3002"
+    node_id_string = db.Column(db.String(255), nullable=False)
+
+    # Tên hiển thị của DataType (DisplayName), ví dụ "Double"
+    display_name = db.Column(db.String(255), nullable=False)
+
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('server_id', 'node_id_string', name='uq_server_datatype_node_id'),)
+
+    def __repr__(self):
+        return f'<OpcDataType Srv:{self.server_id} ID:{self.node_id_string} Name:{self.display_name}>'
+
+
 class SubscriptionMapping(db.Model):
     __tablename__ = 'subscription_mappings'
 
@@ -122,6 +147,12 @@ class SubscriptionMapping(db.Model):
     
     is_active = db.Column(db.Boolean, default=True, nullable=False)
 
+    # Report-by-exception: 'None', 'Absolute' (cùng đơn vị với giá trị) hoặc 'Percent' (% EURange của node)
+    deadband_type = db.Column(db.String(20), default='None', nullable=False, server_default='None')
+    deadband_value = db.Column(db.Float, default=0.0, nullable=False, server_default='0')
+    # Gửi lại giá trị cuối nếu không có thay đổi nào được gửi trong khoảng này (giây), 0 = tắt
+    heartbeat_interval_s = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
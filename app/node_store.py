@@ -0,0 +1,212 @@
+# app/node_store.py
+import asyncio
+import logging
+import queue
+import time
+
+from app import db
+from app.models import OpcNode
+from app.opcua_client import start_server_browse, browse_stop_flags
+from async_worker import get_async_worker
+
+logger = logging.getLogger(__name__)
+
+# Số chunk tối đa nằm chờ giữa event loop (duyệt) và thread ghi DB.
+# Khi đầy, việc duyệt tạm dừng cho tới khi DB ghi kịp => bộ nhớ bị chặn ở khoảng QUEUE_CHUNKS * chunk_size node.
+QUEUE_CHUNKS = 4
+
+_SENTINEL = None
+
+
+async def _produce_browse_chunks(server_id: int, max_depth: int, chunk_size: int, chunk_queue: queue.Queue,
+                                 progress: dict = None):
+    """Chạy trên AsyncWorker: duyệt server và đẩy từng chunk node_info vào chunk_queue."""
+    loop = asyncio.get_running_loop()
+    chunk = []
+    try:
+        async for node_info in start_server_browse(server_db_id=server_id, max_depth=max_depth, progress=progress):
+            chunk.append(node_info)
+            if len(chunk) >= chunk_size:
+                # put() có thể chặn khi hàng đợi đầy, chạy trong executor để không chặn event loop
+                await loop.run_in_executor(None, chunk_queue.put, chunk)
+                chunk = []
+        if chunk:
+            await loop.run_in_executor(None, chunk_queue.put, chunk)
+    except Exception as e_browse:
+        logger.error(f"Lỗi khi duyệt server ID {server_id} (streaming): {e_browse}", exc_info=True)
+        await loop.run_in_executor(None, chunk_queue.put, e_browse)
+    finally:
+        await loop.run_in_executor(None, chunk_queue.put, _SENTINEL)
+
+
+# Các cột được so sánh khi duyệt incremental để quyết định node có thay đổi hay không
+NODE_FIELDS = ('browse_name', 'display_name', 'node_class_str', 'parent_node_id_string', 'data_type', 'description')
+
+
+def _insert_chunk(chunk) -> int:
+    """Ghi một chunk node bằng Core bulk INSERT (executemany), không qua ORM unit-of-work."""
+    db.session.execute(OpcNode.__table__.insert(), chunk)
+    db.session.commit()
+    return len(chunk)
+
+
+def _delete_server_nodes(server_id: int) -> int:
+    """Chế độ duyệt full: xóa node cũ trong chính job duyệt, để request bị từ chối không làm mất cây node."""
+    try:
+        num_deleted = OpcNode.query.filter_by(server_id=server_id).delete()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"Đã xóa {num_deleted} node cũ của server ID {server_id} khỏi DB trước khi duyệt full.")
+    return num_deleted
+
+
+class IncrementalNodeWriter:
+    """
+    Ghi kết quả duyệt theo kiểu upsert trên (server_id, node_id_string) (ràng buộc uq_server_node_id):
+    node mới được INSERT, node có thông tin thay đổi (hoặc đang stale) được UPDATE, node không đổi không bị ghi.
+    Sau khi duyệt xong trọn vẹn, các node có từ trước mà không còn thấy được đánh dấu is_stale thay vì bị xóa.
+    """
+    def __init__(self, server_id: int, chunk_size: int = 1000):
+        self.server_id = server_id
+        self.chunk_size = chunk_size
+        self.seen_ids = set() # id của các node đã có trong DB và được thấy lại trong lần duyệt này
+        # Node có id lớn hơn mốc này được thêm trong lần duyệt hiện tại, không thể là stale
+        self.max_id_before = db.session.query(db.func.max(OpcNode.id)).filter(OpcNode.server_id == server_id).scalar() or 0
+        self.stats = {"inserted": 0, "updated": 0, "unchanged": 0, "marked_stale": 0}
+
+        table = OpcNode.__table__
+        self._update_stmt = (
+            table.update()
+            .where(table.c.id == db.bindparam('b_id'))
+            .values({field: db.bindparam(field) for field in NODE_FIELDS + ('is_stale',)})
+        )
+
+    def write_chunk(self, chunk) -> int:
+        columns = [OpcNode.id, OpcNode.node_id_string, OpcNode.is_stale] + [getattr(OpcNode, f) for f in NODE_FIELDS]
+        existing = {
+            row.node_id_string: row for row in db.session.execute(
+                db.select(*columns).where(OpcNode.server_id == self.server_id,
+                                          OpcNode.node_id_string.in_([n['node_id_string'] for n in chunk]))
+            )
+        }
+
+        inserts = []
+        updates = []
+        for node_info in chunk:
+            row = existing.get(node_info['node_id_string'])
+            if row is None:
+                inserts.append(node_info)
+                continue
+            self.seen_ids.add(row.id)
+            if row.is_stale or any(getattr(row, f) != node_info.get(f) for f in NODE_FIELDS):
+                values = {f: node_info.get(f) for f in NODE_FIELDS}
+                values.update({'b_id': row.id, 'is_stale': False})
+                updates.append(values)
+            else:
+                self.stats["unchanged"] += 1
+
+        if inserts:
+            db.session.execute(OpcNode.__table__.insert(), inserts)
+        if updates:
+            db.session.execute(self._update_stmt, updates)
+        if inserts or updates:
+            db.session.commit()
+        self.stats["inserted"] += len(inserts)
+        self.stats["updated"] += len(updates)
+        return len(chunk)
+
+    def mark_vanished_stale(self) -> int:
+        """Đánh dấu is_stale cho node có từ trước lần duyệt này mà không được thấy lại."""
+        candidate_ids = db.session.execute(
+            db.select(OpcNode.id).where(OpcNode.server_id == self.server_id,
+                                        OpcNode.is_stale == False,
+                                        OpcNode.id <= self.max_id_before)
+        ).scalars()
+        vanished_ids = [node_id for node_id in candidate_ids if node_id not in self.seen_ids]
+        for offset in range(0, len(vanished_ids), self.chunk_size):
+            ids = vanished_ids[offset:offset + self.chunk_size]
+            db.session.execute(OpcNode.__table__.update().where(OpcNode.__table__.c.id.in_(ids)).values(is_stale=True))
+        if vanished_ids:
+            db.session.commit()
+        self.stats["marked_stale"] = len(vanished_ids)
+        return len(vanished_ids)
+
+
+def browse_and_stream_to_db(server_id: int, max_depth: int, chunk_size: int = 1000, progress: dict = None,
+                            incremental: bool = True) -> dict:
+    """
+    Duyệt server trên AsyncWorker và ghi kết quả vào bảng opc_nodes theo từng chunk chunk_size node
+    ngay trong lúc duyệt (thread gọi hàm này phải có app context).
+    incremental=True: upsert và đánh dấu stale (IncrementalNodeWriter); False: xóa toàn bộ node cũ của server
+    ngay trước khi bắt đầu duyệt rồi chỉ INSERT (người gọi phải bảo đảm server chưa có mapping).
+    progress (nếu có) được cập nhật tại chỗ: nodes_received, nodes_saved, chunks_saved, elapsed_s,
+    nodes_visited/depth/frontier (từ browse engine) và inserted/updated/unchanged/marked_stale khi incremental.
+    Trả về dict progress cùng 'error' (None nếu không lỗi) và 'stopped_by_user'.
+    """
+    chunk_size = max(1, int(chunk_size))
+    if progress is None:
+        progress = {}
+    progress.update({"nodes_received": 0, "nodes_saved": 0, "chunks_saved": 0, "elapsed_s": 0.0,
+                     "nodes_visited": 0, "depth": 0, "frontier": 0, "error": None, "stopped_by_user": False})
+
+    worker = get_async_worker()
+    loop = worker.loop_for(server_id) # Client của server chỉ được dùng trên shard của nó
+    if not loop or not loop.is_running():
+        raise RuntimeError("Async worker loop is not available.")
+
+    started = time.perf_counter()
+    if incremental:
+        writer = IncrementalNodeWriter(server_id, chunk_size)
+        write_chunk = writer.write_chunk
+    else:
+        writer = None
+        write_chunk = _insert_chunk
+        _delete_server_nodes(server_id)
+    chunk_queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+    producer = asyncio.run_coroutine_threadsafe(
+        _produce_browse_chunks(server_id, max_depth, chunk_size, chunk_queue, progress), loop
+    )
+
+    save_error = None
+    while True:
+        item = chunk_queue.get()
+        if item is _SENTINEL:
+            break
+        if isinstance(item, Exception):
+            progress["error"] = str(item)
+            continue
+        progress["nodes_received"] += len(item)
+        if save_error is not None:
+            continue # Đang chờ phía duyệt dừng, bỏ các chunk còn lại
+        try:
+            progress["nodes_saved"] += write_chunk(item)
+            progress["chunks_saved"] += 1
+            if writer:
+                progress.update(writer.stats)
+            progress["elapsed_s"] = round(time.perf_counter() - started, 3)
+            logger.debug(f"Đã lưu chunk {progress['chunks_saved']} ({len(item)} node) cho server ID {server_id}. "
+                         f"Tổng: {progress['nodes_saved']} node.")
+        except Exception as e_save:
+            db.session.rollback()
+            save_error = e_save
+            progress["error"] = str(e_save)
+            logger.error(f"Lỗi khi lưu chunk {len(item)} node cho server ID {server_id}: {e_save}", exc_info=True)
+            browse_stop_flags[server_id] = True # Không lưu được thì dừng duyệt, các chunk đã commit vẫn giữ lại
+
+    producer.result() # Producer đã đẩy sentinel nên đã (hoặc sắp) hoàn tất
+    progress["elapsed_s"] = round(time.perf_counter() - started, 3)
+    if save_error is None:
+        progress["stopped_by_user"] = browse_stop_flags.get(server_id, False)
+    # Chỉ đánh dấu stale khi đã duyệt trọn vẹn, nếu không các node chưa kịp duyệt tới sẽ bị đánh dấu nhầm
+    if writer and not progress["error"] and not progress["stopped_by_user"]:
+        try:
+            writer.mark_vanished_stale()
+            progress.update(writer.stats)
+        except Exception as e_stale:
+            db.session.rollback()
+            progress["error"] = str(e_stale)
+            logger.error(f"Lỗi khi đánh dấu node stale cho server ID {server_id}: {e_stale}", exc_info=True)
+    logger.info(f"Streaming browse server ID {server_id} hoàn tất: {progress}")
+    return progress
@@ -1,5 +1,6 @@
 # app/opcua_client.py
 import asyncio
+import time
 from asyncua import Client as AsyncuaClient # Đổi tên để tránh nhầm lẫn nếu có Client khác
 from asyncua import ua
 from app.models import OpcServer, SubscriptionMapping, OpcNode
@@ -8,8 +9,9 @@ from asyncua.common.node import Node as AsyncuaNode # Import lớp Node đúng
 from typing import Optional # Thêm ở đầu file
 from async_worker import get_async_worker
 from app import db 
-import requests
-import json
+from app.browse_engine import BrowseEngine, DEFAULT_MAX_IN_FLIGHT as DEFAULT_BROWSE_MAX_IN_FLIGHT
+from app.datatype_cache import datatype_cache
+from app.value_cache import value_cache
 
 
 
@@ -227,6 +229,8 @@ async def connect_server(server_config: OpcServer):
         await client.connect()
         logger.info(f"Kết nối thành công đến server: {server_config.name}")
         active_clients[server_id] = client
+        from app.connection_supervisor import connection_supervisor # Import ở đây để tránh circular
+        connection_supervisor.watch(server_id) # Giám sát session, tự kết nối lại và khôi phục subscription khi mất kết nối
         return True
     except ConnectionRefusedError:
         logger.error(f"Kết nối bị từ chối từ server: {server_config.name} ({server_config.endpoint_url})")
@@ -254,6 +258,12 @@ async def disconnect_server(server_id: int):
     Trả về True nếu ngắt kết nối thành công hoặc không có kết nối nào, False nếu lỗi.
     """
     global active_clients
+    from app.connection_supervisor import connection_supervisor # Import ở đây để tránh circular
+    # Dừng giám sát trước để supervisor không tự kết nối lại server vừa bị ngắt
+    connection_supervisor.unwatch(server_id)
+    # Đóng session sẽ xóa mọi subscription trên server, gỡ luôn trạng thái runtime của các mapping thuộc server này
+    # (kể cả khi supervisor đang kết nối lại và client cũ đã bị bỏ khỏi active_clients)
+    forget_server_runtime_state(server_id)
     if server_id in active_clients:
         client = active_clients.pop(server_id) # Lấy và xóa client khỏi danh sách active
         try:
@@ -269,6 +279,16 @@ async def disconnect_server(server_id: int):
         logger.info(f"Không có kết nối hoạt động nào cho server ID: {server_id} để ngắt.")
         return True # Coi như thành công vì không có gì để làm
 
+
+def forget_server_runtime_state(server_id: int):
+    """Gỡ trạng thái runtime gắn với session của server: subscription dùng chung, mapping đã subscribe, cache."""
+    for mapping_id in subscription_manager.drop_server(server_id):
+        route = pop_active_route(mapping_id)
+        if route is not None and iec104_outstation.running: # Mất session: master IEC-104 nhận cờ IV
+            iec104_outstation.publish(route.ioa_mapping, None, good=False)
+    server_operation_limits.pop(server_id, None)
+    value_cache.forget_server(server_id)
+
 def get_client_by_server_id(server_id: int) -> Optional[AsyncuaClient]:
     """
     Lấy client object đang hoạt động cho một server_id.
@@ -287,132 +307,12 @@ def is_server_connected(server_id: int) -> bool:
 
 
 # mới thêm cho phần duyệt node
-async def _browse_recursive(client: AsyncuaClient,
-                            ua_node: AsyncuaNode,
-                            server_db_id: int,
-                            processed_node_ids: set, # Set để theo dõi các node đã xử lý trong phiên này
-                            parent_node_db_id_str: str = None,
-                            depth: int = 0,
-                            max_depth: int = 5):
-    """
-    Hàm đệ quy để duyệt các node.
-    Yield một dictionary chứa thông tin của từng node tìm thấy.
-    """
-    if browse_stop_flags.get(server_db_id, False):
-        logger.info(f"Dừng duyệt (cờ): ServerID={server_db_id}, Node='{ua_node.nodeid.to_string() if ua_node and ua_node.nodeid else 'N/A'}'")
-        return
-
-    if not ua_node or not ua_node.nodeid:
-        logger.warning(f"Node không hợp lệ hoặc không có NodeId. ServerID={server_db_id}, Parent='{parent_node_db_id_str}', Depth={depth}")
-        return
-
-    node_id_str = ua_node.nodeid.to_string()
-
-    if depth > max_depth:
-        logger.warning(f"Đạt độ sâu tối đa ({max_depth}). ServerID={server_db_id}, Node='{node_id_str}', Dừng nhánh này.")
-        return
-
-    if node_id_str in processed_node_ids:
-        logger.debug(f"Node đã xử lý: ServerID={server_db_id}, Node='{node_id_str}'. Bỏ qua.")
-        return
-    processed_node_ids.add(node_id_str)
-
-    try:
-        # Đọc các thuộc tính cơ bản
-        try:
-            browse_name_obj = await ua_node.read_browse_name()
-            browse_name_str = f"{browse_name_obj.NamespaceIndex}:{browse_name_obj.Name}" if browse_name_obj.NamespaceIndex != 0 else browse_name_obj.Name
-        except ua.UaStatusCodeError as e_bn:
-            logger.warning(f"Lỗi đọc BrowseName: ServerID={server_db_id}, Node='{node_id_str}', Code={e_bn.code}, Msg='{str(e_bn)}'. Bỏ qua node.")
-            return
-
-        display_name_str = browse_name_str # Fallback
-        try:
-            display_name_obj = await ua_node.read_display_name()
-            if display_name_obj and display_name_obj.Text:
-                display_name_str = display_name_obj.Text
-        except ua.UaStatusCodeError as e_dn:
-            logger.debug(f"Lỗi đọc DisplayName: ServerID={server_db_id}, Node='{node_id_str}', Code={e_dn.code}, Msg='{str(e_dn)}'. Dùng BrowseName.")
-
-        try:
-            node_class_obj = await ua_node.read_node_class()
-            node_class_str = node_class_obj.name if node_class_obj else "UnknownNodeClass"
-        except ua.UaStatusCodeError as e_nc:
-            logger.warning(f"Lỗi đọc NodeClass: ServerID={server_db_id}, Node='{node_id_str}', Code={e_nc.code}, Msg='{str(e_nc)}'. Bỏ qua node.")
-            return
-
-        description_str = None
-        try:
-            description_obj = await ua_node.read_description()
-            description_str = description_obj.Text if description_obj and description_obj.Text else None
-        except ua.UaStatusCodeError as e_desc:
-            logger.debug(f"Lỗi đọc Description: ServerID={server_db_id}, Node='{node_id_str}', Code={e_desc.code}, Msg='{str(e_desc)}'. Gán là None.")
-
-        data_type_str = None
-        if node_class_obj == ua.NodeClass.Variable:
-            try:
-                datatype_nodeid = await ua_node.read_data_type()
-                if datatype_nodeid:
-                    # Cố gắng lấy tên dễ đọc của DataType, nếu không thì dùng NodeId của nó
-                    try:
-                        datatype_node = client.get_node(datatype_nodeid)
-                        datatype_display_name_obj = await datatype_node.read_display_name()
-                        data_type_str = datatype_display_name_obj.Text if datatype_display_name_obj and datatype_display_name_obj.Text else datatype_nodeid.to_string()
-                    except Exception as e_dt_resolve:
-                        logger.debug(f"Không thể phân giải tên DataType cho {datatype_nodeid} của Node {node_id_str}: {e_dt_resolve}. Dùng NodeId.")
-                        data_type_str = datatype_nodeid.to_string()
-                else:
-                    data_type_str = "DataTypeNotSet"
-            except ua.UaStatusCodeError as e_dt_status:
-                 logger.debug(f"Lỗi Status Code khi đọc DataType: ServerID={server_db_id}, VariableNode='{node_id_str}', Code={e_dt_status.code}, Msg='{str(e_dt_status)}'. Gán là 'UnknownDataType'.")
-                 data_type_str = "UnknownDataType"
-            except Exception as e_dt_general:
-                logger.debug(f"Lỗi chung khi đọc DataType: ServerID={server_db_id}, VariableNode='{node_id_str}', Lỗi='{str(e_dt_general)}'. Gán là 'UnknownDataType'.")
-                data_type_str = "UnknownDataType"
-
-        node_info = {
-            'server_id': server_db_id,
-            'node_id_string': node_id_str,
-            'browse_name': browse_name_str,
-            'display_name': display_name_str,
-            'node_class_str': node_class_str,
-            'parent_node_id_string': parent_node_db_id_str,
-            'data_type': data_type_str,
-            'description': description_str,
-        }
-        # logger.info(f"Đã xử lý Node: ServerID={server_db_id}, ID='{node_id_str}', Name='{display_name_str}', Class='{node_class_str}', Parent='{parent_node_db_id_str}', Depth={depth}")
-        yield node_info
-
-        # Tiếp tục duyệt các node con
-        if node_class_obj in [ua.NodeClass.Object, ua.NodeClass.View] and depth < max_depth:
-            if browse_stop_flags.get(server_db_id, False):
-                logger.info(f"Dừng duyệt con của node '{node_id_str}' do tín hiệu dừng. ServerID={server_db_id}.")
-                return
-
-            children = []
-            try:
-                children = await ua_node.get_children(refs=ua.ObjectIds.HierarchicalReferences)
-            except ua.UaStatusCodeError as e_child:
-                 logger.warning(f"Không thể lấy con của node '{node_id_str}': Code={e_child.code}, Msg='{str(e_child)}'. ServerID={server_db_id}.")
-
-            if children:
-                logger.debug(f"Node '{node_id_str}' ({display_name_str}) có {len(children)} con. Duyệt con ở độ sâu {depth + 1}. ServerID={server_db_id}.")
-                for child_ua_node in children:
-                    async for sub_node_info in _browse_recursive(client, child_ua_node, server_db_id,
-                                                                 processed_node_ids, # Truyền set
-                                                                 node_id_str, depth + 1, max_depth):
-                        yield sub_node_info
-                    if browse_stop_flags.get(server_db_id, False):
-                        logger.info(f"Dừng duyệt các con tiếp theo của node '{node_id_str}' do tín hiệu dừng. ServerID={server_db_id}.")
-                        break
-    except Exception as e_outer:
-        current_node_id_for_log = node_id_str if node_id_str else (ua_node.nodeid.to_string() if ua_node and ua_node.nodeid else 'UnknownNode (outer exception)')
-        logger.error(f"Lỗi nghiêm trọng khi xử lý node '{current_node_id_for_log}': {str(e_outer)}. ServerID={server_db_id}.", exc_info=True)
-
-
-async def start_server_browse(server_db_id: int, start_node_id_str: str = None, max_depth: int = 5):
+async def start_server_browse(server_db_id: int, start_node_id_str: str = None, max_depth: int = 5,
+                              max_in_flight: int = DEFAULT_BROWSE_MAX_IN_FLIGHT, progress: dict = None):
     """
-    Bắt đầu quá trình duyệt Address Space của server.
+    Bắt đầu quá trình duyệt Address Space của server (theo chiều rộng, xem app/browse_engine.py).
+    max_in_flight: số request Browse/Read gửi song song tới server.
+    progress: dict (tùy chọn) được cập nhật tại chỗ với depth, frontier, nodes_visited.
     Yields node_info dictionaries.
     """
     client = get_client_by_server_id(server_db_id) # Hàm này đã được định nghĩa
@@ -421,9 +321,9 @@ async def start_server_browse(server_db_id: int, start_node_id_str: str = None,
         return # Hoặc raise Exception
 
     logger.info(f"Bắt đầu duyệt server ID: {server_db_id}. Độ sâu tối đa: {max_depth}. Đặt cờ dừng về False.")
-    browse_stop_flags[server_db_id] = False # Reset/Khởi tạo cờ dừng cho phiên duyệt này
-    
-    processed_node_ids_this_session = set() # Set để theo dõi node đã xử lý trong phiên này
+    # Khởi tạo cờ dừng nếu chưa có. Không ghi đè True: yêu cầu dừng/hủy có thể đến trước khi duyệt thực sự bắt đầu,
+    # người gọi chịu trách nhiệm xóa cờ sau khi duyệt xong.
+    browse_stop_flags.setdefault(server_db_id, False)
 
     try:
         start_ua_node = None
@@ -450,11 +350,17 @@ async def start_server_browse(server_db_id: int, start_node_id_str: str = None,
         if start_ua_node.nodeid == ua.ObjectIds.ObjectsFolder:
             parent_for_start_node = ua.ObjectIds.RootFolder.to_string() # Cha của ObjectsFolder là RootFolder
 
-        # Bắt đầu duyệt đệ quy
-        async for node_data in _browse_recursive(client, start_ua_node, server_db_id, 
-                                                 processed_node_ids_this_session, # Truyền set vào
-                                                 parent_for_start_node, 0, max_depth):
+        limits = await get_server_operation_limits(server_db_id)
+        engine = BrowseEngine(client, server_db_id, max_depth=max_depth, max_in_flight=max_in_flight,
+                              max_nodes_per_read=limits["max_nodes_per_read"],
+                              max_nodes_per_browse=limits["max_nodes_per_browse"],
+                              should_stop=lambda: browse_stop_flags.get(server_db_id, False),
+                              datatype_cache=datatype_cache, progress=progress)
+
+        # Bắt đầu duyệt theo từng mức
+        async for node_data in engine.browse([start_ua_node.nodeid], parent_for_start_node):
             yield node_data
+        logger.info(f"Thống kê duyệt server ID {server_db_id}: {engine.stats}")
         
         # Kiểm tra cờ dừng sau khi generator hoàn tất (hoặc bị dừng sớm)
         if browse_stop_flags.get(server_db_id, False):
@@ -593,9 +499,11 @@ async def get_opcua_node_all_attributes(server_db_id: int, node_id_to_fetch_str:
                     datatype_node_id_str = details.get("DataType") # DataType giờ là NodeId string từ map
                     if datatype_node_id_str:
                         try:
-                            dt_node = client.get_node(datatype_node_id_str)
-                            dt_name_obj = await dt_node.read_display_name() # Đổi tên biến
-                            details["DataTypeName"] = dt_name_obj.Text if dt_name_obj and dt_name_obj.Text else datatype_node_id_str
+                            # Tên DataType lấy từ cache của server, chỉ đọc từ server khi chưa có
+                            dt_names = await datatype_cache.resolve(
+                                client, server_db_id, {datatype_node_id_str: ua.NodeId.from_string(datatype_node_id_str)}
+                            )
+                            details["DataTypeName"] = dt_names.get(datatype_node_id_str, datatype_node_id_str)
                         except Exception as e_dt_name:
                             logger.debug(f"Node Details: Không thể lấy DisplayName cho DataTypeNodeId {datatype_node_id_str}: {e_dt_name}")
                             details["DataTypeName"] = datatype_node_id_str # Fallback về NodeId
@@ -642,17 +550,7 @@ async def async_get_node_data_value(server_db_id: int, node_id_to_fetch_str: str
         #     return {"error": "Node không phải là Variable"}
 
         data_value_obj = await ua_node.read_data_value()
-        
-        value_details = {}
-        if data_value_obj.StatusCode.is_good():
-            value_details["Value"] = str(data_value_obj.Value.Value)
-            value_details["ValueSourceTimestamp"] = data_value_obj.SourceTimestamp.isoformat() if data_value_obj.SourceTimestamp else None
-            value_details["ValueServerTimestamp"] = data_value_obj.ServerTimestamp.isoformat() if data_value_obj.ServerTimestamp else None
-            value_details["ValueStatusCode"] = data_value_obj.StatusCode.name
-        else:
-            value_details["Value"] = f"Lỗi đọc: {data_value_obj.StatusCode.name}"
-            value_details["ValueStatusCode"] = data_value_obj.StatusCode.name
-            value_details["error_message"] = f"Không thể đọc giá trị: {data_value_obj.StatusCode.name}"
+        value_details = _data_value_details(data_value_obj)
         
         logger.info(f"Refresh Value: Đọc DataValue thành công cho NodeID '{node_id_to_fetch_str}'.")
         return value_details
@@ -663,94 +561,200 @@ async def async_get_node_data_value(server_db_id: int, node_id_to_fetch_str: str
     except Exception as e_general:
         logger.error(f"Refresh Value: Lỗi không mong muốn khi đọc DataValue cho NodeID '{node_id_to_fetch_str}': {str(e_general)}", exc_info=True)
         return {"error": f"Lỗi không mong muốn: {str(e_general)}"}
+
+
+def _data_value_details(data_value_obj) -> dict:
+    """Chuyển ua.DataValue thành dict Value/ValueStatusCode/timestamps dùng cho JSON."""
+    value_details = {}
+    if data_value_obj.StatusCode.is_good():
+        value_details["Value"] = str(data_value_obj.Value.Value)
+        value_details["ValueSourceTimestamp"] = data_value_obj.SourceTimestamp.isoformat() if data_value_obj.SourceTimestamp else None
+        value_details["ValueServerTimestamp"] = data_value_obj.ServerTimestamp.isoformat() if data_value_obj.ServerTimestamp else None
+        value_details["ValueStatusCode"] = data_value_obj.StatusCode.name
+    else:
+        value_details["Value"] = f"Lỗi đọc: {data_value_obj.StatusCode.name}"
+        value_details["ValueStatusCode"] = data_value_obj.StatusCode.name
+        value_details["error_message"] = f"Không thể đọc giá trị: {data_value_obj.StatusCode.name}"
+    return value_details
+
+
+async def _read_server_node_values(server_db_id: int, node_id_strs) -> dict:
+    """Đọc DataValue của các node trên một server, chia chunk theo MaxNodesPerRead. Trả về {node_id_str: value_details}."""
+    client = get_client_by_server_id(server_db_id)
+    if not client:
+        return {node_id_str: {"error": "Server không kết nối"} for node_id_str in node_id_strs}
+
+    values = {}
+    read_ids = []
+    for node_id_str in node_id_strs:
+        try:
+            read_ids.append((node_id_str, ua.NodeId.from_string(node_id_str)))
+        except Exception as e_parse:
+            values[node_id_str] = {"error": f"NodeId không hợp lệ: {e_parse}"}
+
+    limits = await get_server_operation_limits(server_db_id)
+    chunk_size = limits["max_nodes_per_read"]
+    for offset in range(0, len(read_ids), chunk_size):
+        chunk = read_ids[offset:offset + chunk_size]
+        params = ua.ReadParameters()
+        for _, node_id in chunk:
+            rv = ua.ReadValueId()
+            rv.NodeId = node_id
+            rv.AttributeId = ua.AttributeIds.Value
+            params.NodesToRead.append(rv)
+        try:
+            data_values = await client.uaclient.read(params)
+        except Exception as e_read:
+            logger.error(f"Batch Read: Lỗi khi đọc {len(chunk)} node trên ServerID {server_db_id}: {e_read}", exc_info=True)
+            for node_id_str, _ in chunk:
+                values[node_id_str] = {"error": f"Lỗi OPC UA: {str(e_read)}"}
+            continue
+        for (node_id_str, _), data_value_obj in zip(chunk, data_values):
+            values[node_id_str] = _data_value_details(data_value_obj)
+    return values
+
+
+async def async_read_node_values(node_ids_by_server: dict) -> dict:
+    """
+    Đọc DataValue của nhiều node trên nhiều server: mỗi server một Read (chia chunk theo MaxNodesPerRead),
+    các server được đọc đồng thời.
+    node_ids_by_server: {server_db_id: [node_id_str, ...]}.
+    Trả về {server_db_id: {node_id_str: value_details}}, node không đọc được có key "error".
+    """
+    worker = get_async_worker()
+    server_ids = list(node_ids_by_server)
+    results = await asyncio.gather(*(worker.call_on_shard(server_id,
+                                                          _read_server_node_values(server_id, node_ids_by_server[server_id]))
+                                     for server_id in server_ids))
+    return dict(zip(server_ids, results))
     
 
     # Hàm tự động kết nối 
 def try_auto_reconnect_servers(app_instance): # <-- Thêm app_instance làm tham số
     """
-    Cố gắng tự động kết nối lại các server.
-    Cần được gọi bên trong một app_context hoặc truyền app_instance.
+    Tự động kết nối lại các server được đánh dấu 'CONNECTED' trong DB nhưng chưa có kết nối runtime.
+    Các kết nối chạy đồng thời trên AsyncWorker (tối đa AUTO_RECONNECT_CONCURRENCY server cùng lúc);
+    hàm chỉ lên lịch rồi trả về ngay nên không chặn create_app dù có server offline.
+    Trả về concurrent.futures.Future (kết quả là dict {server_id: True/False}) hoặc None nếu không có gì để làm.
     """
     logger.info("Bắt đầu quá trình kiểm tra và tự động kết nối lại các server...")
     try:
+        pending_servers = []
         # Sử dụng app_context của app_instance được truyền vào
         with app_instance.app_context():
             servers_to_check = OpcServer.query.filter_by(connection_status="CONNECTED").all()
             
             if not servers_to_check:
                 logger.info("Không có server nào trong CSDL được đánh dấu là 'CONNECTED' để kiểm tra.")
-                return
+                return None
 
             worker = get_async_worker()
             if not worker.loop or not worker.loop.is_running():
                 logger.error("AsyncWorker không chạy, không thể thực hiện tự động kết nối lại.")
-                return
+                return None
 
-            changes_made_to_db = False
             for server_config in servers_to_check:
-                if not is_server_connected(server_config.id):
-                    logger.info(f"Server '{server_config.name}' (ID: {server_config.id}) được đánh dấu 'CONNECTED' trong DB "
-                                f"nhưng không có kết nối runtime. Đang thử kết nối lại...")
-                    try:
-                        # async_connect_server được giả định là đã được import hoặc định nghĩa
-                        # success = worker.run_coroutine(async_connect_server(server_config))
-                        success = worker.run_coroutine(connect_server(server_config)) # <-- SỬA Ở ĐÂY
-                        if success:
-                            logger.info(f"Tự động kết nối lại thành công cho server '{server_config.name}'.")
-                            # Trạng thái DB đã là CONNECTED, không cần thay đổi nếu thành công
-                        else:
-                            logger.warning(f"Tự động kết nối lại thất bại cho server '{server_config.name}'. "
-                                           f"Cập nhật trạng thái DB thành 'ERROR'.")
-                            server_config.connection_status = "ERROR"
-                            db.session.add(server_config)
-                            changes_made_to_db = True
-                    except Exception as e_connect:
-                        logger.error(f"Lỗi nghiêm trọng khi tự động kết nối lại server '{server_config.name}': {e_connect}", exc_info=True)
-                        server_config.connection_status = "ERROR"
-                        db.session.add(server_config)
-                        changes_made_to_db = True
-                else:
+                if is_server_connected(server_config.id):
                     logger.info(f"Server '{server_config.name}' (ID: {server_config.id}) đã có kết nối runtime.")
-            
-            if changes_made_to_db:
-                try:
-                    db.session.commit()
-                    logger.info("Đã commit các thay đổi trạng thái server vào DB sau khi auto-reconnect.")
-                except Exception as e_commit:
-                    db.session.rollback()
-                    logger.error(f"Lỗi khi commit thay đổi trạng thái server sau auto-reconnect: {e_commit}", exc_info=True)
-            else:
-                logger.info("Không có thay đổi trạng thái nào cần commit sau khi auto-reconnect.")
+                    continue
+                logger.info(f"Server '{server_config.name}' (ID: {server_config.id}) được đánh dấu 'CONNECTED' trong DB "
+                            f"nhưng không có kết nối runtime. Sẽ thử kết nối lại...")
+                # Tách khỏi session để dùng trên thread của AsyncWorker sau khi app context kết thúc
+                db.session.expunge(server_config)
+                pending_servers.append(server_config)
+
+        if not pending_servers:
+            logger.info("Không có server nào cần tự động kết nối lại.")
+            return None
 
-        logger.info("Hoàn tất quá trình kiểm tra và tự động kết nối lại.")
+        concurrency = max(1, int(app_instance.config.get('AUTO_RECONNECT_CONCURRENCY', 8)))
+        future = asyncio.run_coroutine_threadsafe(
+            _auto_reconnect_servers(app_instance, pending_servers, concurrency), worker.loop
+        )
+        logger.info(f"Đã lên lịch tự động kết nối lại {len(pending_servers)} server chạy nền "
+                    f"(tối đa {concurrency} kết nối đồng thời).")
+        return future
 
     except Exception as e:
-        # Không nên có db.session.rollback() ở đây nếu khối with app_instance.app_context() đã bao trùm
-        # vì context có thể đã bị hủy. Rollback nên nằm trong khối with.
         logger.error(f"Lỗi nghiêm trọng trong quá trình try_auto_reconnect_servers: {e}", exc_info=True)
+        return None
+
+
+async def _auto_reconnect_servers(app_instance, server_configs, concurrency: int) -> dict:
+    """Chạy trên AsyncWorker: kết nối đồng thời các server, cập nhật DB cho các server thất bại trong một lần commit."""
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    worker = get_async_worker()
+
+    async def reconnect(server_config):
+        async with semaphore:
+            try:
+                # Client phải được tạo trên shard phụ trách server
+                return server_config, await worker.call_on_shard(server_config.id, connect_server(server_config))
+            except Exception as e_connect:
+                logger.error(f"Lỗi nghiêm trọng khi tự động kết nối lại server '{server_config.name}': {e_connect}", exc_info=True)
+                return server_config, False
+
+    results = {}
+    failed_ids = []
+    for next_result in asyncio.as_completed([reconnect(server_config) for server_config in server_configs]):
+        server_config, success = await next_result
+        results[server_config.id] = success
+        if success:
+            logger.info(f"Tự động kết nối lại thành công cho server '{server_config.name}'.")
+        else:
+            logger.warning(f"Tự động kết nối lại thất bại cho server '{server_config.name}'. "
+                           f"Sẽ cập nhật trạng thái DB thành 'ERROR'.")
+            failed_ids.append(server_config.id)
+
+    if failed_ids:
+        # Truy vấn DB không được chạy trực tiếp trên event loop
+        await asyncio.get_running_loop().run_in_executor(None, _mark_servers_error, app_instance, failed_ids)
+
+    logger.info(f"Hoàn tất tự động kết nối lại {len(server_configs)} server trong {time.perf_counter() - started:.1f}s: "
+                f"{len(server_configs) - len(failed_ids)} thành công, {len(failed_ids)} thất bại.")
+    return results
+
+
+def _mark_servers_error(app_instance, server_ids):
+    """Đặt connection_status='ERROR' cho các server (bỏ qua server đã được kết nối lại thủ công) trong một lần commit."""
+    server_ids = [server_id for server_id in server_ids if not is_server_connected(server_id)]
+    if not server_ids:
+        return
+    with app_instance.app_context():
+        try:
+            OpcServer.query.filter(OpcServer.id.in_(server_ids))\
+                           .update({OpcServer.connection_status: "ERROR"}, synchronize_session=False)
+            db.session.commit()
+            logger.info(f"Đã commit trạng thái 'ERROR' cho {len(server_ids)} server sau khi auto-reconnect.")
+        except Exception as e_commit:
+            db.session.rollback()
+            logger.error(f"Lỗi khi commit thay đổi trạng thái server sau auto-reconnect: {e_commit}", exc_info=True)
 
 # app/opcua_client.py
 import asyncio
 import logging
-import requests # Cần cho việc gọi API bên thứ 3
+import time
 
 from asyncua import Client as AsyncuaClient
 from asyncua import ua
 from asyncua.common.node import Node as AsyncuaNode
 
 # Các import từ app của bạn (đảm bảo chúng tồn tại và đúng đường dẫn)
-# from app import db # Sẽ cần nếu SubHandler hoặc các hàm khác cần truy cập DB trực tiếp
+# from app import db # Sẽ cần nếu MappingRoute hoặc các hàm khác cần truy cập DB trực tiếp
 # from app.models import SubscriptionMapping, OpcNode # Tương tự
 from async_worker import get_async_worker # Giả sử async_worker.py cùng cấp trong app
-
-# --- Logger Setup (Giữ nguyên hoặc điều chỉnh nếu cần) ---
+from app.delivery import delivery_pipeline # Hàng đợi + gửi theo lô tới API datapoint
+from app.iec104 import iec104_outstation, COT_PERIODIC # Xuất trực tiếp qua IEC 60870-5-104 theo ioa_mapping
+from app.change_log import change_log # Consumer pull các thay đổi theo seq qua GET /api/values
+from app.subscription_manager import subscription_manager, make_deadband_filter # Subscription dùng chung theo publishing interval
+from app import metrics # Bộ đếm thông báo cho /metrics
+from log_config import log_rate_limiter # Giới hạn log lặp lại theo mapping trên đường dữ liệu
+
+# --- Logger Setup ---
+# Không gắn handler riêng: record được chuyển lên logger 'app', ghi file/console qua QueueListener (log_config.py)
 logger = logging.getLogger(__name__)
-if not logger.handlers:
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.INFO)
 
 # --- Global Dictionaries (Giữ nguyên các dict đã có) ---
 active_clients = {}
@@ -758,108 +762,195 @@ browse_stop_flags = {}
 
 # Dictionary mới để lưu trữ các OPC UA subscription đang hoạt động
 # Key: mapping_id (ID từ bảng subscription_mappings trong DB)
-# Value: tuple (asyncua_subscription_object, monitored_item_handle, handler_instance)
+# Value: MappingRoute của mapping (cũng nằm trong bảng routes của SubscriptionGroup theo ClientHandle),
+# subscription dùng chung của (server, publishing interval) xem ở app/subscription_manager.py
 active_opcua_subscriptions = {}
+# IOA là địa chỉ của giá trị ở mọi đầu ra (API datapoint, IEC-104, /api/values) nhưng chỉ duy nhất trong một server
+# (UniqueConstraint server_id + ioa_mapping): mỗi IOA chỉ được một mapping đang hoạt động sử dụng.
+# Key: ioa_mapping, Value: mapping_id đang giữ IOA
+active_ioa_owners = {}
 
 # --- Các hàm đã có: get_server_security_params, connect_server, disconnect_server,
-# get_client_by_server_id, is_server_connected, _browse_recursive, start_server_browse,
+# get_client_by_server_id, is_server_connected, start_server_browse,
 # get_opcua_node_all_attributes, async_get_node_data_value ---
 # (Giữ nguyên các hàm này như phiên bản cuối cùng của chúng)
 
 
 # --- LỚP VÀ CÁC HÀM MỚI CHO SUBSCRIPTION ---
 
-class SubHandler:
+def _claim_ioa(mapping_id: int, ioa: int, server_id: int) -> bool:
+    """Giữ IOA cho mapping khi kích hoạt. False nếu mapping khác (của server khác) đang dùng IOA này."""
+    owner = active_ioa_owners.setdefault(ioa, mapping_id) # setdefault là nguyên tử dưới GIL giữa các shard
+    if owner != mapping_id:
+        logger.error(f"Không subscribe MappingID {mapping_id} (Server ID {server_id}): IOA {ioa} đang được "
+                     f"MappingID {owner} sử dụng. Mỗi IOA chỉ được gán cho một mapping đang hoạt động.")
+        return False
+    return True
+
+
+def _release_ioa(mapping_id: int, ioa: int):
+    if active_ioa_owners.get(ioa) == mapping_id and mapping_id not in active_opcua_subscriptions:
+        del active_ioa_owners[ioa]
+
+
+def pop_active_route(mapping_id: int):
+    """Gỡ route của mapping khỏi active_opcua_subscriptions và trả IOA. Trả về route, None nếu chưa subscribe."""
+    route = active_opcua_subscriptions.pop(mapping_id, None)
+    if route is not None:
+        _release_ioa(mapping_id, route.ioa_mapping)
+    return route
+
+
+_NO_VALUE = object() # Chưa có giá trị nào được chuyển đi (hoặc giá trị cuối đã mất hiệu lực do StatusCode xấu)
+
+
+_SERVER_LABELS = {} # server_id -> (server_id,), nhãn metrics dùng chung cho mọi route của server
+
+
+class MappingRoute:
     """
-    Xử lý các thông báo thay đổi dữ liệu từ OPC UA Subscription.
-    Mỗi monitored item sẽ có một instance của handler này.
+    Bản ghi định tuyến của một mapping trong bảng routes của SubscriptionGroup (theo ClientHandle).
+    SubscriptionGroup là handler duy nhất của subscription và gọi datachange() của route tương ứng;
+    __slots__ giữ mỗi mapping ở mức một bản ghi nhỏ, không có __dict__.
+    Deadband (report-by-exception) được server áp dụng qua DataChangeFilter; nếu server từ chối filter,
+    SubscriptionManager gọi use_client_side_filter() để route tự lọc. Heartbeat gửi lại giá trị cuối
+    khi không có thay đổi nào được chuyển đi trong heartbeat_interval_s giây.
     """
-    def __init__(self, mapping_id: int, ioa_mapping_value: int, node_id_str: str, server_id: int):
+    __slots__ = ("mapping_id", "ioa_mapping", "server_id", "node_id_str", "client_handle", "server_handle",
+                 "deadband_type", "deadband_value", "heartbeat_interval_s", "client_deadband", "needs_eu_range",
+                 "_last_value", "_last_sent", "_metric_labels", "_server_labels")
+
+    def __init__(self, mapping_id: int, ioa_mapping_value: int, node_id_str: str, server_id: int,
+                 deadband_type: str = "None", deadband_value: float = 0.0, heartbeat_interval_s: int = 0):
         self.mapping_id = mapping_id
         self.ioa_mapping = ioa_mapping_value
         self.node_id_str = node_id_str # NodeID của OPC UA node đang được theo dõi
         self.server_id = server_id # Server ID mà node này thuộc về
-        self.api_url = "http://localhost:5001/api/v1/datapoint-value" # API cố định
-        self.worker_loop = get_async_worker().loop # Lấy event loop từ AsyncWorker
+        self.client_handle = None # Gán bởi SubscriptionGroup.add_route
+        self.server_handle = None # MonitoredItemId do server cấp
+        self.deadband_type = deadband_type or "None"
+        self.deadband_value = deadband_value or 0.0
+        self.heartbeat_interval_s = heartbeat_interval_s or 0
+        self.client_deadband = None # Ngưỡng tuyệt đối lọc phía client, None: không lọc (hoặc server đã lọc)
+        self.needs_eu_range = False # Deadband Percent phía client: cần đọc EURange của node để tính ngưỡng
+        self._last_value = _NO_VALUE # Giá trị cuối đã chuyển tới delivery pipeline
+        self._last_sent = 0.0 # time.monotonic() của lần chuyển gần nhất (kể cả heartbeat)
+        self._metric_labels = (server_id, mapping_id) # Tạo sẵn để đếm thông báo không phải cấp phát
+        self._server_labels = _SERVER_LABELS.setdefault(server_id, (server_id,))
+
+    def data_filter(self):
+        """DataChangeFilter gửi kèm CreateMonitoredItems, None nếu mapping không dùng deadband."""
+        return make_deadband_filter(self.deadband_type, self.deadband_value)
+
+    def use_client_side_filter(self):
+        """Server không nhận DataChangeFilter: áp dụng deadband ở route."""
+        if self.deadband_type == "Absolute":
+            self.client_deadband = float(self.deadband_value)
+        elif self.deadband_type == "Percent":
+            self.needs_eu_range = True
+
+    async def resolve_eu_range(self, client: AsyncuaClient):
+        """Đổi deadband Percent thành ngưỡng tuyệt đối theo EURange của node (chỉ cho lọc phía client)."""
+        self.needs_eu_range = False
+        try:
+            eu_range_node = await client.get_node(self.node_id_str).get_child("0:EURange")
+            eu_range = await eu_range_node.read_value()
+            self.client_deadband = float(self.deadband_value) / 100.0 * abs(eu_range.High - eu_range.Low)
+        except Exception as e:
+            logger.warning(f"MappingRoute (MappingID: {self.mapping_id}): Không đọc được EURange của '{self.node_id_str}' "
+                           f"({e}), bỏ qua deadband Percent, mọi thay đổi đều được gửi.")
+
+    def _within_deadband(self, val) -> bool:
+        last = self._last_value
+        if (last is _NO_VALUE or isinstance(val, bool) or not isinstance(val, (int, float))
+                or isinstance(last, bool) or not isinstance(last, (int, float))):
+            return False
+        return abs(val - last) <= self.client_deadband
+
+    def invalidate(self):
+        """Giá trị cuối mất hiệu lực (mất session/subscription lỗi): không heartbeat, master IEC-104 nhận cờ IV."""
+        if self._last_value is _NO_VALUE:
+            return
+        self._last_value = _NO_VALUE
+        if iec104_outstation.running:
+            iec104_outstation.publish(self.ioa_mapping, None, good=False)
 
-    async def datachange_notification(self, node: AsyncuaNode, val, data):
+    def send_heartbeat(self, now: float):
+        """Gọi bởi task heartbeat của SubscriptionGroup mỗi HEARTBEAT_TICK_S."""
+        if self._last_value is _NO_VALUE or now - self._last_sent < self.heartbeat_interval_s:
+            return
+        self._last_sent = now
+        metrics.heartbeats.inc(self._server_labels)
+        if delivery_pipeline.enabled:
+            delivery_pipeline.submit(self.ioa_mapping, self._last_value)
+        if iec104_outstation.running:
+            iec104_outstation.publish(self.ioa_mapping, self._last_value, cot=COT_PERIODIC)
+
+    def datachange(self, val, data):
         """
-        Được gọi bởi asyncua khi có thay đổi dữ liệu.
-        'node': đối tượng asyncua.common.node.Node của item được monitor.
+        Được SubscriptionGroup gọi (đồng bộ, trên event loop của AsyncWorker) cho mỗi thay đổi dữ liệu.
         'val': giá trị mới của node.
-        'data': đối tượng DataChangeNotification.
+        'data': đối tượng DataChangeNotification của asyncua.
         """
+        metrics.notifications.inc(self._metric_labels)
         source_timestamp = data.monitored_item.Value.SourceTimestamp
         server_timestamp = data.monitored_item.Value.ServerTimestamp
         status_code = data.monitored_item.Value.StatusCode
 
-        logger.info(
-            f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
-            f"DataChange! Value={val}, StatusCode={status_code.name if status_code else 'N/A'}, "
-            f"SourceTs={source_timestamp}, ServerTs={server_timestamp}"
-        )
+        # Log trên đường dữ liệu: format lười (tham số %s) và mỗi loại log của một mapping tối đa một dòng
+        # trong LOG_RATE_LIMIT_INTERVAL_S, số thông báo bị bỏ được ghi kèm. Số lượng đầy đủ xem ở /metrics.
+        if logger.isEnabledFor(logging.DEBUG):
+            suppressed = log_rate_limiter.allow(("datachange", self.mapping_id))
+            if suppressed is not None:
+                logger.debug("MappingRoute (MappingID: %s, Node: %s): DataChange! Value=%s, StatusCode=%s, "
+                             "SourceTs=%s, ServerTs=%s (bỏ qua %d thông báo trước đó)",
+                             self.mapping_id, self.node_id_str, val, status_code.name if status_code else 'N/A',
+                             source_timestamp, server_timestamp, suppressed)
+
+        # Cập nhật cache giá trị cuối (kể cả StatusCode xấu) để route đọc giá trị không cần Read lại server
+        value_cache.update(self.server_id, self.node_id_str, val, status_code, source_timestamp, server_timestamp)
 
         if status_code and not status_code.is_good():
-            logger.warning(
-                f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
-                f"Nhận được DataChange với StatusCode không tốt: {status_code.name}. Không gọi API."
-            )
+            self._last_value = _NO_VALUE # Không heartbeat giá trị cũ khi chất lượng xấu
+            if change_log.enabled:
+                change_log.append(self.ioa_mapping, self.mapping_id, val, status_code.name,
+                                  source_timestamp.timestamp() if source_timestamp else None)
+            if iec104_outstation.running: # Master IEC-104 nhận cờ IV thay vì giữ giá trị cũ như còn hợp lệ
+                iec104_outstation.publish(self.ioa_mapping, val, good=False,
+                                          source_ts=source_timestamp.timestamp() if source_timestamp else None)
+            suppressed = log_rate_limiter.allow(("bad_status", self.mapping_id))
+            if suppressed is not None:
+                logger.warning("MappingRoute (MappingID: %s, Node: %s): Nhận được DataChange với StatusCode không tốt: %s. "
+                               "Không gọi API. (bỏ qua %d thông báo tương tự trước đó)",
+                               self.mapping_id, self.node_id_str, status_code.name, suppressed)
             return
 
-        payload = {
-            "ioa": self.ioa_mapping,
-            "value": val
-        }
-
-        try:
-            logger.debug(f"SubHandler (MappingID: {self.mapping_id}): Gọi API '{self.api_url}' với payload: {payload}")
-            headers = {'Content-Type': 'application/json'}
-            # Thực hiện lời gọi API (blocking) trong một executor để không chặn event loop
-            response = await self.worker_loop.run_in_executor(
-                None,  # Sử dụng ThreadPoolExecutor mặc định của loop
-                lambda: requests.put(self.api_url, data=json.dumps(payload), headers=headers,timeout=10) # Sử dụng PUT
-            )
-            
-            # response = requests.put(self.api_url, headers=headers, json=payload)
-            logger.info(
-                f"SubHandler (MappingID: {self.mapping_id}): Gọi API thành công. "
-                f"Status: {response.status_code}, Response (100 chars): {response.text[:100]}"
-            )
-            if response.status_code >= 300: # 3xx, 4xx, 5xx là các mã lỗi hoặc redirect không mong muốn
-                 logger.warning(
-                     f"SubHandler (MappingID: {self.mapping_id}): API trả về mã lỗi: "
-                     f"{response.status_code} - {response.text}"
-                 )
-
-        except requests.exceptions.Timeout:
-            logger.error(
-                f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
-                f"Timeout khi gọi API: {self.api_url}", exc_info=False # Không cần full traceback cho timeout
-            )
-        except requests.exceptions.RequestException as req_e:
-            logger.error(
-                f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
-                f"Lỗi RequestException khi gọi API: {req_e}", exc_info=True
-            )
-        except Exception as e:
-            logger.error(
-                f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
-                f"Lỗi không xác định khi gọi API: {e}", exc_info=True
-            )
+        if self.client_deadband is not None and self._within_deadband(val):
+            metrics.deadband_suppressed.inc(self._server_labels)
+            return
+        self._last_value = val
+        self._last_sent = time.monotonic()
 
-    def event_notification(self, event):
-        """Được gọi bởi asyncua khi có thông báo event (ít dùng cho data change đơn giản)."""
-        logger.info(
-            f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
-            f"Event Notification: {event}"
-        )
+        source_ts = source_timestamp.timestamp() if source_timestamp else None
+        # Không gọi API trực tiếp ở đây: chỉ đưa vào hàng đợi của delivery pipeline,
+        # pipeline sẽ gom lô và gửi qua connection pool keep-alive (xem app/delivery.py).
+        if delivery_pipeline.enabled and not delivery_pipeline.submit(self.ioa_mapping, val, source_ts):
+            logger.debug("MappingRoute (MappingID: %s): Không đưa được giá trị vào hàng đợi delivery.", self.mapping_id)
+        if iec104_outstation.running: # Outstation gom giá trị thành ASDU trên thread riêng (app/iec104.py)
+            iec104_outstation.publish(self.ioa_mapping, val, source_ts=source_ts)
+        if change_log.enabled:
+            change_log.append(self.ioa_mapping, self.mapping_id, val, None, source_ts)
 
 
 async def actual_subscribe_opcua_node(server_id: int, node_id_str: str, ioa_value: int,
                                     sampling_ms: int, publishing_ms: int,
-                                    mapping_db_id: int): # mapping_db_id để theo dõi và làm key
+                                    mapping_db_id: int, # mapping_db_id để theo dõi và làm key
+                                    deadband_type: str = "None", deadband_value: float = 0.0,
+                                    heartbeat_interval_s: int = 0):
     """
     Thực hiện việc tạo subscription và monitored item cho một mapping cụ thể.
+    deadband_type/deadband_value: deadband của mapping ('None', 'Absolute', 'Percent'),
+    heartbeat_interval_s: gửi lại giá trị cuối sau chừng này giây không thay đổi (0: tắt).
     """
     global active_opcua_subscriptions
     
@@ -876,41 +967,44 @@ async def actual_subscribe_opcua_node(server_id: int, node_id_str: str, ioa_valu
     if not client:
         logger.error(f"Không thể subscribe node '{node_id_str}': Server ID {server_id} chưa kết nối.")
         return False
+    if not _claim_ioa(mapping_db_id, ioa_value, server_id):
+        return False
 
     try:
         ua_node_to_subscribe = client.get_node(node_id_str)
         if not ua_node_to_subscribe: # Kiểm tra thêm
             logger.error(f"Không thể lấy đối tượng ua.Node cho '{node_id_str}' trên server ID {server_id}.")
+            _release_ioa(mapping_db_id, ioa_value)
             return False
             
-        # Tạo handler, truyền các thông tin cần thiết
-        handler_instance = SubHandler(mapping_id=mapping_db_id,
-                                      ioa_mapping_value=ioa_value,
-                                      node_id_str=node_id_str,
-                                      server_id=server_id)
+        # Tạo route của mapping, truyền các thông tin cần thiết
+        route = MappingRoute(mapping_id=mapping_db_id,
+                             ioa_mapping_value=ioa_value,
+                             node_id_str=node_id_str,
+                             server_id=server_id,
+                             deadband_type=deadband_type,
+                             deadband_value=deadband_value,
+                             heartbeat_interval_s=heartbeat_interval_s)
         
-        # Tạo subscription object trên server
-        # period là publishing interval (tính bằng ms)
-        subscription = await client.create_subscription(period=publishing_ms, handler=handler_instance)
-        logger.info(
-            f"Đã tạo subscription object trên server cho MappingID {mapping_db_id}. "
-            f"SubId: {subscription.subscription_id}, Period: {publishing_ms}ms"
-        )
-
-        # Thêm Monitored Item vào subscription
-        # sampling_interval (tính bằng ms)
-        monitored_item_handle = await subscription.subscribe_data_change(
-            nodes=ua_node_to_subscribe, # Có thể truyền một node hoặc list các node
-            attr=ua.AttributeIds.Value,
-            queuesize=1, 
-            sampling_interval=sampling_ms # asyncua v0.9.93+ chấp nhận ms trực tiếp
+        # Thêm Monitored Item vào subscription dùng chung của (server, publishing interval),
+        # subscription chỉ được tạo trên server khi gặp publishing interval mới.
+        # sampling_interval (tính bằng ms) vẫn là riêng của từng mapping.
+        subscription, monitored_item_handle = await subscription_manager.add_mapping(
+            client, server_id, mapping_db_id, node_id_str,
+            sampling_interval_ms=sampling_ms,
+            publishing_interval_ms=publishing_ms,
+            route=route,
+            data_filter=route.data_filter()
         )
+        if route.needs_eu_range:
+            await route.resolve_eu_range(client)
         logger.info(
             f"Đã subscribe DataChange cho node '{node_id_str}' (MappingID: {mapping_db_id}). "
-            f"Handle: {monitored_item_handle}. Sampling: {sampling_ms}ms"
+            f"SubId: {subscription.subscription_id}, Handle: {monitored_item_handle}. "
+            f"Sampling: {sampling_ms}ms, Publishing: {publishing_ms}ms"
         )
         
-        active_opcua_subscriptions[mapping_db_id] = (subscription, monitored_item_handle, handler_instance)
+        active_opcua_subscriptions[mapping_db_id] = route
         return True
         
     except ua.UaStatusCodeError as e_status:
@@ -923,6 +1017,7 @@ async def actual_subscribe_opcua_node(server_id: int, node_id_str: str, ioa_valu
             f"Lỗi không xác định khi subscribe node '{node_id_str}' (MappingID: {mapping_db_id}): {e}",
             exc_info=True
         )
+    _release_ioa(mapping_db_id, ioa_value)
     return False
 
 
@@ -934,14 +1029,10 @@ async def unsubscribe_from_mapping(mapping_id: int):
     logger.info(f"Attempting to unsubscribe MappingID: {mapping_id}")
 
     if mapping_id in active_opcua_subscriptions:
-        subscription_obj, monitored_item_handle, _ = active_opcua_subscriptions.pop(mapping_id)
+        iec104_outstation.forget(pop_active_route(mapping_id).ioa_mapping)
         try:
-            if monitored_item_handle and subscription_obj:
-                logger.info(f"Unsubscribing monitored item (handle: {monitored_item_handle}) for MappingID {mapping_id}.")
-                await subscription_obj.unsubscribe(monitored_item_handle)
-            if subscription_obj:
-                logger.info(f"Deleting subscription object (SubId: {subscription_obj.subscription_id}) for MappingID {mapping_id}.")
-                await subscription_obj.delete()
+            # Chỉ xóa monitored item của mapping; subscription dùng chung chỉ bị xóa khi không còn item nào
+            await subscription_manager.remove_mapping(mapping_id)
             logger.info(f"Đã hủy subscription thành công cho MappingID {mapping_id}.")
             return True
         except ua.UaError as e_ua:
@@ -954,111 +1045,289 @@ async def unsubscribe_from_mapping(mapping_id: int):
         logger.warning(f"Không tìm thấy active OPC UA subscription cho MappingID {mapping_id} để unsubscribe.")
         return True # Không có gì để làm, coi như thành công
     
-def subscribe_all_active_mappings_runtime(app_instance_for_context): # Cần app_context để query DB
+# Cache OperationLimits của từng server (server_id -> dict), bị xóa khi ngắt kết nối server
+server_operation_limits = {}
+# Dùng khi server không công bố giới hạn (giá trị 0 theo chuẩn nghĩa là "không giới hạn")
+DEFAULT_MAX_ITEMS_PER_CALL = 1000
+
+_OPERATION_LIMIT_NODES = {
+    "max_nodes_per_read": ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead,
+    "max_nodes_per_browse": ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerBrowse,
+    "max_monitored_items_per_call": ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxMonitoredItemsPerCall,
+}
+
+
+async def get_server_operation_limits(server_id: int) -> dict:
+    """
+    Đọc (một lần, có cache) các OperationLimits của server trong một request Read duy nhất.
+    Giá trị 0, không đọc được hoặc server không hỗ trợ sẽ được thay bằng DEFAULT_MAX_ITEMS_PER_CALL.
+    """
+    if server_id in server_operation_limits:
+        return server_operation_limits[server_id]
+
+    limits = {name: DEFAULT_MAX_ITEMS_PER_CALL for name in _OPERATION_LIMIT_NODES}
+    client = get_client_by_server_id(server_id)
+    if not client:
+        return limits
+
+    try:
+        params = ua.ReadParameters()
+        for object_id in _OPERATION_LIMIT_NODES.values():
+            rv = ua.ReadValueId()
+            rv.NodeId = ua.NodeId(object_id, 0)
+            rv.AttributeId = ua.AttributeIds.Value
+            params.NodesToRead.append(rv)
+        results = await client.uaclient.read(params)
+        for name, data_value in zip(_OPERATION_LIMIT_NODES, results):
+            value = data_value.Value.Value if data_value.Value else None
+            if data_value.StatusCode.is_good() and isinstance(value, int) and value > 0:
+                limits[name] = value
+    except Exception as e:
+        logger.warning(f"Không đọc được OperationLimits của Server ID {server_id}, dùng giá trị mặc định: {e}")
+
+    logger.info(f"OperationLimits của Server ID {server_id}: {limits}")
+    server_operation_limits[server_id] = limits
+    return limits
+
+
+async def bulk_subscribe_server_mappings(server_id: int, mapping_specs):
+    """
+    Subscribe nhiều mapping của cùng một server: CreateMonitoredItems được gửi theo chunk
+    không vượt quá MaxMonitoredItemsPerCall của server.
+    mapping_specs: list dict {mapping_id, node_id_str, ioa, sampling_ms, publishing_ms}
+    và tùy chọn deadband_type, deadband_value, heartbeat_interval_s.
+    Trả về (success_count, failed_count, chunk_timings).
+    """
+    client = get_client_by_server_id(server_id)
+    if not client:
+        logger.error(f"Không thể subscribe {len(mapping_specs)} mapping: Server ID {server_id} chưa kết nối.")
+        return 0, len(mapping_specs), []
+
+    limits = await get_server_operation_limits(server_id)
+    items = []
+    conflict_count = 0
+    for spec in mapping_specs:
+        if not _claim_ioa(spec["mapping_id"], spec["ioa"], server_id):
+            conflict_count += 1
+            continue
+        route = MappingRoute(mapping_id=spec["mapping_id"],
+                             ioa_mapping_value=spec["ioa"],
+                             node_id_str=spec["node_id_str"],
+                             server_id=server_id,
+                             deadband_type=spec.get("deadband_type"),
+                             deadband_value=spec.get("deadband_value"),
+                             heartbeat_interval_s=spec.get("heartbeat_interval_s"))
+        items.append((spec["mapping_id"], spec["node_id_str"], spec["sampling_ms"], spec["publishing_ms"],
+                      route, route.data_filter()))
+
+    if not items:
+        return 0, conflict_count, []
+    try:
+        results, chunk_timings = await subscription_manager.add_mappings(
+            client, server_id, items, max_items_per_call=limits["max_monitored_items_per_call"]
+        )
+    except BaseException:
+        for mapping_id, _, _, _, route, _ in items:
+            _release_ioa(mapping_id, route.ioa_mapping)
+        raise
+    pending_eu_range = [item[4] for item in items if item[4].needs_eu_range]
+    if pending_eu_range:
+        await asyncio.gather(*(route.resolve_eu_range(client) for route in pending_eu_range))
+
+    success_count = 0
+    failed_count = conflict_count
+    for mapping_id, node_id_str, _, _, route, _ in items:
+        result = results.get(mapping_id)
+        if isinstance(result, int) and not isinstance(result, bool):
+            active_opcua_subscriptions[mapping_id] = route
+            success_count += 1
+        else:
+            reason = result.name if isinstance(result, ua.StatusCode) else result
+            logger.error(f"Subscribe thất bại cho node '{node_id_str}' (MappingID: {mapping_id}): {reason}")
+            _release_ioa(mapping_id, route.ioa_mapping)
+            failed_count += 1
+
+    logger.info(f"Bulk subscribe Server ID {server_id}: {success_count} thành công, {failed_count} thất bại, "
+                f"{len(chunk_timings)} chunk (tối đa {limits['max_monitored_items_per_call']} item/chunk).")
+    return success_count, failed_count, chunk_timings
+
+
+async def bulk_unsubscribe_mappings(mapping_ids):
+    """
+    Hủy nhiều mapping cùng lúc: subscription dùng chung không còn item nào bị xóa bằng DeleteSubscriptions
+    (một request cho mỗi server), các subscription còn lại dùng DeleteMonitoredItems theo chunk.
+    Trả về (success_count, failed_count, chunk_timings).
+    """
+    routes = [pop_active_route(m) for m in mapping_ids]
+    mapping_ids = [route.mapping_id for route in routes if route is not None]
+    for route in routes:
+        if route is not None:
+            iec104_outstation.forget(route.ioa_mapping)
+    if not mapping_ids:
+        return 0, 0, []
+
+    ids_by_server = {} # Mỗi server được gỡ trên shard của nó
+    for mapping_id in mapping_ids:
+        group_key = subscription_manager.mapping_groups.get(mapping_id)
+        ids_by_server.setdefault(group_key[0] if group_key else None, []).append(mapping_id)
+
+    worker = get_async_worker()
+    server_ids = list(ids_by_server)
+    outcomes = await asyncio.gather(
+        *(worker.call_on_shard(server_id, _unsubscribe_server_mappings(server_id, ids_by_server[server_id]))
+          for server_id in server_ids),
+        return_exceptions=True
+    )
+
+    failed_count = 0
+    chunk_timings = []
+    for server_id, outcome in zip(server_ids, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Lỗi khi bulk unsubscribe cho Server ID {server_id}: {outcome}", exc_info=outcome)
+            failed_count += len(ids_by_server[server_id])
+            continue
+        results, server_timings = outcome
+        # Mapping không còn trong subscription_manager (False) vẫn coi như đã hủy xong
+        failed_count += sum(1 for result in results.values() if isinstance(result, Exception))
+        chunk_timings.extend(server_timings)
+    return len(mapping_ids) - failed_count, failed_count, chunk_timings
+
+
+async def _unsubscribe_server_mappings(server_id, mapping_ids):
+    max_items_per_call = DEFAULT_MAX_ITEMS_PER_CALL
+    if server_id is not None:
+        limits = await get_server_operation_limits(server_id)
+        max_items_per_call = limits["max_monitored_items_per_call"]
+    return await subscription_manager.remove_mappings(mapping_ids, max_items_per_call=max_items_per_call)
+
+
+async def _bulk_subscribe_all_servers(specs_by_server):
+    """Chạy bulk subscribe cho các server song song trên event loop của AsyncWorker."""
+    worker = get_async_worker()
+    server_ids = list(specs_by_server.keys())
+    outcomes = await asyncio.gather(
+        *(worker.call_on_shard(server_id, bulk_subscribe_server_mappings(server_id, specs_by_server[server_id]))
+          for server_id in server_ids),
+        return_exceptions=True
+    )
+    return dict(zip(server_ids, outcomes))
+
+
+def subscribe_all_active_mappings_runtime(app_instance_for_context, timeout_s: float = None): # Cần app_context để query DB
     """
     Thử subscribe tất cả các SubscriptionMapping đang có is_active = True trong CSDL
     và server tương ứng đang kết nối, mà chưa có subscription runtime.
-    Hàm này là đồng bộ, nó sẽ điều phối các coroutine qua AsyncWorker.
+    Các mapping được gom theo server và subscribe theo lô trong một lần gọi AsyncWorker,
+    các server chạy song song. Ngoài các bộ đếm, kết quả có thêm chunk_timings và elapsed_s.
+    timeout_s: deadline của cả lần gọi AsyncWorker (ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S), None: mặc định của worker.
     """
     logger.info("Bắt đầu quá trình 'Subscribe All Active Mappings'.")
+    started = time.perf_counter()
     subscribed_count = 0
     failed_count = 0
     already_subscribed_count = 0
     server_not_connected_count = 0
+    chunk_timings = []
 
     try:
         with app_instance_for_context.app_context(): # Đảm bảo có app context
-            active_mappings_in_db = SubscriptionMapping.query.filter_by(is_active=True).all()
-
-            if not active_mappings_in_db:
-                logger.info("Không có mapping nào được đánh dấu 'is_active=True' trong CSDL.")
-                return {"total": 0, "success": 0, "failed": 0, "skipped_already_subscribed":0, "skipped_server_disconnected":0}
-
-            worker = get_async_worker()
-            if not worker.loop or not worker.loop.is_running():
-                logger.error("AsyncWorker không chạy, không thể thực hiện 'Subscribe All'.")
-                return {"error": "AsyncWorker not running"}
-
-            for mapping in active_mappings_in_db:
-                if mapping.id in active_opcua_subscriptions:
-                    logger.info(f"Mapping ID {mapping.id} (IOA: {mapping.ioa_mapping}) đã được subscribe runtime. Bỏ qua.")
-                    already_subscribed_count += 1
+            # Một query duy nhất lấy luôn node của mapping, tránh lazy-load từng mapping.opc_node
+            rows = (db.session.query(SubscriptionMapping.id, SubscriptionMapping.server_id,
+                                     SubscriptionMapping.ioa_mapping, SubscriptionMapping.sampling_interval_ms,
+                                     SubscriptionMapping.publishing_interval_ms,
+                                     SubscriptionMapping.deadband_type, SubscriptionMapping.deadband_value,
+                                     SubscriptionMapping.heartbeat_interval_s,
+                                     OpcNode.node_id_string, OpcNode.node_class_str)
+                    .outerjoin(OpcNode, SubscriptionMapping.opc_node_db_id == OpcNode.id)
+                    .filter(SubscriptionMapping.is_active == True)
+                    .all())
+
+        if not rows:
+            logger.info("Không có mapping nào được đánh dấu 'is_active=True' trong CSDL.")
+            return {"total": 0, "success": 0, "failed": 0, "skipped_already_subscribed":0, "skipped_server_disconnected":0,
+                    "chunk_timings": [], "elapsed_s": 0.0}
+
+        worker = get_async_worker()
+        if not worker.loop or not worker.loop.is_running():
+            logger.error("AsyncWorker không chạy, không thể thực hiện 'Subscribe All'.")
+            return {"error": "AsyncWorker not running"}
+
+        specs_by_server = {}
+        for (mapping_id, server_id, ioa, sampling_ms, publishing_ms, deadband_type, deadband_value, heartbeat_interval_s,
+             node_id_str, node_class_str) in rows:
+            if mapping_id in active_opcua_subscriptions:
+                already_subscribed_count += 1
+                continue
+            if not is_server_connected(server_id):
+                server_not_connected_count += 1
+                continue
+            if not node_id_str or node_class_str != ua.NodeClass.Variable.name:
+                logger.warning(f"Mapping ID {mapping_id} trỏ đến node không hợp lệ hoặc không phải Variable. Bỏ qua.")
+                failed_count += 1 # Coi như một lỗi cấu hình
+                continue
+            specs_by_server.setdefault(server_id, []).append({
+                "mapping_id": mapping_id, "node_id_str": node_id_str, "ioa": ioa,
+                "sampling_ms": sampling_ms, "publishing_ms": publishing_ms,
+                "deadband_type": deadband_type, "deadband_value": deadband_value,
+                "heartbeat_interval_s": heartbeat_interval_s,
+            })
+
+        if already_subscribed_count:
+            logger.info(f"{already_subscribed_count} mapping đã được subscribe runtime. Bỏ qua.")
+        if server_not_connected_count:
+            logger.warning(f"{server_not_connected_count} mapping thuộc server chưa kết nối. Bỏ qua subscribe.")
+
+        if specs_by_server:
+            outcomes = worker.run_coroutine(_bulk_subscribe_all_servers(specs_by_server), timeout=timeout_s)
+            for server_id, outcome in outcomes.items():
+                if isinstance(outcome, Exception):
+                    logger.error(f"Lỗi khi bulk subscribe cho Server ID {server_id}: {outcome}", exc_info=outcome)
+                    failed_count += len(specs_by_server[server_id])
                     continue
+                server_success, server_failed, server_timings = outcome
+                subscribed_count += server_success
+                failed_count += server_failed
+                chunk_timings.extend(server_timings)
 
-                if not is_server_connected(mapping.server_id):
-                    logger.warning(f"Server ID {mapping.server_id} cho Mapping ID {mapping.id} (IOA: {mapping.ioa_mapping}) chưa kết nối. Bỏ qua subscribe.")
-                    server_not_connected_count +=1
-                    continue
-                
-                opc_node = mapping.opc_node # Sử dụng relationship đã có
-                if not opc_node or opc_node.node_class_str != ua.NodeClass.Variable.name:
-                    logger.warning(f"Mapping ID {mapping.id} trỏ đến node không hợp lệ hoặc không phải Variable. Bỏ qua.")
-                    failed_count += 1 # Coi như một lỗi cấu hình
-                    continue
-                
-                logger.info(f"Đang thử subscribe cho Mapping ID {mapping.id} (IOA: {mapping.ioa_mapping})...")
-                try:
-                    success = worker.run_coroutine(
-                        actual_subscribe_opcua_node(
-                            server_id=mapping.server_id,
-                            node_id_str=opc_node.node_id_string,
-                            ioa_value=mapping.ioa_mapping,
-                            sampling_ms=mapping.sampling_interval_ms,
-                            publishing_ms=mapping.publishing_interval_ms,
-                            mapping_db_id=mapping.id
-                        )
-                    )
-                    if success:
-                        subscribed_count += 1
-                    else:
-                        failed_count += 1
-                except Exception as e_sub:
-                    logger.error(f"Lỗi khi subscribe cho Mapping ID {mapping.id}: {e_sub}", exc_info=True)
-                    failed_count += 1
-            
-            logger.info(f"'Subscribe All Active Mappings' hoàn tất. Thành công: {subscribed_count}, Thất bại: {failed_count}, Đã sub từ trước: {already_subscribed_count}, Server chưa kết nối: {server_not_connected_count}")
-            return {"total": len(active_mappings_in_db), "success": subscribed_count, "failed": failed_count, "skipped_already_subscribed": already_subscribed_count, "skipped_server_disconnected": server_not_connected_count}
+        elapsed_s = round(time.perf_counter() - started, 3)
+        logger.info(f"'Subscribe All Active Mappings' hoàn tất trong {elapsed_s}s. Thành công: {subscribed_count}, Thất bại: {failed_count}, Đã sub từ trước: {already_subscribed_count}, Server chưa kết nối: {server_not_connected_count}")
+        return {"total": len(rows), "success": subscribed_count, "failed": failed_count, "skipped_already_subscribed": already_subscribed_count, "skipped_server_disconnected": server_not_connected_count,
+                "chunk_timings": chunk_timings, "elapsed_s": elapsed_s}
 
     except Exception as e:
         logger.error(f"Lỗi nghiêm trọng trong quá trình 'Subscribe All Active Mappings': {e}", exc_info=True)
         return {"error": str(e)}
 
 
-def unsubscribe_all_runtime_subscriptions_opcua(): # Không cần app_context vì chỉ thao tác với active_opcua_subscriptions và worker
+def unsubscribe_all_runtime_subscriptions_opcua(timeout_s: float = None): # Không cần app_context vì chỉ thao tác với active_opcua_subscriptions và worker
     """
-    Hủy tất cả các OPC UA subscription đang hoạt động trong active_opcua_subscriptions.
-    Hàm này là đồng bộ, nó sẽ điều phối các coroutine qua AsyncWorker.
+    Hủy tất cả các OPC UA subscription đang hoạt động trong active_opcua_subscriptions,
+    dùng DeleteSubscriptions/DeleteMonitoredItems theo lô trong một lần gọi AsyncWorker.
+    timeout_s: deadline của lần gọi AsyncWorker (ASYNC_BULK_SUBSCRIPTION_TIMEOUT_S), None: mặc định của worker.
     """
     logger.info("Bắt đầu quá trình 'Unsubscribe All Runtime Subscriptions'.")
-    unsubscribed_count = 0
-    failed_count = 0
-    
-    # Sao chép danh sách keys vì dictionary sẽ thay đổi trong vòng lặp
+    started = time.perf_counter()
+
     mapping_ids_to_unsubscribe = list(active_opcua_subscriptions.keys())
 
     if not mapping_ids_to_unsubscribe:
         logger.info("Không có subscription runtime nào đang hoạt động để hủy.")
-        return {"total_runtime": 0, "success": 0, "failed": 0}
+        return {"total_runtime_before": 0, "success": 0, "failed": 0, "chunk_timings": [], "elapsed_s": 0.0}
 
     worker = get_async_worker()
     if not worker.loop or not worker.loop.is_running():
         logger.error("AsyncWorker không chạy, không thể thực hiện 'Unsubscribe All'.")
         return {"error": "AsyncWorker not running"}
 
-    for mapping_id in mapping_ids_to_unsubscribe:
-        logger.info(f"Đang thử unsubscribe cho Mapping ID {mapping_id}...")
-        try:
-            success = worker.run_coroutine(unsubscribe_from_mapping(mapping_id))
-            if success:
-                unsubscribed_count += 1
-            else:
-                failed_count += 1
-        except Exception as e_unsub:
-            logger.error(f"Lỗi khi unsubscribe cho Mapping ID {mapping_id}: {e_unsub}", exc_info=True)
-            failed_count += 1
-            # active_opcua_subscriptions[mapping_id] có thể vẫn còn nếu run_coroutine lỗi trước khi pop
-            # nhưng unsubscribe_from_mapping đã pop nó ra rồi.
-
-    logger.info(f"'Unsubscribe All Runtime Subscriptions' hoàn tất. Thành công: {unsubscribed_count}, Thất bại: {failed_count}, Tổng số đã thử: {len(mapping_ids_to_unsubscribe)}")
-    return {"total_runtime_before": len(mapping_ids_to_unsubscribe), "success": unsubscribed_count, "failed": failed_count}
-
+    try:
+        unsubscribed_count, failed_count, chunk_timings = worker.run_coroutine(
+            bulk_unsubscribe_mappings(mapping_ids_to_unsubscribe), timeout=timeout_s
+        )
+    except Exception as e_unsub:
+        logger.error(f"Lỗi khi bulk unsubscribe {len(mapping_ids_to_unsubscribe)} mapping: {e_unsub}", exc_info=True)
+        return {"error": str(e_unsub)}
+
+    elapsed_s = round(time.perf_counter() - started, 3)
+    logger.info(f"'Unsubscribe All Runtime Subscriptions' hoàn tất trong {elapsed_s}s. Thành công: {unsubscribed_count}, Thất bại: {failed_count}, Tổng số đã thử: {len(mapping_ids_to_unsubscribe)}")
+    return {"total_runtime_before": len(mapping_ids_to_unsubscribe), "success": unsubscribed_count, "failed": failed_count,
+            "chunk_timings": chunk_timings, "elapsed_s": elapsed_s}
@@ -0,0 +1,186 @@
+# app/outbox.py
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RETENTION_SCAN_ROWS = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY,
+    ioa INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    source_ts REAL
+);
+CREATE TABLE IF NOT EXISTS outbox_offsets (
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+"""
+
+
+class DeliveryOutbox:
+    """
+    Outbox chỉ-ghi-thêm trên đĩa (SQLite, journal WAL) cho delivery pipeline.
+    Mỗi giá trị được gán một seq tăng dần và commit theo nhóm (một transaction cho cả lô) trước khi gửi.
+    delivered_seq là offset đã được API xác nhận: mọi seq <= offset này không cần gửi lại. maintain() lưu offset
+    vào bảng outbox_offsets (cùng transaction với việc xóa các giá trị đã gửi), nên sau khi tiến trình chết
+    các giá trị chưa xác nhận được gửi lại (at-least-once, API có thể nhận trùng một số giá trị).
+    Chỉ thread writer của pipeline được gọi append()/maintain()/close(); ack() gọi từ thread nào cũng được.
+    """
+    def __init__(self, path: str, max_rows: int = 5000000, retention_s: float = 7 * 24 * 3600,
+                 synchronous: str = "NORMAL"):
+        self.path = path
+        self.max_rows = max_rows # Số giá trị chưa gửi tối đa, vượt thì bỏ các giá trị cũ nhất
+        self.retention_s = retention_s # Giá trị chưa gửi được quá thời gian này thì bị bỏ
+        self.synchronous = synchronous # NORMAL: an toàn khi tiến trình chết; FULL: an toàn cả khi mất điện
+
+        self.last_seq = 0 # seq lớn nhất đã commit
+        self.delivered_seq = 0
+        self._persisted_seq = 0 # delivered_seq đã ghi xuống bảng outbox_offsets
+        self._acked = {} # seq đầu -> seq cuối của các lô đã xác nhận nhưng chưa liền với delivered_seq
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._conn = None
+
+    def connect(self) -> sqlite3.Connection:
+        """Mở một connection mới (mỗi thread dùng connection riêng)."""
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self.connect()
+        conn.executescript(_SCHEMA)
+        row = conn.execute("SELECT seq FROM outbox_offsets WHERE name = 'delivered'").fetchone()
+        delivered_seq = row[0] if row else 0
+        max_seq = conn.execute("SELECT MAX(seq) FROM outbox").fetchone()[0] or 0
+        with self._lock:
+            self.delivered_seq = self._persisted_seq = delivered_seq
+            self.last_seq = max(max_seq, delivered_seq)
+            self._acked = {}
+        self._conn = conn
+        if self.backlog():
+            logger.warning(f"Outbox {self.path}: còn {self.backlog()} giá trị chưa gửi từ lần chạy trước, sẽ gửi lại.")
+        else:
+            logger.info(f"Outbox {self.path} đã mở (offset đã gửi: {delivered_seq}).")
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._persist_offset()
+        finally:
+            self._conn.close()
+            self._conn = None
+
+    def backlog(self) -> int:
+        """Số giá trị đã ghi vào outbox nhưng chưa được API xác nhận."""
+        return self.last_seq - self.delivered_seq
+
+    def append(self, items):
+        """
+        Ghi một lô item (ioa, value, enqueued_monotonic, source_ts) trong một transaction (group commit).
+        Trả về (seq đầu, seq cuối).
+        """
+        wall_offset = time.time() - time.monotonic()
+        first_seq = self.last_seq + 1
+        rows = [(first_seq + i, ioa, json.dumps(value, default=str), enqueued + wall_offset, source_ts)
+                for i, (ioa, value, enqueued, source_ts) in enumerate(items)]
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany("INSERT INTO outbox (seq, ioa, value, enqueued_at, source_ts) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        last_seq = first_seq + len(rows) - 1
+        with self._committed:
+            self.last_seq = last_seq
+            self._committed.notify_all()
+        return first_seq, last_seq
+
+    def wait_for_rows(self, after_seq: int, timeout: float) -> bool:
+        """Chờ tới khi có giá trị với seq > after_seq được commit."""
+        with self._committed:
+            return self._committed.wait_for(lambda: self.last_seq > after_seq, timeout)
+
+    @staticmethod
+    def read_after(conn: sqlite3.Connection, after_seq: int, limit: int):
+        """Các giá trị có seq > after_seq theo thứ tự: list (seq, ioa, value, enqueued_at, source_ts)."""
+        rows = conn.execute("SELECT seq, ioa, value, enqueued_at, source_ts FROM outbox WHERE seq > ? ORDER BY seq LIMIT ?",
+                            (after_seq, limit)).fetchall()
+        return [(seq, ioa, json.loads(value), enqueued_at, source_ts) for seq, ioa, value, enqueued_at, source_ts in rows]
+
+    def ack(self, first_seq: int, last_seq: int):
+        """Đánh dấu các seq từ first_seq tới last_seq đã được API xác nhận."""
+        with self._lock:
+            if first_seq > self.delivered_seq + 1:
+                self._acked[first_seq] = last_seq # Lô gửi song song xong trước lô trước nó
+                return
+            self.delivered_seq = max(self.delivered_seq, last_seq)
+            self._advance_locked()
+
+    def _advance_locked(self):
+        # Nhập các lô đã xác nhận nối tiếp (hoặc chồng lên) delivered_seq
+        while True:
+            joined = [first for first in self._acked if first <= self.delivered_seq + 1]
+            if not joined:
+                return
+            for first in joined:
+                self.delivered_seq = max(self.delivered_seq, self._acked.pop(first))
+
+    def maintain(self) -> int:
+        """
+        Ghi offset, xóa các giá trị đã gửi và áp dụng retention/giới hạn số giá trị chưa gửi.
+        Trả về số giá trị chưa gửi bị bỏ.
+        """
+        dropped = 0
+        drop_until = 0
+        if self.retention_s:
+            # Chỉ xét RETENTION_SCAN_ROWS giá trị cũ nhất mỗi lần để không quét cả backlog lớn
+            row = self._conn.execute("SELECT MAX(seq) FROM (SELECT seq, enqueued_at FROM outbox WHERE seq > ? "
+                                     "ORDER BY seq LIMIT ?) WHERE enqueued_at < ?",
+                                     (self.delivered_seq, RETENTION_SCAN_ROWS, time.time() - self.retention_s)).fetchone()
+            drop_until = row[0] or 0
+        if self.max_rows and self.backlog() > self.max_rows:
+            drop_until = max(drop_until, self.last_seq - self.max_rows)
+        if drop_until:
+            with self._lock:
+                if drop_until > self.delivered_seq:
+                    dropped = drop_until - self.delivered_seq
+                    self.delivered_seq = drop_until
+                    self._advance_locked()
+            if dropped:
+                logger.warning(f"Outbox: Bỏ {dropped} giá trị chưa gửi được do vượt retention "
+                               f"({self.retention_s}s) hoặc giới hạn {self.max_rows} giá trị.")
+        self._persist_offset()
+        return dropped
+
+    def _persist_offset(self):
+        delivered_seq = self.delivered_seq
+        if delivered_seq == self._persisted_seq:
+            return
+        self._conn.execute("BEGIN")
+        try:
+            self._write_offset(delivered_seq)
+            self._conn.execute("DELETE FROM outbox WHERE seq <= ?", (delivered_seq,))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._persisted_seq = delivered_seq
+
+    def _write_offset(self, seq: int):
+        self._conn.execute("INSERT INTO outbox_offsets (name, seq) VALUES ('delivered', ?) "
+                           "ON CONFLICT(name) DO UPDATE SET seq = excluded.seq", (seq,))
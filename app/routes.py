@@ -1,21 +1,13 @@
 # app/routes.py
-from flask import render_template, redirect, url_for, flash, request, jsonify # Thêm jsonify
+from flask import render_template, redirect, url_for, flash, request, jsonify, Response # Thêm jsonify
+from markupsafe import escape
 
-from app import db
-from app.models import OpcServer, OpcNode
+from app import db, csrf
+from app.models import OpcServer, OpcNode, OpcDataType, SubscriptionMapping
 from app.forms import OpcServerForm
-from app.opcua_client import (
-    connect_server as async_connect_server,
-    disconnect_server as async_disconnect_server,
-    is_server_connected,
-    start_server_browse,
-    browse_stop_flags
-)
-from async_worker import get_async_worker # Import hàm get_async_worker
 from asyncua import ua # Import ua để lấy ObjectIds nếu cần
-import json # Thêm import json
-from app.opcua_client import get_opcua_node_all_attributes # Import hàm mới
-from app.opcua_client import async_get_node_data_value # Import hàm mới
+from app.datatype_cache import datatype_cache
+from app.collector import collector, CollectorError # Runtime OPC UA (trong tiến trình này hoặc collector riêng qua IPC)
 
 
 
@@ -39,8 +31,9 @@ def register_routes(app_instance):
             all_servers = OpcServer.query.order_by(OpcServer.name).all()
             
             server_display_states = {} # Sẽ chứa thông tin để hiển thị
+            live_server_ids = set(collector.connected_server_ids()) # Một lần gọi collector cho cả trang
             for srv in all_servers:
-                is_live = is_server_connected(srv.id) # Trạng thái runtime
+                is_live = srv.id in live_server_ids # Trạng thái runtime
                 db_state = srv.connection_status # Trạng thái trong DB
                 
                 status_text = "Chưa xác định"
@@ -55,9 +48,12 @@ def register_routes(app_instance):
                         show_connect_button = False
                         show_disconnect_button = True
                     else:
-                        # DB nói là CONNECTED, nhưng runtime không thấy -> có thể là lỗi, hoặc đang chờ auto-connect (sẽ làm sau)
+                        # DB nói là CONNECTED, nhưng runtime không thấy -> có thể là lỗi, hoặc supervisor đang kết nối lại
                         status_text = "Lỗi/Đang chờ" 
                         status_class = "warning"
+                        supervisor_state = collector.supervisor_status(server_id=srv.id)
+                        if supervisor_state and supervisor_state.get("state") == "RECONNECTING":
+                            status_text = f"Đang kết nối lại (lần {supervisor_state.get('attempts', 0)})"
                         # Vẫn hiện nút Connect để người dùng có thể thử lại, hoặc nút Disconnect để reset DB state
                         show_connect_button = True 
                         show_disconnect_button = True 
@@ -172,11 +168,10 @@ def register_routes(app_instance):
         logger.info(f"Yêu cầu xóa server ID: {server_id}")
         server_to_delete = OpcServer.query.get_or_404(server_id)
         
-        if is_server_connected(server_id):
+        if collector.is_server_connected(server_id=server_id):
             logger.info(f"Server ID {server_id} đang có kết nối, thử ngắt kết nối trước khi xóa.")
             try:
-                worker = get_async_worker()
-                worker.run_coroutine(async_disconnect_server(server_id))
+                collector.disconnect_server(server_id=server_id)
             except TimeoutError as te:
                  logger.error(f"Timeout khi ngắt kết nối server ID {server_id} trước khi xóa: {te}", exc_info=True)
             except RuntimeError as re:
@@ -187,8 +182,10 @@ def register_routes(app_instance):
         server_name = server_to_delete.name
         try:
             OpcNode.query.filter_by(server_id=server_id).delete() # Xóa các node con trước
+            OpcDataType.query.filter_by(server_id=server_id).delete()
             db.session.delete(server_to_delete)
             db.session.commit()
+            datatype_cache.forget_server(server_id)
             logger.info(f'Đã xóa server "{server_name}" (ID: {server_id}) và các node liên quan khỏi DB thành công!')
             flash(f'Đã xóa server "{server_name}" và các node liên quan thành công!', 'success')
         except Exception as e:
@@ -203,7 +200,7 @@ def register_routes(app_instance):
         logger.info(f"Yêu cầu kết nối đến server ID: {server_id}")
         server_config = OpcServer.query.get_or_404(server_id)
         
-        if is_server_connected(server_id): # Kiểm tra trạng thái runtime trong active_clients
+        if collector.is_server_connected(server_id=server_id): # Kiểm tra trạng thái runtime trong active_clients
             flash(f'Server "{server_config.name}" đã được kết nối (runtime).', 'info')
             # Vẫn cập nhật DB nếu trạng thái DB là DISCONNECTED
             if server_config.connection_status != "CONNECTED":
@@ -218,8 +215,7 @@ def register_routes(app_instance):
             
         success = False
         try:
-            worker = get_async_worker()
-            success = worker.run_coroutine(async_connect_server(server_config)) # async_connect_server từ opcua_client.py
+            success = collector.connect_server(server_id=server_config.id) # connect_server của opcua_client, chạy trong tiến trình giữ runtime
             
             if success:
                 server_config.connection_status = "CONNECTED"
@@ -263,9 +259,8 @@ def register_routes(app_instance):
         success = False
         try:
             # Vẫn thực hiện ngắt kết nối runtime ngay cả khi DB nói là DISCONNECTED, để đảm bảo
-            if is_server_connected(server_id):
-                worker = get_async_worker()
-                success = worker.run_coroutine(async_disconnect_server(server_id)) # async_disconnect_server từ opcua_client.py
+            if collector.is_server_connected(server_id=server_id):
+                success = collector.disconnect_server(server_id=server_id) # disconnect_server của opcua_client
             else:
                 success = True # Coi như thành công nếu không có kết nối runtime để ngắt
 
@@ -307,7 +302,7 @@ def register_routes(app_instance):
         logger.info(f"Yêu cầu duyệt và lưu node cho server ID: {server_id}")
         opc_server = OpcServer.query.get_or_404(server_id)
 
-        if not is_server_connected(server_id):
+        if not collector.is_server_connected(server_id=server_id):
             flash(f"Server '{opc_server.name}' chưa được kết nối. Vui lòng kết nối trước khi duyệt node.", "warning")
             return redirect(url_for('list_servers'))
 
@@ -323,93 +318,77 @@ def register_routes(app_instance):
         
         logger.info(f"Chuẩn bị duyệt node cho server '{opc_server.name}' (ID: {server_id}) với max_depth={max_depth}.")
 
-        try:
-            logger.info(f"Đang xóa các node cũ của server ID {server_id}...")
-            num_deleted = OpcNode.query.filter_by(server_id=server_id).delete()
-            db.session.commit()
-            logger.info(f"Đã xóa {num_deleted} node cũ của server ID {server_id} khỏi DB.")
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Lỗi khi xóa node cũ của server ID {server_id}: {e}", exc_info=True)
-            flash(f"Lỗi khi dọn dẹp node cũ: {str(e)}", "danger")
+        wants_json = request.accept_mimetypes.best == 'application/json'
+        active_job = collector.active_browse_job(server_id=server_id)
+        if active_job is not None:
+            if wants_json:
+                return jsonify({"error": "Server đang được duyệt", **active_job}), 409
+            flash(f"Server '{opc_server.name}' đang được duyệt (job {active_job['job_id']}).", "warning")
             return redirect(url_for('list_servers'))
 
-        all_node_data = []
-        browse_process_error = None
-        
-        async def collect_nodes_async_wrapper():
-            nonlocal browse_process_error 
-            try:
-                async for node_info_dict in start_server_browse(server_db_id=server_id, max_depth=max_depth):
-                    all_node_data.append(node_info_dict)
-            except Exception as e_async_browse:
-                browse_process_error = e_async_browse
-                logger.error(f"Lỗi bên trong coroutine collect_nodes_async_wrapper cho server ID {server_id}: {e_async_browse}", exc_info=True)
-        
-        worker = get_async_worker()
+        # Mặc định duyệt incremental: upsert theo (server_id, node_id_string), node biến mất chỉ bị đánh dấu stale.
+        # Chế độ 'full' xóa toàn bộ node cũ rồi ghi lại, chỉ dùng được khi server chưa có mapping nào (FK opc_node_db_id).
+        incremental = request.form.get('browse_mode', 'incremental') != 'full'
+        if not incremental and SubscriptionMapping.query.filter_by(server_id=server_id).first() is not None:
+            logger.warning(f"Server ID {server_id} đã có mapping, không thể xóa node cũ. Chuyển sang duyệt incremental.")
+            flash("Server đã có mapping nên không thể xóa node cũ, sẽ duyệt incremental.", "warning")
+            incremental = True
+
+        # Duyệt chạy nền (xem app/browse_jobs.py): node được ghi xuống DB theo từng chunk ngay trong lúc duyệt,
+        # request trả về ngay với job_id, tiến độ xem qua /browse_jobs/<job_id>. Ở chế độ full, node cũ được
+        # xóa trong job ngay trước khi ghi, nên job bị từ chối (409/503) không làm mất cây node hiện có.
         try:
-            logger.info(f"Bắt đầu quá trình duyệt bất đồng bộ cho server ID {server_id}...")
-            browse_stop_flags.pop(server_id, None) 
-            
-            worker.run_coroutine(collect_nodes_async_wrapper())
-            
-            if browse_process_error:
-                raise browse_process_error
-
-            logger.info(f"Đã thu thập được {len(all_node_data)} node từ server ID {server_id}.")
-
+            job = collector.start_browse(server_id=server_id, max_depth=max_depth, incremental=incremental)
+        except ValueError as ve:
+            logger.warning(str(ve))
+            if wants_json:
+                return jsonify({"error": str(ve)}), 409
+            flash(str(ve), "warning")
+            return redirect(url_for('list_servers'))
         except TimeoutError as te:
-             logger.error(f"Timeout khi duyệt node cho server ID {server_id}: {te}", exc_info=True)
-             flash(f'Timeout khi duyệt node cho server "{opc_server.name}".', 'danger')
+            logger.error(f"Collector không phản hồi khi tạo job duyệt cho server ID {server_id}: {te}")
+            if wants_json:
+                return jsonify({"error": f"Collector không phản hồi: {te}"}), 503
+            flash(f'Collector không phản hồi, chưa tạo được job duyệt: {str(te)}', 'danger')
+            return redirect(url_for('list_servers'))
         except RuntimeError as re:
-             logger.error(f"Lỗi RuntimeError khi duyệt node cho server ID {server_id}: {re}. AsyncWorker có vấn đề?", exc_info=True)
-             flash(f'Lỗi hệ thống (AsyncWorker) khi duyệt node: {str(re)}', 'danger')
-        except Exception as e_run:
-            logger.error(f"Lỗi trong quá trình duyệt hoặc thu thập node cho server ID {server_id}: {e_run}", exc_info=True)
-            flash(f"Có lỗi xảy ra khi duyệt node: {str(e_run)}", "danger")
-        
-        was_stopped_by_user = browse_stop_flags.pop(server_id, False)
-        if was_stopped_by_user:
-            logger.info(f"Quá trình duyệt cho server ID {server_id} đã được người dùng yêu cầu dừng.")
-            flash("Quá trình duyệt đã được dừng. Đang lưu các node đã tìm thấy (nếu có).", "info")
-
-        if all_node_data:
-            nodes_to_add_instances = []
-            for node_data_dict in all_node_data:
-                try:
-                    node_obj = OpcNode(**node_data_dict)
-                    nodes_to_add_instances.append(node_obj)
-                except TypeError as te:
-                    logger.error(f"Lỗi TypeError khi tạo OpcNode từ dict: {node_data_dict}. Lỗi: {te}", exc_info=True)
-                except Exception as e_model:
-                    logger.error(f"Lỗi khi tạo đối tượng OpcNode từ dict: {node_data_dict}. Lỗi: {e_model}", exc_info=True)
-            
-            if nodes_to_add_instances:
-                try:
-                    logger.info(f"Chuẩn bị lưu {len(nodes_to_add_instances)} node vào DB cho server ID {server_id}.")
-                    db.session.add_all(nodes_to_add_instances)
-                    db.session.commit()
-                    logger.info(f"Đã lưu {len(nodes_to_add_instances)} node vào DB cho server ID {server_id}.")
-                    flash(f"Đã duyệt và lưu {len(nodes_to_add_instances)} node cho server '{opc_server.name}'.", "success")
-                except Exception as e_commit:
-                    db.session.rollback()
-                    logger.error(f"Lỗi khi commit {len(nodes_to_add_instances)} node cho server ID {server_id}: {e_commit}", exc_info=True)
-                    flash(f"Lỗi khi lưu các node đã duyệt: {str(e_commit)}", "danger")
-            elif not was_stopped_by_user and not browse_process_error :
-                 flash(f"Không tìm thấy node nào để lưu cho server '{opc_server.name}' (dữ liệu duyệt rỗng).", "info")
-        
-        elif not was_stopped_by_user and not browse_process_error:
-            flash(f"Không tìm thấy node nào trên server '{opc_server.name}' với độ sâu đã chọn, hoặc server không có node, hoặc quá trình duyệt gặp lỗi sớm.", "info")
-            logger.info(f"Không có node nào được tìm thấy/thu thập cho server ID {server_id} sau khi duyệt.")
-        
+            logger.error(f"Lỗi RuntimeError khi tạo job duyệt cho server ID {server_id}: {re}", exc_info=True)
+            if wants_json:
+                return jsonify({"error": str(re)}), 500
+            flash(f'Lỗi hệ thống khi duyệt node: {str(re)}', 'danger')
+            return redirect(url_for('list_servers'))
+
+        if wants_json:
+            return jsonify(job), 202
+        flash(f"Đã bắt đầu duyệt node cho server '{opc_server.name}' ở chế độ nền (job {job['job_id']}). "
+              f"Xem tiến độ tại {url_for('get_browse_job', job_id=job['job_id'])}.", "info")
         return redirect(url_for('list_servers'))
 
+    @app_instance.route('/browse_jobs', methods=['GET'])
+    def list_browse_jobs():
+        server_id = request.args.get('server_id', type=int)
+        return jsonify(collector.browse_jobs(server_id=server_id))
+
+    @app_instance.route('/browse_jobs/<job_id>', methods=['GET'])
+    def get_browse_job(job_id):
+        job = collector.browse_job(job_id=job_id)
+        if job is None:
+            return jsonify({"error": "Không tìm thấy job duyệt"}), 404
+        return jsonify(job)
+
+    @app_instance.route('/browse_jobs/<job_id>/cancel', methods=['POST'])
+    def cancel_browse_job(job_id):
+        result = collector.cancel_browse_job(job_id=job_id)
+        if result is None:
+            return jsonify({"error": "Không tìm thấy job duyệt"}), 404
+        return jsonify(result)
+
 
     @app_instance.route('/servers/<int:server_id>/stop_browse', methods=['POST'])
     def stop_browse_for_server(server_id):
         opc_server = OpcServer.query.get_or_404(server_id)
         logger.info(f"Nhận yêu cầu dừng duyệt node cho server ID: {server_id} ({opc_server.name})")
-        browse_stop_flags[server_id] = True
+        collector.stop_browse(server_id=server_id)
         flash(f"Đã gửi yêu cầu dừng duyệt node cho server '{opc_server.name}'. Quá trình sẽ dừng ở điểm kiểm tra tiếp theo.", "info")
         return redirect(request.referrer or url_for('list_servers'))
 
@@ -419,56 +398,16 @@ def register_routes(app_instance):
         opc_server = OpcServer.query.get_or_404(server_id)
         
         try:
-            nodes_from_db = OpcNode.query.filter_by(server_id=server_id).all()
-            count = len(nodes_from_db)
+            # Cây node được jsTree tải dần theo từng nhánh qua get_server_node_children_ajax,
+            # trang này chỉ cần biết số node để hiển thị
+            count = db.session.query(db.func.count(OpcNode.id)).filter(OpcNode.server_id == server_id).scalar()
             logger.info(f"Tìm thấy {count} node trong DB cho server '{opc_server.name}' (ID: {server_id}).")
 
-            if not nodes_from_db:
+            if not count:
                 flash(f"Không có node nào được lưu trong database cho server '{opc_server.name}'. Bạn có thể cần phải duyệt node trước.", "info")
 
-            # Chuẩn bị dữ liệu cho jsTree
-            jstree_data = []
-            # NodeId của RootFolder thường là 'i=84', được coi là cha của các node cấp cao nhất như ObjectsFolder
-            root_folder_node_id_obj = ua.NodeId(ua.ObjectIds.RootFolder)
-            root_folder_node_id_str = root_folder_node_id_obj.to_string()
-
-            for node_db in nodes_from_db:
-                parent_id_for_jstree = node_db.parent_node_id_string
-                # Nếu parent là RootFolder hoặc không có parent, coi nó là node gốc cho jsTree
-                if parent_id_for_jstree is None or parent_id_for_jstree == root_folder_node_id_str:
-                    parent_id_for_jstree = "#" # Ký hiệu node gốc cho jsTree
-
-                # Chọn icon dựa trên NodeClass
-                icon_class = "fas fa-file-alt text-secondary" # Mặc định
-                if node_db.node_class_str == 'Variable':
-                    icon_class = "fas fa-tag text-primary"
-                elif node_db.node_class_str == 'Object':
-                    icon_class = "fas fa-folder text-warning"
-                elif node_db.node_class_str == 'Method':
-                    icon_class = "fas fa-cog text-info"
-                
-                jstree_data.append({
-                    "id": node_db.node_id_string, # ID của node (NodeId string)
-                    "parent": parent_id_for_jstree, # ID của node cha
-                    "text": f"{node_db.display_name if node_db.display_name else node_db.browse_name} <small class='text-muted'>({node_db.node_class_str})</small>",
-                    "icon": icon_class, # Sử dụng class của Font Awesome
-                    "li_attr": {"title": f"NodeId: {node_db.node_id_string}\nBrowseName: {node_db.browse_name}\nClass: {node_db.node_class_str}\nDataType: {node_db.data_type if node_db.data_type else 'N/A'}"},
-                    "data": { # Dữ liệu tùy chỉnh bạn muốn gắn với node
-                        "db_id": node_db.id,
-                        "node_class": node_db.node_class_str,
-                        "data_type": node_db.data_type
-                    }
-                })
-            
-            # Chuyển đổi sang chuỗi JSON để nhúng vào template
-            # Sử dụng 'unsafe_json' filter nếu truyền trực tiếp vào script tag, hoặc truyền như biến context bình thường
-            # và JavaScript sẽ lấy từ đó.
-            # Để an toàn, chúng ta sẽ truyền như biến context và JavaScript sẽ parse nó.
-            # Hoặc, sử dụng json.dumps và |safe filter trong template.
-            
             return render_template('nodes/tree.html', 
                                    server=opc_server, 
-                                   jstree_data_json=json.dumps(jstree_data), # Truyền dữ liệu JSON đã được dump
                                    nodes_count=count,
                                    title=f"Các Node của Server {opc_server.name}")
 
@@ -476,6 +415,124 @@ def register_routes(app_instance):
             logger.error(f"Lỗi khi truy vấn hoặc xử lý node cho server ID {server_id}: {str(e)}", exc_info=True)
             flash('Không thể tải hoặc xử lý danh sách node từ database.', 'danger')
             return redirect(url_for('list_servers'))
+
+    def _jstree_node_from_row(node_db, has_children):
+        """Dữ liệu jsTree cho một OpcNode."""
+        # Chọn icon dựa trên NodeClass
+        icon_class = "fas fa-file-alt text-secondary" # Mặc định
+        if node_db.node_class_str == 'Variable':
+            icon_class = "fas fa-tag text-primary"
+        elif node_db.node_class_str == 'Object':
+            icon_class = "fas fa-folder text-warning"
+        elif node_db.node_class_str == 'Method':
+            icon_class = "fas fa-cog text-info"
+
+        return {
+            "id": node_db.node_id_string, # ID của node (NodeId string)
+            "text": f"{escape(node_db.display_name if node_db.display_name else node_db.browse_name)} <small class='text-muted'>({node_db.node_class_str})</small>"
+                    + (" <small class='text-danger'>(stale)</small>" if node_db.is_stale else ""),
+            "icon": icon_class, # Sử dụng class của Font Awesome
+            "children": bool(has_children), # True => jsTree sẽ gọi lại endpoint khi mở nhánh này
+            "li_attr": {"title": f"NodeId: {node_db.node_id_string}\nBrowseName: {node_db.browse_name}\nClass: {node_db.node_class_str}\nDataType: {node_db.data_type if node_db.data_type else 'N/A'}"},
+            "data": { # Dữ liệu tùy chỉnh bạn muốn gắn với node
+                "db_id": node_db.id,
+                "node_class": node_db.node_class_str,
+                "data_type": node_db.data_type,
+                "is_stale": node_db.is_stale
+            }
+        }
+
+    @app_instance.route('/servers/<int:server_id>/nodes/children', methods=['GET'])
+    def get_server_node_children_ajax(server_id):
+        """
+        Trả về các node con trực tiếp của một node (tham số parent, '#' là gốc cây) theo trang offset/limit,
+        dùng index trên parent_node_id_string nên thời gian không phụ thuộc kích thước address space.
+        Nếu còn node chưa trả về, phần tử cuối là node giả "Tải thêm..." (data.more_offset).
+        Response có ETag, client gửi If-None-Match khớp sẽ nhận 304.
+        """
+        if db.session.query(OpcServer.id).filter_by(id=server_id).scalar() is None:
+            return jsonify({"error": "Server không tìm thấy"}), 404
+
+        parent = request.args.get('parent', '#')
+        page_size = app_instance.config.get('NODE_TREE_PAGE_SIZE', 500)
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = min(max(1, request.args.get('limit', page_size, type=int)), page_size)
+
+        query = OpcNode.query.filter(OpcNode.server_id == server_id)
+        if parent == '#':
+            # Node không có cha hoặc cha là RootFolder được coi là node gốc của cây
+            root_folder_node_id_str = ua.NodeId(ua.ObjectIds.RootFolder).to_string()
+            query = query.filter(db.or_(OpcNode.parent_node_id_string.is_(None),
+                                        OpcNode.parent_node_id_string == root_folder_node_id_str))
+        else:
+            query = query.filter(OpcNode.parent_node_id_string == parent)
+
+        child = db.aliased(OpcNode)
+        has_children = db.exists().where(child.server_id == OpcNode.server_id,
+                                         child.parent_node_id_string == OpcNode.node_id_string)
+        # Lấy dư một dòng để biết còn trang sau hay không mà không cần COUNT
+        rows = query.add_columns(has_children.label('has_children'))\
+                    .order_by(OpcNode.display_name, OpcNode.browse_name, OpcNode.id)\
+                    .offset(offset).limit(limit + 1).all()
+
+        jstree_data = [_jstree_node_from_row(node_db, has_children_flag) for node_db, has_children_flag in rows[:limit]]
+        if len(rows) > limit:
+            jstree_data.append({
+                "id": f"__more__{parent}__{offset + limit}",
+                "text": "<em class='text-muted'>Tải thêm...</em>",
+                "icon": "fas fa-ellipsis-h text-muted",
+                "children": False,
+                "data": {"more_parent": parent, "more_offset": offset + limit}
+            })
+
+        response = jsonify(jstree_data)
+        response.cache_control.no_cache = True # Trình duyệt luôn hỏi lại server bằng If-None-Match
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @app_instance.route('/servers/<int:server_id>/nodes/search', methods=['GET'])
+    def search_server_nodes_ajax(server_id):
+        """
+        Tìm node trong DB theo display_name/browse_name (tham số str, LIKE không phân biệt hoa thường) cho search.ajax
+        của jsTree. Trả về NodeId của các node tổ tiên của tối đa NODE_SEARCH_MAX_RESULTS node khớp, từ gốc xuống,
+        để jsTree tải dần và mở đúng các nhánh đó. Node khớp nằm sau trang đầu của nhánh cha vẫn cần "Tải thêm...".
+        """
+        if db.session.query(OpcServer.id).filter_by(id=server_id).scalar() is None:
+            return jsonify({"error": "Server không tìm thấy"}), 404
+        text = (request.args.get('str') or '').strip()
+        if not text:
+            return jsonify([])
+
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        limit = app_instance.config.get('NODE_SEARCH_MAX_RESULTS', 100)
+        parent_ids = {parent for (parent,) in db.session.query(OpcNode.parent_node_id_string)
+                      .filter(OpcNode.server_id == server_id,
+                              db.or_(OpcNode.display_name.ilike(pattern, escape="\\"),
+                                     OpcNode.browse_name.ilike(pattern, escape="\\")))
+                      .limit(limit)}
+
+        # Đi ngược lên gốc theo từng mức (một query cho mỗi mức), RootFolder là gốc của cây
+        root_folder_node_id_str = ua.NodeId(ua.ObjectIds.RootFolder).to_string()
+        parent_of = {} # node_id -> node_id cha (None nếu là node gốc của cây)
+        pending = {node_id for node_id in parent_ids if node_id and node_id != root_folder_node_id_str}
+        while pending:
+            parent_of.update((node_id, None) for node_id in pending)
+            for node_id, parent in (db.session.query(OpcNode.node_id_string, OpcNode.parent_node_id_string)
+                                    .filter(OpcNode.server_id == server_id, OpcNode.node_id_string.in_(pending))):
+                if parent and parent != root_folder_node_id_str:
+                    parent_of[node_id] = parent
+            pending = {parent for parent in parent_of.values() if parent and parent not in parent_of}
+
+        def depth(node_id):
+            level, seen = 0, set()
+            while parent_of.get(node_id) is not None and node_id not in seen: # seen: tránh vòng lặp nếu dữ liệu lỗi
+                seen.add(node_id)
+                node_id = parent_of[node_id]
+                level += 1
+            return level
+
+        # Nhánh cha trước nhánh con để jsTree mở lần lượt từ gốc xuống
+        return jsonify(sorted(parent_of, key=lambda node_id: (depth(node_id), node_id)))
         
     # === ROUTE MỚI CHO AJAX ĐỂ LẤY CHI TIẾT NODE ===
     @app_instance.route('/internal/node_details_ajax/<int:node_db_id>', methods=['GET'])
@@ -492,7 +549,7 @@ def register_routes(app_instance):
             logger.error(f"AJAX request: Không tìm thấy OpcServer (ID: {opc_node_from_db.server_id}) cho OpcNode DB ID: {node_db_id}")
             return jsonify({"error": "Server chứa node này không tìm thấy"}), 500
 
-        if not is_server_connected(opc_server.id):
+        if not collector.is_server_connected(server_id=opc_server.id):
             logger.warning(f"AJAX request: Server '{opc_server.name}' (ID: {opc_server.id}) chưa kết nối. Không thể lấy chi tiết node trực tiếp.")
             # Trả về thông tin từ DB và thông báo server chưa kết nối
             details_from_db = {
@@ -501,7 +558,7 @@ def register_routes(app_instance):
                 "DisplayName": opc_node_from_db.display_name,
                 "NodeClass": opc_node_from_db.node_class_str,
                 "Description": opc_node_from_db.description,
-                "DataTypeName": opc_node_from_db.data_type,
+                "DataTypeName": datatype_cache.display(opc_server.id, opc_node_from_db.data_type),
                 "Value": "(Server chưa kết nối, không thể đọc giá trị)",
                 "status_message": f"Server '{opc_server.name}' chưa kết nối. Thông tin hiển thị từ lần duyệt cuối."
             }
@@ -510,9 +567,9 @@ def register_routes(app_instance):
         # Nếu server đã kết nối, lấy chi tiết từ OPC UA server
         node_details_live = None
         try:
-            worker = get_async_worker()
-            node_details_live = worker.run_coroutine(
-                get_opcua_node_all_attributes(opc_server.id, opc_node_from_db.node_id_string)
+            node_details_live = collector.node_attributes(
+                server_id=opc_server.id, node_id_str=opc_node_from_db.node_id_string,
+                timeout_s=app_instance.config.get('ASYNC_READ_TIMEOUT_S', 10)
             )
         except TimeoutError as te:
             logger.error(f"AJAX request: Timeout khi lấy chi tiết node '{opc_node_from_db.node_id_string}' từ server ID {opc_server.id}: {te}", exc_info=True)
@@ -558,15 +615,17 @@ def register_routes(app_instance):
             logger.error(f"AJAX Refresh Value: Không tìm thấy OpcServer cho OpcNode DB ID: {node_db_id}")
             return jsonify({"error": "Server của node không tồn tại"}), 500
 
-        if not is_server_connected(opc_server.id):
+        if not collector.is_server_connected(server_id=opc_server.id):
             logger.warning(f"AJAX Refresh Value: Server '{opc_server.name}' chưa kết nối.")
             return jsonify({"error": f"Server '{opc_server.name}' chưa kết nối. Không thể làm mới giá trị."}), 503 # Service Unavailable
 
         value_details = None
         try:
-            worker = get_async_worker()
-            value_details = worker.run_coroutine(
-                async_get_node_data_value(opc_server.id, opc_node_from_db.node_id_string)
+            # Node đang được subscribe đã có giá trị mới nhất trong cache, chỉ Read lại server khi giá trị quá cũ
+            value_details = collector.read_node_value(
+                server_id=opc_server.id, node_id_str=opc_node_from_db.node_id_string,
+                max_age_s=app_instance.config.get('VALUE_CACHE_MAX_AGE_S', 5.0),
+                timeout_s=app_instance.config.get('ASYNC_READ_TIMEOUT_S', 10)
             )
         except TimeoutError as te:
             logger.error(f"AJAX Refresh Value: Timeout khi lấy giá trị node '{opc_node_from_db.node_id_string}': {te}", exc_info=True)
@@ -585,4 +644,123 @@ def register_routes(app_instance):
             return jsonify(value_details)
         else:
             logger.warning(f"AJAX Refresh Value: Hàm async_get_node_data_value trả về None cho node '{opc_node_from_db.node_id_string}'.")
-            return jsonify({"error": "Không thể lấy giá trị từ server OPC UA."}), 500
\ No newline at end of file
+            return jsonify({"error": "Không thể lấy giá trị từ server OPC UA."}), 500
+
+    @app_instance.route('/internal/node_values_ajax', methods=['GET', 'POST'])
+    @csrf.exempt # Chỉ đọc, không thay đổi trạng thái: dashboard/API client gửi POST JSON không cần CSRF token
+    def get_node_values_batch_ajax():
+        """
+        Đọc giá trị của nhiều node trong một request: GET ?ids=1,2,3 hoặc POST JSON {"node_db_ids": [...]}.
+        Node đang được subscribe có giá trị mới trong cache được trả ngay, các node còn lại được gom theo server
+        và đọc bằng một Read (chia chunk) cho mỗi server, các server đọc đồng thời trong một lần gọi AsyncWorker.
+        Tham số tùy chọn max_age (giây) thay cho VALUE_CACHE_MAX_AGE_S, max_age=0 luôn đọc trực tiếp.
+        Số node mỗi request bị giới hạn bởi NODE_VALUES_MAX_IDS.
+        Trả về {"values": {node_db_id: value_details}, "servers": {server_id: thống kê}, "elapsed_ms": ...}.
+        """
+        payload = request.get_json(silent=True) if request.method == 'POST' else {}
+        if not isinstance(payload, dict):
+            return jsonify({"error": "Body phải là JSON object {\"node_db_ids\": [...]}"}), 400
+        try:
+            if request.method == 'POST':
+                raw_ids = payload.get('node_db_ids', [])
+                if not isinstance(raw_ids, list):
+                    return jsonify({"error": "node_db_ids phải là một danh sách"}), 400
+            else:
+                raw_ids = [part for part in request.args.get('ids', '').split(',') if part.strip()]
+            max_ids = app_instance.config.get('NODE_VALUES_MAX_IDS', 5000)
+            if len(raw_ids) > max_ids:
+                return jsonify({"error": f"Tối đa {max_ids} node mỗi request (nhận {len(raw_ids)})"}), 400
+            node_db_ids = list(dict.fromkeys(int(node_db_id) for node_db_id in raw_ids)) # Bỏ trùng, giữ thứ tự
+            max_age_s = float(payload.get('max_age', request.args.get('max_age', app_instance.config.get('VALUE_CACHE_MAX_AGE_S', 5.0))))
+        except (TypeError, ValueError):
+            return jsonify({"error": "Danh sách node_db_ids hoặc max_age không hợp lệ"}), 400
+        if not node_db_ids:
+            return jsonify({"error": "Không có node nào được yêu cầu"}), 400
+
+        errors = {} # node_db_id -> lỗi của các node không đọc được (không cần hỏi collector)
+        nodes = [] # [node_db_id, server_id, node_id_string]
+        rows = db.session.query(OpcNode.id, OpcNode.server_id, OpcNode.node_id_string, OpcNode.node_class_str)\
+                         .filter(OpcNode.id.in_(node_db_ids)).all()
+        rows_by_id = {row.id: row for row in rows}
+        for node_db_id in node_db_ids:
+            row = rows_by_id.get(node_db_id)
+            if row is None:
+                errors[node_db_id] = "Node không tìm thấy trong database"
+            elif row.node_class_str != ua.NodeClass.Variable.name:
+                errors[node_db_id] = "Chỉ có thể đọc giá trị cho Node kiểu Variable"
+            else:
+                nodes.append([node_db_id, row.server_id, row.node_id_string])
+
+        read_timeout_s = app_instance.config.get('ASYNC_READ_TIMEOUT_S', 10)
+        try:
+            if payload.get('async') or request.args.get('async') == '1':
+                # Không giữ thread của request: trả job_id ngay, client poll /async_jobs/<job_id>
+                job = collector.read_node_values(nodes=nodes, errors=errors, max_age_s=max_age_s,
+                                                 timeout_s=read_timeout_s, async_job=True)
+                return jsonify({**job, "status_url": url_for('get_async_job', job_id=job["job_id"])}), 202
+            return jsonify(collector.read_node_values(nodes=nodes, errors=errors, max_age_s=max_age_s,
+                                                      timeout_s=read_timeout_s))
+        except TimeoutError as te:
+            logger.error(f"AJAX Batch Read: Timeout khi đọc {len(nodes)} node: {te}", exc_info=True)
+            return jsonify({"error": f"Timeout khi lấy giá trị: {str(te)}"}), 504
+        except RuntimeError as re:
+            logger.error(f"AJAX Batch Read: Lỗi RuntimeError: {re}", exc_info=True)
+            return jsonify({"error": f"Lỗi hệ thống (AsyncWorker): {str(re)}"}), 500
+        except Exception as e:
+            logger.error(f"AJAX Batch Read: Lỗi không xác định: {e}", exc_info=True)
+            return jsonify({"error": f"Lỗi không xác định: {str(e)}"}), 500
+
+    @app_instance.route('/async_jobs/<job_id>', methods=['GET'])
+    def get_async_job(job_id):
+        """
+        Trạng thái job đã submit lên AsyncWorker, kèm "result" khi đã xong.
+        Tham số wait (giây, tối đa ASYNC_JOB_MAX_WAIT_S) chờ job xong trước khi trả lời (long-poll).
+        """
+        wait_s = min(max(0.0, request.args.get('wait', 0, type=float)), app_instance.config.get('ASYNC_JOB_MAX_WAIT_S', 25))
+        data = collector.get_job(job_id=job_id, wait_s=wait_s)
+        if data is None:
+            return jsonify({"error": "Job không tồn tại"}), 404
+        return jsonify(data)
+
+    @app_instance.route('/api/values', methods=['GET'])
+    def get_value_changes():
+        """
+        Các thay đổi giá trị có seq > since, tối đa max (giới hạn VALUES_API_MAX_ITEMS), theo thứ tự seq.
+        Khi chưa có thay đổi mới thì chờ tối đa wait giây (giới hạn VALUES_API_MAX_WAIT_S) trước khi trả lời (long-poll).
+        Consumer gửi lại "next" làm since ở lần sau; gap=true nghĩa là đã mất "lost" thay đổi (ring buffer bị ghi đè
+        hoặc collector khởi động lại, xem "epoch").
+        """
+        # Tham số sai trả 400 thay vì dùng giá trị mặc định: since=0 lặng lẽ sẽ đọc lại cả ring buffer với gap=false
+        max_limit = app_instance.config.get('VALUES_API_MAX_ITEMS', 10000)
+        try:
+            since = int(request.args.get('since', 0))
+            max_items = int(request.args.get('max', max_limit))
+            wait_s = float(request.args.get('wait', 0))
+        except (TypeError, ValueError):
+            return jsonify({"error": "since, max phải là số nguyên và wait là số giây"}), 400
+        if since < 0:
+            return jsonify({"error": "since phải là số nguyên không âm"}), 400
+        if max_items < 1:
+            return jsonify({"error": "max phải là số nguyên dương"}), 400
+        if not 0.0 <= wait_s < float("inf"):
+            return jsonify({"error": "wait phải là số giây không âm"}), 400
+        max_items = min(max_items, max_limit)
+        wait_s = min(wait_s, app_instance.config.get('VALUES_API_MAX_WAIT_S', 25))
+        try:
+            data = collector.changes_since(since=since, max_items=max_items, wait_s=wait_s)
+        except (CollectorError, TimeoutError) as e: # Collector (tiến trình riêng) không chạy hoặc không trả lời kịp
+            logger.error(f"API values: Không gọi được collector: {e}")
+            return jsonify({"error": f"Collector không khả dụng: {str(e)}"}), 503
+        if data is None:
+            return jsonify({"error": "Change log đang tắt (CHANGE_LOG_CAPACITY=0)"}), 404
+        return jsonify(data)
+
+    @app_instance.route('/async_worker/status', methods=['GET'])
+    def get_async_worker_status():
+        """Độ trễ event loop của từng shard AsyncWorker và shard phụ trách mỗi server đang kết nối."""
+        return jsonify(collector.worker_status())
+
+    @app_instance.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """Metric của đường dữ liệu (thông báo, delivery, độ trễ, loop lag, duyệt, session) theo định dạng Prometheus."""
+        return Response(collector.metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
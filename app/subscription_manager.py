@@ -0,0 +1,435 @@
+# app/subscription_manager.py
+import asyncio
+import logging
+import time
+
+from asyncua import ua
+from asyncua import Client as AsyncuaClient
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_TICK_S = 1.0 # Chu kỳ kiểm tra heartbeat của các mapping trong một subscription
+
+# Server không hỗ trợ/không chấp nhận DataChangeFilter cho item: tạo lại item không có filter, lọc phía client
+FILTER_REJECTED_STATUS_CODES = frozenset((
+    ua.StatusCodes.BadFilterNotAllowed,
+    ua.StatusCodes.BadMonitoredItemFilterUnsupported,
+    ua.StatusCodes.BadMonitoredItemFilterInvalid,
+    ua.StatusCodes.BadDeadbandFilterInvalid,
+))
+
+
+class SubscriptionGroup:
+    """
+    Một subscription OPC UA phía server, dùng chung cho mọi mapping của cùng một server
+    có cùng publishing interval. Mỗi mapping là một monitored item trong subscription này.
+    Đối tượng này là handler duy nhất của subscription: thông báo được định tuyến theo ClientHandle
+    qua bảng routes tới bản ghi route của mapping (MappingRoute trong app/opcua_client.py, dùng __slots__).
+    datachange_notification là hàm thường (không phải coroutine) để asyncua gọi trực tiếp cho từng item
+    thay vì tạo một Task cho mỗi thông báo rồi asyncio.gather.
+    """
+    def __init__(self, server_id: int, publishing_interval_ms: int):
+        self.server_id = server_id
+        self.publishing_interval_ms = publishing_interval_ms
+        self.subscription = None # asyncua Subscription, tạo trong SubscriptionManager
+        self.routes = {} # client_handle -> route của mapping
+        self.items_by_mapping = {} # mapping_id -> route (route.client_handle, route.server_handle)
+        self.heartbeat_routes = {} # client_handle -> route, chỉ các mapping bật heartbeat
+        self._next_client_handle = 1
+        self._heartbeat_task = None # Chỉ chạy khi có mapping bật heartbeat
+        self.heartbeat_suspended = False # Mất session hoặc subscription báo trạng thái xấu: không heartbeat giá trị cũ
+
+    def allocate_client_handle(self) -> int:
+        handle = self._next_client_handle
+        self._next_client_handle += 1
+        return handle
+
+    @property
+    def subscription_id(self):
+        return self.subscription.subscription_id if self.subscription else None
+
+    def ensure_heartbeat(self):
+        """Khởi động task heartbeat của subscription (trên event loop hiện tại) nếu chưa chạy."""
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat_loop())
+
+    def stop_heartbeat(self):
+        if self._heartbeat_task is not None and not self._heartbeat_task.done():
+            self._heartbeat_task.cancel()
+        self._heartbeat_task = None
+
+    def suspend(self):
+        """
+        Dừng heartbeat và đánh dấu giá trị cuối của mọi route là mất hiệu lực (session mất, subscription lỗi).
+        Group vẫn được giữ để TransferSubscriptions dùng lại; giá trị đầu tiên sau khi khôi phục được gửi như thay đổi.
+        """
+        self.heartbeat_suspended = True
+        for route in list(self.routes.values()):
+            route.invalidate()
+
+    def resume(self):
+        self.heartbeat_suspended = False
+
+    async def _heartbeat_loop(self):
+        # Một task cho cả subscription thay vì một timer cho mỗi mapping
+        while True:
+            await asyncio.sleep(HEARTBEAT_TICK_S)
+            if self.heartbeat_suspended:
+                continue
+            now = time.monotonic()
+            for route in list(self.heartbeat_routes.values()):
+                route.send_heartbeat(now)
+
+    def add_route(self, client_handle: int, route):
+        route.client_handle = client_handle
+        self.routes[client_handle] = route
+        if route.heartbeat_interval_s:
+            self.heartbeat_routes[client_handle] = route
+
+    def remove_route(self, client_handle: int):
+        self.routes.pop(client_handle, None)
+        self.heartbeat_routes.pop(client_handle, None)
+
+    def datachange_notification(self, node, val, data):
+        route = self.routes.get(data.monitored_item.ClientHandle)
+        if route is None:
+            logger.debug("SubscriptionGroup (Server %s, %sms): Không có route cho ClientHandle %s. Bỏ qua.",
+                         self.server_id, self.publishing_interval_ms, data.monitored_item.ClientHandle)
+            return
+        route.datachange(val, data)
+
+    def event_notification(self, event):
+        logger.info(f"SubscriptionGroup (Server {self.server_id}, {self.publishing_interval_ms}ms): Event Notification: {event}")
+
+    def status_change_notification(self, status):
+        logger.warning(f"SubscriptionGroup (Server {self.server_id}, {self.publishing_interval_ms}ms): "
+                       f"Status change: {status}")
+        if not status.Status.is_good(): # Subscription không còn gửi dữ liệu (ví dụ BadTimeout)
+            self.suspend()
+
+
+class SubscriptionManager:
+    """
+    Quản lý các subscription dùng chung: mỗi cặp (server_id, publishing_interval_ms) chỉ có
+    một subscription trên server, các mapping được thêm vào dưới dạng monitored item.
+    Mọi coroutine của lớp này phải chạy trên event loop của AsyncWorker.
+    """
+    def __init__(self):
+        self.groups = {} # (server_id, publishing_interval_ms) -> SubscriptionGroup
+        self.mapping_groups = {} # mapping_id -> (server_id, publishing_interval_ms)
+        self._group_locks = {} # Tránh tạo trùng subscription khi nhiều mapping cùng interval được subscribe đồng thời
+
+    def _lock_for(self, key):
+        lock = self._group_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._group_locks[key] = lock
+        return lock
+
+    async def _get_or_create_group_locked(self, client: AsyncuaClient, server_id: int,
+                                          publishing_interval_ms: int) -> SubscriptionGroup:
+        # Phải được gọi khi đang giữ lock của key tương ứng
+        key = (server_id, publishing_interval_ms)
+        group = self.groups.get(key)
+        if group is not None:
+            return group
+        group = SubscriptionGroup(server_id, publishing_interval_ms)
+        group.subscription = await client.create_subscription(period=publishing_interval_ms, handler=group)
+        self.groups[key] = group
+        logger.info(f"Đã tạo subscription dùng chung cho ServerID {server_id}, Publishing={publishing_interval_ms}ms. "
+                    f"SubId: {group.subscription_id}. Số subscription của server: {self.count_for_server(server_id)}")
+        return group
+
+    async def add_mapping(self, client: AsyncuaClient, server_id: int, mapping_id: int, node_id_str: str,
+                          sampling_interval_ms: int, publishing_interval_ms: int, route, data_filter=None):
+        """
+        Thêm monitored item cho một mapping vào subscription dùng chung của (server, publishing interval).
+        Trả về (subscription, server_handle). Raise ua.UaStatusCodeError nếu server từ chối item.
+        """
+        results, _ = await self.add_mappings(
+            client, server_id,
+            [(mapping_id, node_id_str, sampling_interval_ms, publishing_interval_ms, route, data_filter)]
+        )
+        result = results[mapping_id]
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, ua.StatusCode):
+            result.check()
+        return self.groups[self.mapping_groups[mapping_id]].subscription, result
+
+    async def add_mappings(self, client: AsyncuaClient, server_id: int, items, max_items_per_call: int = 1000):
+        """
+        Thêm nhiều monitored item của một server, gom theo publishing interval và gửi
+        CreateMonitoredItems theo từng chunk tối đa max_items_per_call item.
+        items: list tuple (mapping_id, node_id_str, sampling_interval_ms, publishing_interval_ms, route[, data_filter]),
+        data_filter là ua.DataChangeFilter (deadband phía server) hoặc None. Item bị server từ chối filter
+        (FILTER_REJECTED_STATUS_CODES) được tạo lại không có filter và route.use_client_side_filter() được gọi.
+        Trả về (results, chunk_timings):
+          - results: dict mapping_id -> server_handle (int), ua.StatusCode (bị server từ chối) hoặc Exception
+          - chunk_timings: list dict {server_id, publishing_interval_ms, items, failed, elapsed_ms}
+        """
+        max_items_per_call = max(1, int(max_items_per_call))
+        items_by_interval = {}
+        for item in items:
+            items_by_interval.setdefault(item[3], []).append(item)
+
+        results = {}
+        chunk_timings = []
+        for publishing_interval_ms, interval_items in items_by_interval.items():
+            key = (server_id, publishing_interval_ms)
+            async with self._lock_for(key):
+                try:
+                    group = await self._get_or_create_group_locked(client, server_id, publishing_interval_ms)
+                except Exception as e_group:
+                    logger.error(f"Không thể tạo subscription cho ServerID {server_id}, Publishing={publishing_interval_ms}ms: "
+                                 f"{e_group}", exc_info=True)
+                    for item in interval_items:
+                        results[item[0]] = e_group
+                    continue
+
+                for offset in range(0, len(interval_items), max_items_per_call):
+                    chunk = interval_items[offset:offset + max_items_per_call]
+                    started = time.perf_counter()
+                    failed = await self._create_chunk_locked(client, key, group, chunk, results)
+                    chunk_timings.append({
+                        "server_id": server_id,
+                        "publishing_interval_ms": publishing_interval_ms,
+                        "items": len(chunk),
+                        "failed": failed,
+                        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                    })
+
+                rejected = [item for item in interval_items
+                            if len(item) > 5 and item[5] is not None and isinstance(results.get(item[0]), ua.StatusCode)
+                            and results[item[0]].value in FILTER_REJECTED_STATUS_CODES]
+                if rejected:
+                    logger.info(f"ServerID {server_id}, Publishing={publishing_interval_ms}ms: {len(rejected)} item không được "
+                                f"server chấp nhận DataChangeFilter ({results[rejected[0][0]].name}), tạo lại và lọc phía client.")
+                    for item in rejected:
+                        item[4].use_client_side_filter()
+                    for offset in range(0, len(rejected), max_items_per_call):
+                        await self._create_chunk_locked(client, key, group, [item[:5] for item in
+                                                                             rejected[offset:offset + max_items_per_call]], results)
+
+                if group.heartbeat_routes:
+                    group.ensure_heartbeat()
+        return results, chunk_timings
+
+    async def _create_chunk_locked(self, client, key, group, chunk, results) -> int:
+        requests = []
+        client_handles = []
+        for item in chunk:
+            mapping_id, node_id_str, sampling_interval_ms, _, route = item[:5]
+            client_handle = group.allocate_client_handle()
+            requests.append(_make_monitored_item_request(client.get_node(node_id_str).nodeid, client_handle,
+                                                         sampling_interval_ms,
+                                                         data_filter=item[5] if len(item) > 5 else None))
+            client_handles.append(client_handle)
+            # Đăng ký route TRƯỚC khi gửi request, vì thông báo đầu tiên có thể đến trước khi có kết quả
+            group.add_route(client_handle, route)
+
+        try:
+            chunk_results = await group.subscription.create_monitored_items(requests)
+        except Exception as e_chunk:
+            logger.error(f"Lỗi CreateMonitoredItems ({len(chunk)} item) cho ServerID {key[0]}, Publishing={key[1]}ms: "
+                         f"{e_chunk}", exc_info=True)
+            for client_handle, item in zip(client_handles, chunk):
+                group.remove_route(client_handle)
+                results[item[0]] = e_chunk
+            return len(chunk)
+
+        failed = 0
+        for client_handle, item, result in zip(client_handles, chunk, chunk_results):
+            mapping_id = item[0]
+            if isinstance(result, ua.StatusCode):
+                group.remove_route(client_handle)
+                failed += 1
+            else:
+                route = item[4]
+                route.server_handle = result
+                group.items_by_mapping[mapping_id] = route
+                self.mapping_groups[mapping_id] = key
+            results[mapping_id] = result
+        return failed
+
+    async def remove_mapping(self, mapping_id: int) -> bool:
+        """
+        Xóa monitored item của mapping. Nếu subscription dùng chung không còn item nào thì xóa luôn subscription.
+        Trả về False nếu mapping không thuộc subscription nào.
+        """
+        if mapping_id not in self.mapping_groups:
+            return False
+        results, _ = await self.remove_mappings([mapping_id])
+        result = results.get(mapping_id)
+        if isinstance(result, Exception):
+            raise result
+        return bool(result)
+
+    async def remove_mappings(self, mapping_ids, max_items_per_call: int = 1000):
+        """
+        Gỡ nhiều mapping. Subscription dùng chung không còn item nào được xóa bằng một DeleteSubscriptions
+        cho mỗi server; các subscription còn item khác thì gửi DeleteMonitoredItems theo từng chunk.
+        Trả về (results, chunk_timings), results: dict mapping_id -> True/False/Exception.
+        """
+        max_items_per_call = max(1, int(max_items_per_call))
+        ids_by_key = {}
+        results = {}
+        for mapping_id in mapping_ids:
+            key = self.mapping_groups.get(mapping_id)
+            if key is None:
+                results[mapping_id] = False
+                continue
+            ids_by_key.setdefault(key, []).append(mapping_id)
+
+        chunk_timings = []
+        emptied_groups_by_server = {} # server_id -> list (key, group, mapping_ids)
+        for key, key_mapping_ids in ids_by_key.items():
+            async with self._lock_for(key):
+                group = self.groups.get(key)
+                server_handles = []
+                for mapping_id in key_mapping_ids:
+                    self.mapping_groups.pop(mapping_id, None)
+                    if group is None:
+                        results[mapping_id] = False
+                        continue
+                    route = group.items_by_mapping.pop(mapping_id, None)
+                    if route is not None:
+                        group.remove_route(route.client_handle)
+                        server_handles.append((mapping_id, route.server_handle))
+                if group is None:
+                    continue
+
+                if not group.items_by_mapping:
+                    # Xóa subscription sẽ xóa luôn các monitored item còn lại, không cần DeleteMonitoredItems
+                    self.groups.pop(key, None)
+                    group.stop_heartbeat()
+                    emptied_groups_by_server.setdefault(key[0], []).append((key, group, [m for m, _ in server_handles]))
+                    continue
+
+                for offset in range(0, len(server_handles), max_items_per_call):
+                    chunk = server_handles[offset:offset + max_items_per_call]
+                    started = time.perf_counter()
+                    outcome = True
+                    try:
+                        logger.info(f"DeleteMonitoredItems: {len(chunk)} item khỏi SubId {group.subscription_id} "
+                                    f"(ServerID {key[0]}, Publishing={key[1]}ms).")
+                        await group.subscription.unsubscribe([handle for _, handle in chunk])
+                    except Exception as e_chunk:
+                        logger.error(f"Lỗi DeleteMonitoredItems cho SubId {group.subscription_id}: {e_chunk}", exc_info=True)
+                        outcome = e_chunk
+                    for mapping_id, _ in chunk:
+                        results[mapping_id] = outcome
+                    chunk_timings.append({
+                        "server_id": key[0],
+                        "publishing_interval_ms": key[1],
+                        "items": len(chunk),
+                        "failed": 0 if outcome is True else len(chunk),
+                        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                    })
+
+        for server_id, emptied in emptied_groups_by_server.items():
+            subscription_ids = [group.subscription_id for _, group, _ in emptied]
+            started = time.perf_counter()
+            outcome = True
+            try:
+                logger.info(f"DeleteSubscriptions: {len(subscription_ids)} subscription dùng chung của ServerID {server_id}: "
+                            f"{subscription_ids}")
+                # Dùng UaClient của subscription (cùng session) để xóa tất cả trong một request
+                status_codes = await emptied[0][1].subscription.server.delete_subscriptions(subscription_ids)
+                for status in status_codes:
+                    if not status.is_good():
+                        logger.warning(f"DeleteSubscriptions trả về {status.name} cho ServerID {server_id}.")
+            except Exception as e_delete:
+                logger.error(f"Lỗi DeleteSubscriptions cho ServerID {server_id}: {e_delete}", exc_info=True)
+                outcome = e_delete
+            for _, _, emptied_mapping_ids in emptied:
+                for mapping_id in emptied_mapping_ids:
+                    results[mapping_id] = outcome
+            chunk_timings.append({
+                "server_id": server_id,
+                "publishing_interval_ms": None,
+                "items": len(subscription_ids),
+                "failed": 0 if outcome is True else len(subscription_ids),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            })
+        return results, chunk_timings
+
+    def drop_server(self, server_id: int):
+        """
+        Quên mọi subscription của một server (dùng khi session đã đóng, server tự xóa subscription).
+        Trả về list mapping_id đã bị gỡ.
+        """
+        return self.drop_groups([k for k in self.groups if k[0] == server_id])
+
+    def drop_groups(self, keys):
+        """Quên các subscription dùng chung theo key (server_id, publishing_interval_ms). Trả về list mapping_id đã bị gỡ."""
+        removed_mapping_ids = []
+        for key in keys:
+            group = self.groups.pop(key, None)
+            self._group_locks.pop(key, None)
+            if group is not None:
+                group.stop_heartbeat()
+                removed_mapping_ids.extend(group.items_by_mapping.keys())
+        for mapping_id in removed_mapping_ids:
+            self.mapping_groups.pop(mapping_id, None)
+        return removed_mapping_ids
+
+    def suspend_server(self, server_id: int):
+        """Tạm dừng heartbeat các subscription của server trong lúc mất session (xem SubscriptionGroup.suspend)."""
+        for group in self.groups.values():
+            if group.server_id == server_id:
+                group.suspend()
+
+    def groups_for_server(self, server_id: int):
+        """List (key, SubscriptionGroup) của một server."""
+        return [(key, group) for key, group in self.groups.items() if key[0] == server_id]
+
+    def count_for_server(self, server_id: int) -> int:
+        return sum(1 for k in self.groups if k[0] == server_id)
+
+    def summary(self):
+        """Trạng thái các subscription dùng chung: list dict theo (server_id, publishing interval)."""
+        return [
+            {
+                "server_id": server_id,
+                "publishing_interval_ms": interval_ms,
+                "subscription_id": group.subscription_id,
+                "monitored_items": len(group.items_by_mapping),
+            }
+            for (server_id, interval_ms), group in sorted(self.groups.items())
+        ]
+
+
+def make_deadband_filter(deadband_type: str, deadband_value: float):
+    """DataChangeFilter cho deadband 'Absolute'/'Percent' (Percent tính theo EURange của node), None nếu không dùng."""
+    if deadband_type not in ("Absolute", "Percent") or not deadband_value:
+        return None
+    data_filter = ua.DataChangeFilter()
+    data_filter.Trigger = ua.DataChangeTrigger.StatusValue
+    data_filter.DeadbandType = ua.DeadbandType.Absolute if deadband_type == "Absolute" else ua.DeadbandType.Percent
+    data_filter.DeadbandValue = float(deadband_value)
+    return data_filter
+
+
+def _make_monitored_item_request(node_id: ua.NodeId, client_handle: int, sampling_interval_ms: int,
+                                 queue_size: int = 1, data_filter=None) -> ua.MonitoredItemCreateRequest:
+    read_value_id = ua.ReadValueId()
+    read_value_id.NodeId = node_id
+    read_value_id.AttributeId = ua.AttributeIds.Value
+
+    params = ua.MonitoringParameters()
+    params.ClientHandle = client_handle
+    params.SamplingInterval = sampling_interval_ms
+    params.QueueSize = queue_size
+    params.DiscardOldest = True
+    params.Filter = data_filter
+
+    request = ua.MonitoredItemCreateRequest()
+    request.ItemToMonitor = read_value_id
+    request.MonitoringMode = ua.MonitoringMode.Reporting
+    request.RequestedParameters = params
+    return request
+
+
+# Instance global dùng bởi app/opcua_client.py
+subscription_manager = SubscriptionManager()
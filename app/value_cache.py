@@ -0,0 +1,61 @@
+# app/value_cache.py
+import threading
+import time
+
+
+class ValueCache:
+    """
+    Cache giá trị cuối cùng của các node đang được subscribe, theo key (server_id, node_id_str).
+    MappingRoute cập nhật cache mỗi khi có DataChange (trên thread của AsyncWorker), các route Flask đọc cache
+    để trả giá trị ngay thay vì gửi một request Read tới server OPC UA.
+    """
+    def __init__(self):
+        self._values = {} # (server_id, node_id_str) -> (value, status_code, source_ts, server_ts, received_monotonic)
+        self._lock = threading.Lock()
+
+    def update(self, server_id: int, node_id_str: str, value, status_code, source_timestamp, server_timestamp):
+        entry = (value, status_code, source_timestamp, server_timestamp, time.monotonic())
+        with self._lock:
+            self._values[(server_id, node_id_str)] = entry
+
+    def get(self, server_id: int, node_id_str: str, max_age_s: float):
+        """
+        Trả về dict giá trị cùng định dạng với async_get_node_data_value (thêm ValueSource và ValueAge_s),
+        hoặc None nếu node chưa có trong cache hoặc giá trị đã cũ hơn max_age_s giây.
+        """
+        with self._lock:
+            entry = self._values.get((server_id, node_id_str))
+        if entry is None:
+            return None
+        value, status_code, source_timestamp, server_timestamp, received = entry
+        age_s = time.monotonic() - received
+        if age_s > max_age_s:
+            return None
+
+        status_name = status_code.name if status_code is not None else None
+        value_details = {
+            "ValueStatusCode": status_name,
+            "ValueSourceTimestamp": source_timestamp.isoformat() if source_timestamp else None,
+            "ValueServerTimestamp": server_timestamp.isoformat() if server_timestamp else None,
+            "ValueSource": "cache",
+            "ValueAge_s": round(age_s, 3),
+        }
+        if status_code is None or status_code.is_good():
+            value_details["Value"] = str(value)
+        else:
+            value_details["Value"] = f"Lỗi đọc: {status_name}"
+            value_details["error_message"] = f"Không thể đọc giá trị: {status_name}"
+        return value_details
+
+    def forget_server(self, server_id: int):
+        """Xóa các giá trị của server (khi ngắt kết nối hoặc xóa server)."""
+        with self._lock:
+            for key in [key for key in self._values if key[0] == server_id]:
+                del self._values[key]
+
+    def __len__(self):
+        return len(self._values)
+
+
+# Instance global, dùng chung giữa MappingRoute (AsyncWorker) và các route Flask
+value_cache = ValueCache()
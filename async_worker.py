@@ -1,11 +1,21 @@
 # app/async_worker.py
 import asyncio
+import collections
+import concurrent.futures
 import threading
 import logging
-from concurrent.futures import Future
+import time
+import uuid
+import zlib
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TIMEOUT_S = 60 # Deadline mặc định của một job
+DEFAULT_MAX_CONCURRENT_PER_KEY = 4 # Số job chạy đồng thời tối đa cho mỗi server
+MAX_FINISHED_JOBS = 200 # Số job đã xong được giữ lại để poll kết quả
+LAG_SAMPLE_INTERVAL_S = 0.5 # Chu kỳ đo độ trễ event loop
+LAG_WINDOW_SAMPLES = 120 # max_lag_ms tính trên ~60 giây gần nhất
+
 class AsyncWorker:
     _instance = None
     _lock = threading.Lock()
@@ -24,65 +34,294 @@ class AsyncWorker:
         with self._lock:
             if self._initialized:
                 return
-            self.loop = None
-            self.thread = None
+            self.shards = [] # list _Shard, shard 0 là loop mặc định (self.loop)
+            self.shard_count = 1
+            self.default_timeout_s = DEFAULT_TIMEOUT_S
+            self.max_concurrent_per_key = DEFAULT_MAX_CONCURRENT_PER_KEY
+            self._semaphores = {} # key (server_id) -> asyncio.Semaphore, chỉ dùng trên event loop của shard của key
+            self._jobs = {} # job_id -> AsyncJob
+            self._jobs_lock = threading.Lock()
             self._initialized = True
 
+    @property
+    def loop(self):
+        """Event loop mặc định (shard 0), dùng cho các việc không gắn với một server cụ thể."""
+        return self.shards[0].loop if self.shards else None
+
+    @property
+    def thread(self):
+        return self.shards[0].thread if self.shards else None
+
     def start(self):
         if self.thread is not None and self.thread.is_alive():
             logger.info("Async worker thread is already running.")
             return
 
-        self.loop = asyncio.new_event_loop()
-        self.thread = threading.Thread(target=self._run_loop, daemon=True)
-        self.thread.start()
-        logger.info("Async worker thread started.")
+        self._semaphores = {} # Semaphore gắn với event loop cũ không dùng lại được
+        self.shards = [_Shard(index) for index in range(self.shard_count)]
+        for shard in self.shards:
+            shard.loop = asyncio.new_event_loop()
+            shard.thread = threading.Thread(target=self._run_loop, args=(shard,), name=f"async-worker-{shard.index}",
+                                            daemon=True)
+            shard.thread.start()
+            shard.monitor_future = asyncio.run_coroutine_threadsafe(self._monitor_lag(shard), shard.loop)
+        logger.info(f"Async worker started with {len(self.shards)} event loop shard(s).")
 
-    def _run_loop(self):
-        asyncio.set_event_loop(self.loop)
+    def _run_loop(self, shard):
+        asyncio.set_event_loop(shard.loop)
         try:
-            self.loop.run_forever()
+            shard.loop.run_forever()
         finally:
-            self.loop.close()
-            logger.info("Async worker event loop closed.")
+            shard.loop.close()
+            logger.info(f"Async worker event loop (shard {shard.index}) closed.")
 
     def stop(self):
-        if self.loop and self.loop.is_running():
-            logger.info("Stopping async worker event loop...")
-            self.loop.call_soon_threadsafe(self.loop.stop)
-        if self.thread and self.thread.is_alive():
-            logger.info("Waiting for async worker thread to join...")
-            self.thread.join(timeout=5) # Chờ thread kết thúc
-            if self.thread.is_alive():
-                logger.warning("Async worker thread did not join in time.")
-        self.thread = None
-        self.loop = None
+        for shard in self.shards:
+            if shard.loop and shard.loop.is_running():
+                logger.info(f"Stopping async worker event loop (shard {shard.index})...")
+                if shard.monitor_future is not None:
+                    shard.monitor_future.cancel()
+                # Dừng loop sau một vòng nữa để task _monitor_lag xử lý xong CancelledError trước khi loop đóng
+                shard.loop.call_soon_threadsafe(shard.loop.call_soon, shard.loop.stop)
+        for shard in self.shards:
+            if shard.thread and shard.thread.is_alive():
+                logger.info(f"Waiting for async worker thread (shard {shard.index}) to join...")
+                shard.thread.join(timeout=5) # Chờ thread kết thúc
+                if shard.thread.is_alive():
+                    logger.warning(f"Async worker thread (shard {shard.index}) did not join in time.")
+        self.shards = []
         logger.info("Async worker stopped.")
 
+    def configure(self, default_timeout_s: float = None, max_concurrent_per_key: int = None, shard_count: int = None):
+        """
+        Đặt deadline mặc định của job, số job chạy đồng thời tối đa cho mỗi key (server)
+        và số event loop shard (chỉ có hiệu lực nếu gọi trước start()).
+        """
+        if default_timeout_s is not None:
+            self.default_timeout_s = default_timeout_s
+        if max_concurrent_per_key is not None:
+            self.max_concurrent_per_key = max(1, int(max_concurrent_per_key))
+        if shard_count is not None:
+            if self.shards and int(shard_count) != len(self.shards):
+                logger.warning(f"Async worker đang chạy với {len(self.shards)} shard, bỏ qua shard_count={shard_count}.")
+            else:
+                self.shard_count = max(1, int(shard_count))
+
+    def shard_index(self, key) -> int:
+        """Shard cố định của một key: server_id % số shard (key không phải số nguyên thì dùng crc32)."""
+        count = len(self.shards) or self.shard_count
+        if key is None:
+            return 0
+        if isinstance(key, int):
+            return key % count
+        return zlib.crc32(str(key).encode()) % count
+
+    def loop_for(self, key):
+        """Event loop của shard phụ trách key (server_id); key None => loop mặc định."""
+        if not self.shards:
+            return None
+        return self.shards[self.shard_index(key)].loop
 
-    def run_coroutine(self, coro):
+    async def call_on_shard(self, key, coro):
         """
-        Chạy một coroutine trong event loop của worker và chờ kết quả (blocking).
-        Hàm này an toàn để gọi từ một thread khác.
+        Await coroutine trên shard của key từ một event loop bất kỳ của worker (chạy trực tiếp nếu đang ở đúng shard).
+        Dùng trong các coroutine làm việc với nhiều server để mỗi server chỉ được truy cập trên shard của nó.
         """
-        if not self.loop or not self.loop.is_running():
-            logger.error("Async worker loop is not running. Cannot run coroutine.")
-            # Có thể raise Exception ở đây hoặc khởi động lại worker nếu cần
-            # self.start() # Cân nhắc việc tự động khởi động lại
+        loop = self.loop_for(key)
+        if loop is None or loop is asyncio.get_running_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    async def _monitor_lag(self, shard):
+        """Đo độ trễ của event loop: thời gian thức dậy thực tế so với lịch của một asyncio.sleep ngắn."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_SAMPLE_INTERVAL_S
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL_S)
+            lag_ms = max(0.0, (loop.time() - expected) * 1000)
+            shard.lag_samples.append(lag_ms)
+            shard.lag_ms = lag_ms
+            shard.tasks = len(asyncio.all_tasks(loop))
+
+    def shard_stats(self):
+        """Trạng thái từng shard: độ trễ loop hiện tại/lớn nhất trong cửa sổ gần nhất và số task."""
+        return [
+            {
+                "shard": shard.index,
+                "running": bool(shard.loop and shard.loop.is_running()),
+                "lag_ms": round(shard.lag_ms, 2),
+                "max_lag_ms": round(max(shard.lag_samples, default=0.0), 2),
+                "tasks": shard.tasks,
+            }
+            for shard in self.shards
+        ]
+
+    def submit(self, coro, timeout: float = None, key=None, name: str = None, track: bool = True) -> "AsyncJob":
+        """
+        Lên lịch coroutine trên event loop của worker và trả về AsyncJob ngay (không blocking).
+        timeout: deadline (giây, tính từ lúc submit, gồm cả thời gian chờ lượt); quá hạn thì coroutine bị hủy
+        thật sự trên event loop và job kết thúc với TimeoutError. Mặc định là default_timeout_s.
+        key: thường là server_id; job chạy trên shard của key, tối đa max_concurrent_per_key job cùng key
+        chạy đồng thời, các job khác chờ lượt.
+        track=True: job được lưu để tra cứu bằng get_job(job_id) (các route poll kết quả).
+        """
+        loop = self.loop_for(key)
+        if not loop or not loop.is_running():
+            coro.close()
+            logger.error("Async worker loop is not running. Cannot submit coroutine.")
             raise RuntimeError("Async worker loop is not available.")
 
-        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        job = AsyncJob(name or getattr(coro, "__name__", "coroutine"), key,
+                       self.default_timeout_s if timeout is None else timeout)
+        job.future = asyncio.run_coroutine_threadsafe(self._run_job(job, coro), loop)
+        if track:
+            with self._jobs_lock:
+                self._jobs[job.job_id] = job
+                self._prune_jobs_locked()
+        return job
+
+    async def _run_job(self, job: "AsyncJob", coro):
+        started = False
+
+        async def guarded():
+            nonlocal started
+            semaphore = self._semaphore_for(job.key)
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                started = True
+                job.started_at = time.time()
+                return await coro
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
         try:
-            return future.result(timeout=50000)  # Đặt timeout hợp lý (ví dụ 30 giây)
-        except asyncio.TimeoutError:
-            logger.error(f"Coroutine execution timed out: {coro.__name__}")
-            # Hủy future nếu timeout
-            future.cancel()
-            raise TimeoutError(f"Operation {coro.__name__} timed out.")
+            if job.timeout_s is None:
+                return await guarded()
+            remaining_s = max(0.0, job.deadline - time.monotonic())
+            try:
+                return await asyncio.wait_for(guarded(), remaining_s)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Operation {job.name} timed out after {job.timeout_s}s.") from None
+        finally:
+            if not started:
+                coro.close() # Job bị hủy/quá hạn khi còn chờ lượt, tránh cảnh báo coroutine chưa được await
+            job.finished_at = time.time()
+
+    def _semaphore_for(self, key):
+        # Chỉ được gọi trên event loop của shard phụ trách key
+        if key is None:
+            return None
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrent_per_key)
+            self._semaphores[key] = semaphore
+        return semaphore
+
+    def get_job(self, job_id: str):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def _prune_jobs_locked(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done()]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self._jobs.pop(job_id, None)
+
+    def run_coroutine(self, coro, timeout: float = None, key=None):
+        """
+        Chạy một coroutine trong event loop của worker và chờ kết quả (blocking).
+        Hàm này an toàn để gọi từ một thread khác. key (server_id) chọn shard chạy coroutine.
+        Thread gọi bị giữ tối đa tới deadline của job
+        (timeout, mặc định default_timeout_s); quá hạn thì coroutine bị hủy và raise TimeoutError.
+        """
+        job = self.submit(coro, timeout=timeout, key=key, track=False)
+        try:
+            return job.result()
+        except TimeoutError:
+            logger.error(f"Coroutine execution timed out: {job.name}")
+            job.cancel()
+            raise TimeoutError(f"Operation {job.name} timed out.")
         except Exception as e:
-            logger.error(f"Exception in coroutine {coro.__name__}: {e}", exc_info=True)
+            logger.error(f"Exception in coroutine {job.name}: {e}", exc_info=True)
             raise
 
+
+class _Shard:
+    """Một event loop chạy trên thread riêng; mỗi server luôn được xử lý trên cùng một shard."""
+    def __init__(self, index: int):
+        self.index = index
+        self.loop = None
+        self.thread = None
+        self.lag_ms = 0.0
+        self.lag_samples = collections.deque(maxlen=LAG_WINDOW_SAMPLES)
+        self.tasks = 0
+        self.monitor_future = None # Task _monitor_lag, hủy khi dừng
+
+
+class AsyncJob:
+    """Handle của một coroutine đã submit lên AsyncWorker: poll trạng thái, chờ kết quả có giới hạn hoặc hủy."""
+    def __init__(self, name: str, key, timeout_s: float):
+        self.job_id = uuid.uuid4().hex
+        self.name = name
+        self.key = key
+        self.timeout_s = timeout_s
+        self.deadline = time.monotonic() + timeout_s if timeout_s is not None else None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None # concurrent.futures.Future
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    @property
+    def status(self) -> str:
+        if not self.done():
+            return "running" if self.started_at else "queued"
+        if self.future.cancelled():
+            return "cancelled"
+        error = self.future.exception()
+        if error is None:
+            return "completed"
+        return "timeout" if isinstance(error, TimeoutError) else "failed"
+
+    def result(self, wait: float = None):
+        """
+        Chờ kết quả tối đa wait giây (None: tới deadline của job). Raise TimeoutError nếu chưa xong,
+        CancelledError nếu job đã bị hủy, hoặc exception của coroutine.
+        """
+        if wait is None and self.deadline is not None:
+            # Deadline được event loop áp dụng, thêm chút thời gian để nhận kết quả hủy từ loop
+            wait = max(0.0, self.deadline - time.monotonic()) + 1.0
+        try:
+            return self.future.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            if self.future.done(): # TimeoutError của chính coroutine (quá deadline)
+                raise
+            raise TimeoutError(f"Operation {self.name} is still running.") from None
+
+    def cancel(self) -> bool:
+        """Hủy job: task trên event loop nhận CancelledError."""
+        return self.future.cancel()
+
+    def to_dict(self) -> dict:
+        status = self.status
+        error = None
+        if status in ("failed", "timeout"):
+            error = str(self.future.exception())
+        return {
+            "job_id": self.job_id,
+            "name": self.name,
+            "key": self.key,
+            "status": status,
+            "timeout_s": self.timeout_s,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": error,
+        }
+
 # Tạo một instance global của AsyncWorker
 async_worker = AsyncWorker()
 
@@ -0,0 +1,4 @@
+# benchmarks/__init__.py
+# Các script đo hiệu năng, chạy từ thư mục gốc của dự án, ví dụ:
+#   python -m benchmarks.bench_delivery --count 20000
+#   python -m benchmarks.bench_e2e --variables 1000 --duration 10 --json out/e2e.json
@@ -0,0 +1,140 @@
+# benchmarks/bench_delivery.py
+"""
+Đo throughput và độ trễ của delivery pipeline (app/delivery.py) so với cách cũ
+(mỗi thay đổi một requests.put trên executor mặc định, mở connection mới mỗi lần)
+trên một stub API cục bộ.
+
+    python -m benchmarks.bench_delivery --count 20000 --batch-size 500 --linger-ms 20
+    python -m benchmarks.bench_delivery --count 2000 --legacy
+    python -m benchmarks.bench_delivery --count 20000 --outbox /tmp/outbox.db --outage-s 3
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app.delivery import DeliveryPipeline
+from app.outbox import DeliveryOutbox
+from benchmarks.common import latency_summary_ms, write_results
+from benchmarks.stub_api import StubApiServer
+
+
+def _wait_for_items(stub, expected, timeout_s):
+    deadline = time.perf_counter() + timeout_s
+    while stub.item_count() < expected and time.perf_counter() < deadline:
+        time.sleep(0.005)
+
+
+def _submit_paced(count, rate, submit):
+    """Gọi submit(i) count lần, giới hạn ở rate item/giây (rate=0: nhanh nhất có thể)."""
+    interval = 1.0 / rate if rate else 0.0
+    start = time.perf_counter()
+    for i in range(count):
+        if interval:
+            target = start + i * interval
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        submit(i)
+
+
+def run_pipeline(stub, args):
+    pipeline = DeliveryPipeline()
+    pipeline.api_url = stub.url
+    pipeline.http_method = args.method
+    pipeline.batch_size = args.batch_size
+    pipeline.linger_ms = args.linger_ms
+    pipeline.sender_threads = args.threads
+    pipeline.max_queue_size = max(args.count, 1)
+    if args.outbox:
+        for suffix in ("", "-wal", "-shm"): # Mỗi lần đo bắt đầu với outbox rỗng
+            if os.path.exists(args.outbox + suffix):
+                os.remove(args.outbox + suffix)
+        pipeline.outbox = DeliveryOutbox(args.outbox)
+        pipeline.retry_interval_s = args.retry_interval
+    pipeline.start()
+    if args.outage_s:
+        # API downstream lỗi trong outage_s giây đầu, sau đó outbox phải gửi lại đủ các giá trị
+        stub.fail = True
+        threading.Timer(args.outage_s, lambda: setattr(stub, "fail", False)).start()
+
+    start = time.perf_counter()
+    # Giá trị gửi đi chính là thời điểm submit -> stub tính được độ trễ end-to-end
+    _submit_paced(args.count, args.rate, lambda i: pipeline.submit(i, time.perf_counter()))
+    _wait_for_items(stub, args.count, args.timeout)
+    elapsed = time.perf_counter() - start
+    pipeline.stop()
+    return elapsed, dict(pipeline.stats)
+
+
+def run_legacy(stub, args):
+    executor = ThreadPoolExecutor() # Giống loop.run_in_executor(None, ...) của asyncio
+    headers = {'Content-Type': 'application/json'}
+
+    def put_one(i):
+        payload = {"ioa": i, "value": time.perf_counter()}
+        try:
+            requests.put(stub.url, data=json.dumps(payload), headers=headers, timeout=10)
+        except requests.exceptions.RequestException:
+            pass
+
+    start = time.perf_counter()
+    _submit_paced(args.count, args.rate, lambda i: executor.submit(put_one, i))
+    _wait_for_items(stub, args.count, args.timeout)
+    elapsed = time.perf_counter() - start
+    executor.shutdown(wait=True)
+    return elapsed, {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20000, help="Số notification giả lập")
+    parser.add_argument('--rate', type=float, default=0, help="Tốc độ submit (item/s), 0 = nhanh nhất")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--linger-ms', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--method', default='PUT', choices=['PUT', 'POST'])
+    parser.add_argument('--stub-delay-ms', type=int, default=0, help="Độ trễ giả lập của API downstream")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--legacy', action='store_true', help="Đo cách cũ: một requests.put cho mỗi thay đổi")
+    parser.add_argument('--outbox', help="Đường dẫn file outbox SQLite (bật outbox trên đĩa)")
+    parser.add_argument('--outage-s', type=float, default=0, help="Giả lập API lỗi trong khoảng thời gian đầu (giây)")
+    parser.add_argument('--retry-interval', type=float, default=1.0, help="DELIVERY_RETRY_INTERVAL_S khi dùng outbox")
+    parser.add_argument('--json', dest='json_path', help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    stub = StubApiServer(delay_ms=args.stub_delay_ms).start()
+    try:
+        mode = "legacy" if args.legacy else ("pipeline+outbox" if args.outbox else "pipeline")
+        elapsed, stats = run_legacy(stub, args) if args.legacy else run_pipeline(stub, args)
+        with stub.lock:
+            latencies = [received_at - item["value"] for received_at, item in stub.items]
+            http_requests = stub.requests
+            connections = len(stub.connections)
+    finally:
+        stub.stop()
+
+    results = {
+        "mode": mode,
+        "count": args.count,
+        "received": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "http_requests": http_requests,
+        "tcp_connections": connections,
+        "latency": latency_summary_ms(latencies),
+        "params": {"batch_size": args.batch_size, "linger_ms": args.linger_ms, "threads": args.threads,
+                   "rate": args.rate, "stub_delay_ms": args.stub_delay_ms, "outage_s": args.outage_s},
+        "pipeline_stats": stats,
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.json_path:
+        write_results(args.json_path, "delivery", results)
+
+
+if __name__ == '__main__':
+    main()
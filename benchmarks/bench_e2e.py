@@ -0,0 +1,228 @@
+# benchmarks/bench_e2e.py
+"""
+Benchmark end-to-end trên server OPC UA mô phỏng (benchmarks/sim_server.py) và stub API datapoint,
+đi qua đúng các đường code thật của ứng dụng (qua facade collector, chế độ nhúng):
+  1. connect_server
+  2. job duyệt node: start_server_browse + ghi DB theo chunk (browse_and_stream_to_db)
+  3. tạo SubscriptionMapping cho các Variable vừa duyệt, subscribe_all_active_mappings_runtime
+  4. đo trong --duration giây: MappingRoute -> delivery pipeline -> stub API
+     (--output iec104: MappingRoute -> outstation IEC-104 -> master benchmarks/iec104_master.py, sau một GI)
+Kết quả: nodes/s khi duyệt, thời gian subscribe, notifications/s, items/s tới đầu nhận và độ trễ p50/p99
+(từ lúc server ghi giá trị tới lúc đầu nhận nhận được). Dùng --json để lưu và so sánh giữa các phiên bản.
+Lưu ý khi đo deadband: server asyncua so sánh với mẫu ngay trước (không phải giá trị đã báo gần nhất), nên với
+--deadband-value lớn hơn bước thay đổi (1/change-rate-hz) server không báo thay đổi nào, chỉ còn heartbeat.
+
+    python -m benchmarks.bench_e2e --depth 3 --fanout 5 --variables 1000 --change-rate-hz 1 --duration 10
+    python -m benchmarks.bench_e2e --variables 5000 --mappings 5000 --json out/e2e.json
+    python -m benchmarks.bench_e2e --variables 1000 --deadband-type Absolute --deadband-value 2.5 --heartbeat-s 5
+    python -m benchmarks.bench_e2e --variables 1000 --output iec104 --iec104-port 2405
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from app.config import Config
+from benchmarks.common import latency_summary_ms, write_results
+from benchmarks.iec104_master import Iec104Master
+from benchmarks.sim_server import VARIABLE_PREFIX, SimulationServer
+from benchmarks.stub_api import StubApiServer
+
+
+def _make_config(args, workdir, stub_url):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'bench_e2e.db')
+        WTF_CSRF_ENABLED = False
+        LOG_LEVEL = args.log_level
+        LOG_FILE = os.path.join(workdir, 'bench_e2e.log')
+        LOG_TO_CONSOLE = False
+        DATAPOINT_API_ENABLED = args.output == 'http'
+        DATAPOINT_API_URL = stub_url or Config.DATAPOINT_API_URL
+        IEC104_ENABLED = args.output == 'iec104'
+        IEC104_HOST = '127.0.0.1'
+        IEC104_PORT = args.iec104_port
+        DELIVERY_OUTBOX_ENABLED = not args.no_outbox
+        DELIVERY_OUTBOX_PATH = os.path.join(workdir, 'delivery_outbox.db')
+        COLLECTOR_SOCKET = '' # Runtime OPC UA chạy ngay trong tiến trình benchmark
+        ASYNC_WORKER_SHARDS = args.shards
+    return BenchConfig
+
+
+def _wait_browse(collector, job_id, timeout_s):
+    deadline = time.perf_counter() + timeout_s
+    while True:
+        job = collector.browse_job(job_id=job_id)
+        if job["status"] not in ("queued", "running"):
+            return job
+        if time.perf_counter() > deadline:
+            collector.cancel_browse_job(job_id=job_id)
+            raise TimeoutError(f"Job duyệt {job_id} chưa xong sau {timeout_s}s: {job}")
+        time.sleep(0.1)
+
+
+def _create_mappings(db, server_id, limit, sampling_ms, publishing_ms, deadband_type, deadband_value, heartbeat_s):
+    from app.models import OpcNode, SubscriptionMapping
+    nodes = (OpcNode.query
+             .filter(OpcNode.server_id == server_id, OpcNode.node_class_str == 'Variable',
+                     OpcNode.node_id_string.like(f"%;s={VARIABLE_PREFIX}%"))
+             .order_by(OpcNode.id)
+             .limit(limit)
+             .all())
+    db.session.bulk_insert_mappings(SubscriptionMapping, [
+        {"server_id": server_id, "opc_node_db_id": node.id, "ioa_mapping": ioa,
+         "sampling_interval_ms": sampling_ms, "publishing_interval_ms": publishing_ms, "is_active": True,
+         "deadband_type": deadband_type, "deadband_value": deadband_value, "heartbeat_interval_s": heartbeat_s}
+        for ioa, node in enumerate(nodes, start=1)
+    ])
+    db.session.commit()
+    return len(nodes)
+
+
+def _notification_total(metrics):
+    return sum(metrics.notifications.values.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=48400)
+    parser.add_argument('--depth', type=int, default=3, help="Số mức Object của address space")
+    parser.add_argument('--fanout', type=int, default=5, help="Số Object con của mỗi Object")
+    parser.add_argument('--variables', type=int, default=1000, help="Số Variable thay đổi giá trị")
+    parser.add_argument('--change-rate-hz', type=float, default=1.0, help="Số lần thay đổi mỗi giây của mỗi Variable")
+    parser.add_argument('--mappings', type=int, default=None, help="Số mapping subscribe (mặc định: tất cả Variable)")
+    parser.add_argument('--sampling-ms', type=int, default=100)
+    parser.add_argument('--publishing-ms', type=int, default=100)
+    parser.add_argument('--deadband-type', default='None', choices=['None', 'Absolute', 'Percent'])
+    parser.add_argument('--deadband-value', type=float, default=0.0,
+                        help="Ngưỡng deadband (giá trị mô phỏng tăng 1/change-rate-hz mỗi lần thay đổi)")
+    parser.add_argument('--heartbeat-s', type=int, default=0, help="heartbeat_interval_s của mapping, 0 = tắt")
+    parser.add_argument('--browse-depth', type=int, default=None, help="max_depth khi duyệt (mặc định: depth + 2)")
+    parser.add_argument('--shards', type=int, default=1, help="ASYNC_WORKER_SHARDS")
+    parser.add_argument('--warmup', type=float, default=2.0, help="Thời gian chờ sau subscribe trước khi đo (giây)")
+    parser.add_argument('--duration', type=float, default=10.0, help="Thời gian đo notification (giây)")
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--stub-delay-ms', type=int, default=0, help="Độ trễ giả lập của API downstream")
+    parser.add_argument('--no-outbox', action='store_true', help="Tắt outbox trên đĩa (DELIVERY_OUTBOX_ENABLED=0)")
+    parser.add_argument('--output', default='http', choices=['http', 'iec104'],
+                        help="Đầu ra đo: API datapoint (stub HTTP) hoặc outstation IEC-104 (master mô phỏng)")
+    parser.add_argument('--iec104-port', type=int, default=2404)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', dest='json_path', help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+    mapping_limit = args.mappings if args.mappings is not None else args.variables
+    browse_depth = args.browse_depth if args.browse_depth is not None else args.depth + 2
+
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    sim = SimulationServer(port=args.port, depth=args.depth, fanout=args.fanout, variables=args.variables,
+                           change_rate_hz=args.change_rate_hz).start(timeout_s=args.timeout)
+    stub = StubApiServer(delay_ms=args.stub_delay_ms).start() if args.output == 'http' else None
+    receiver = stub
+
+    from app import create_app, db, metrics # Import sau khi có cấu hình benchmark
+    from app.collector import collector
+    from app.delivery import delivery_pipeline
+    from app.iec104 import iec104_outstation
+    from app.models import OpcServer
+    from async_worker import async_worker
+
+    app = create_app(_make_config(args, workdir, stub.url if stub else None))
+    results = {}
+    try:
+        with app.app_context():
+            db.create_all()
+            server = OpcServer(name='bench-sim', endpoint_url=sim.endpoint_url)
+            db.session.add(server)
+            db.session.commit()
+            server_id = server.id
+
+        started = time.perf_counter()
+        collector.connect_server(server_id=server_id)
+        connect_s = time.perf_counter() - started
+
+        job = collector.start_browse(server_id=server_id, max_depth=browse_depth)
+        job = _wait_browse(collector, job["job_id"], args.timeout)
+        results["browse"] = {
+            "status": job["status"],
+            "max_depth": browse_depth,
+            "nodes_visited": job["nodes_visited"],
+            "nodes_saved": job["nodes_saved"],
+            "elapsed_s": job["elapsed_s"],
+            "nodes_per_s": job["rate_nodes_per_s"],
+        }
+
+        with app.app_context():
+            mapping_count = _create_mappings(db, server_id, mapping_limit, args.sampling_ms, args.publishing_ms,
+                                             args.deadband_type, args.deadband_value, args.heartbeat_s)
+        subscribe_result = collector.subscribe_all()
+        results["subscribe"] = {
+            "mappings": mapping_count,
+            "success": subscribe_result.get("success"),
+            "failed": subscribe_result.get("failed"),
+            "elapsed_s": subscribe_result.get("elapsed_s"),
+            "error": subscribe_result.get("error"),
+        }
+
+        if args.output == 'iec104':
+            receiver = Iec104Master(port=args.iec104_port).start()
+            started = time.perf_counter()
+            gi_objects = receiver.interrogate(timeout_s=args.timeout)
+            results["interrogation"] = {"objects": gi_objects, "elapsed_s": round(time.perf_counter() - started, 3)}
+
+        time.sleep(args.warmup)
+        epoch_offset = time.time() - time.perf_counter() # Đổi thời điểm nhận (perf_counter) của stub sang epoch
+        with receiver.lock:
+            receiver_start = len(receiver.items)
+        notifications_start = _notification_total(metrics)
+        changes_start = sim.changes_written
+        window_start = time.perf_counter()
+        time.sleep(args.duration)
+        window_s = time.perf_counter() - window_start
+        notifications = _notification_total(metrics) - notifications_start
+        changes = sim.changes_written - changes_start
+        with receiver.lock:
+            window_items = receiver.items[receiver_start:]
+            requests_total = receiver.requests if stub else receiver.asdus
+        # Stub HTTP: giá trị chính là thời điểm ghi; IEC-104: lấy từ CP56Time2a (số thực ngắn không đủ chính xác)
+        source_key = "value" if stub else "source_ts"
+        latencies = [received_at + epoch_offset - item[source_key] for received_at, item in window_items
+                     if isinstance(item.get(source_key), float)]
+
+        results["notifications"] = {
+            "window_s": round(window_s, 3),
+            "server_changes_per_s": round(changes / window_s, 1),
+            "notifications": notifications,
+            "notifications_per_s": round(notifications / window_s, 1),
+            "delivered": len(window_items),
+            "delivered_per_s": round(len(window_items) / window_s, 1),
+            "http_requests_total" if stub else "iec104_asdus_total": requests_total,
+        }
+        results["latency"] = latency_summary_ms(latencies)
+        results["connect_s"] = round(connect_s, 3)
+
+        collector.unsubscribe_all()
+        collector.disconnect_server(server_id=server_id)
+        results["delivery_stats"] = dict(delivery_pipeline.stats if stub else iec104_outstation.stats)
+    finally:
+        delivery_pipeline.stop()
+        async_worker.stop()
+        if receiver is not None:
+            receiver.stop()
+        iec104_outstation.stop()
+        sim.stop()
+
+    results["params"] = {
+        "depth": args.depth, "fanout": args.fanout, "objects": sim.object_count, "variables": args.variables,
+        "change_rate_hz": args.change_rate_hz, "mappings": mapping_limit, "sampling_ms": args.sampling_ms,
+        "publishing_ms": args.publishing_ms, "deadband_type": args.deadband_type,
+        "deadband_value": args.deadband_value, "heartbeat_s": args.heartbeat_s, "shards": args.shards,
+        "outbox": not args.no_outbox, "duration_s": args.duration,
+        "stub_delay_ms": args.stub_delay_ms, "output": args.output,
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.json_path:
+        write_results(args.json_path, "e2e", results)
+
+
+if __name__ == '__main__':
+    main()
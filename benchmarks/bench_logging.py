@@ -0,0 +1,137 @@
+# benchmarks/bench_logging.py
+"""
+Đo chi phí logging trên mỗi notification của MappingRoute.datachange (thời gian event loop
+bị chiếm, tính bằng µs/notification) theo ba chế độ:
+  legacy       log INFO bằng f-string cho mỗi thông báo, FileHandler + StreamHandler ghi đồng bộ (cách cũ)
+  queue        code hiện tại ở LOG_LEVEL=INFO: không tạo record cho từng thông báo
+  queue-debug  code hiện tại ở LOG_LEVEL=DEBUG: format lười, lấy mẫu theo mapping, ghi qua QueueListener
+Console của cả ba chế độ được chuyển vào os.devnull để không phụ thuộc tốc độ terminal.
+
+    python -m benchmarks.bench_logging --mode legacy --count 50000
+    python -m benchmarks.bench_logging --mode queue-debug --count 50000 --mappings 100 --json out/logging.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from asyncua import ua
+
+import log_config
+from app import metrics
+from app.delivery import delivery_pipeline
+from app.opcua_client import MappingRoute, value_cache
+from benchmarks.common import write_results
+from benchmarks.stub_api import StubApiServer
+
+logger = logging.getLogger('app.opcua_client')
+
+
+class LegacyRoute(MappingRoute):
+    """datachange như trước khi có log lười/lấy mẫu: một dòng INFO f-string cho mỗi thông báo."""
+    def datachange(self, val, data):
+        metrics.notifications.inc(self._metric_labels)
+        source_timestamp = data.monitored_item.Value.SourceTimestamp
+        server_timestamp = data.monitored_item.Value.ServerTimestamp
+        status_code = data.monitored_item.Value.StatusCode
+        logger.info(
+            f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
+            f"DataChange! Value={val}, StatusCode={status_code.name if status_code else 'N/A'}, "
+            f"SourceTs={source_timestamp}, ServerTs={server_timestamp}"
+        )
+        value_cache.update(self.server_id, self.node_id_str, val, status_code, source_timestamp, server_timestamp)
+        if status_code and not status_code.is_good():
+            logger.warning(
+                f"SubHandler (MappingID: {self.mapping_id}, Node: {self.node_id_str}): "
+                f"Nhận được DataChange với StatusCode không tốt: {status_code.name}. Không gọi API."
+            )
+            return
+        delivery_pipeline.submit(self.ioa_mapping, val, source_timestamp.timestamp() if source_timestamp else None)
+
+
+def _setup_legacy_logging(log_file):
+    app_logger = logging.getLogger('app')
+    app_logger.setLevel(logging.INFO)
+    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(log_config.FILE_FORMAT))
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setFormatter(logging.Formatter(log_config.CONSOLE_FORMAT))
+    app_logger.addHandler(file_handler)
+    app_logger.addHandler(console_handler)
+
+
+def _make_data(value):
+    now = datetime.now(timezone.utc)
+    data_value = ua.DataValue(ua.Variant(value, ua.VariantType.Double), ua.StatusCode(ua.StatusCodes.Good),
+                              SourceTimestamp=now, ServerTimestamp=now)
+    return SimpleNamespace(monitored_item=SimpleNamespace(Value=data_value))
+
+
+async def _drive(handlers, count):
+    # Dữ liệu tạo trước để chỉ đo phần xử lý trong handler
+    samples = [_make_data(float(i)) for i in range(min(count, 1000))]
+    start = time.perf_counter()
+    for i in range(count):
+        data = samples[i % len(samples)]
+        handlers[i % len(handlers)].datachange(data.monitored_item.Value.Value.Value, data)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='queue', choices=['legacy', 'queue', 'queue-debug'])
+    parser.add_argument('--count', type=int, default=50000, help="Số notification giả lập")
+    parser.add_argument('--mappings', type=int, default=100, help="Số mapping (MappingRoute) nhận thông báo xoay vòng")
+    parser.add_argument('--rate-limit-s', type=float, default=10.0, help="LOG_RATE_LIMIT_INTERVAL_S cho chế độ queue-debug")
+    parser.add_argument('--json', dest='json_path', help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    log_file = os.path.join(tempfile.mkdtemp(prefix='bench_logging_'), 'bench.log')
+    sys.stderr = open(os.devnull, 'w', encoding='utf-8') # Console handler (cả listener nền) ghi vào devnull
+    if args.mode == 'legacy':
+        _setup_legacy_logging(log_file)
+    else:
+        log_config.setup_logger('app', {
+            'LOG_LEVEL': 'DEBUG' if args.mode == 'queue-debug' else 'INFO',
+            'LOG_FILE': log_file,
+            'LOG_RATE_LIMIT_INTERVAL_S': args.rate_limit_s,
+        })
+
+    stub = StubApiServer().start()
+    delivery_pipeline.api_url = stub.url
+    delivery_pipeline.max_queue_size = max(args.count, 1)
+    delivery_pipeline.start()
+    try:
+        handler_cls = LegacyRoute if args.mode == 'legacy' else MappingRoute
+        handlers = [handler_cls(mapping_id, mapping_id, f"ns=2;i={mapping_id}", 1) for mapping_id in range(1, args.mappings + 1)]
+        elapsed = asyncio.run(_drive(handlers, args.count))
+    finally:
+        delivery_pipeline.stop()
+        stub.stop()
+        log_config._stop_listener() # Ghi nốt hàng đợi log trước khi đếm số dòng
+        logging.shutdown()
+
+    with open(log_file, encoding='utf-8') as f:
+        log_lines = sum(1 for _ in f)
+    results = {
+        "mode": args.mode,
+        "count": args.count,
+        "mappings": args.mappings,
+        "elapsed_s": round(elapsed, 3),
+        "us_per_notification": round(elapsed / args.count * 1e6, 2) if args.count else None,
+        "log_lines": log_lines,
+        "log_bytes": os.path.getsize(log_file),
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.json_path:
+        write_results(args.json_path, "logging", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# benchmarks/bench_routing.py
+"""
+Đo bộ nhớ trên mỗi mapping và chi phí định tuyến mỗi notification của bảng route theo ClientHandle,
+so với cách cũ (một SubHandler async có __dict__ cho mỗi mapping, tuple trong active_opcua_subscriptions):
+  legacy  SubscriptionGroup async -> SubHandler.datachange_notification async, asyncua gom bằng asyncio.gather
+  table   SubscriptionGroup đồng bộ -> MappingRoute (__slots__).datachange (code hiện tại)
+Bộ nhớ: tracemalloc của trạng thái runtime do ứng dụng tạo cho N mapping (route/handler, bảng routes,
+items_by_mapping, active_opcua_subscriptions, mapping_groups), không tính SubscriptionItemData của asyncua
+(giống nhau ở cả hai chế độ). Dispatch: gọi Subscription._call_datachange của asyncua với DataChangeNotification
+dựng sẵn (--batch item mỗi lần), không cần server; delivery pipeline gửi tới stub API.
+
+    python -m benchmarks.bench_routing --mode legacy --mappings 100000
+    python -m benchmarks.bench_routing --mode table --mappings 100000 --count 200000 --json out/routing.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from asyncua import ua
+from asyncua.common.subscription import Subscription, SubscriptionItemData
+
+from app.delivery import delivery_pipeline
+from app.opcua_client import MappingRoute
+from app.subscription_manager import SubscriptionGroup, SubscriptionManager
+from benchmarks.common import write_results
+from benchmarks.stub_api import StubApiServer
+
+SERVER_ID = 1
+PUBLISHING_INTERVAL_MS = 100
+
+
+class LegacySubHandler:
+    """SubHandler trước khi có bảng route: một object có __dict__ cho mỗi mapping, callback async."""
+    def __init__(self, mapping_id, ioa_mapping_value, node_id_str, server_id, worker_loop):
+        self.mapping_id = mapping_id
+        self.ioa_mapping = ioa_mapping_value
+        self.node_id_str = node_id_str
+        self.server_id = server_id
+        self.worker_loop = worker_loop
+        self._metric_labels = (server_id, mapping_id)
+        self._server_labels = (server_id,)
+        self.deadband_type = "None"
+        self.deadband_value = 0.0
+        self.heartbeat_interval_s = 0
+        self.client_deadband = None
+        self.needs_eu_range = False
+        self._last_value = None
+        self._last_sent = 0.0
+
+    async def datachange_notification(self, node, val, data):
+        MappingRoute.datachange(self, val, data) # Cùng phần xử lý, chỉ khác cách định tuyến
+
+
+class LegacyGroup:
+    def __init__(self):
+        self.handlers_by_client_handle = {}
+        self.items_by_mapping = {}
+
+    async def datachange_notification(self, node, val, data):
+        handler = self.handlers_by_client_handle.get(data.monitored_item.ClientHandle)
+        if handler is not None:
+            await handler.datachange_notification(node, val, data)
+
+
+def _build_legacy(mappings, node_ids, loop):
+    group = LegacyGroup()
+    manager = SubscriptionManager()
+    active = {}
+    for mapping_id in range(1, mappings + 1):
+        handler = LegacySubHandler(mapping_id, mapping_id, node_ids[mapping_id - 1], SERVER_ID, loop)
+        group.handlers_by_client_handle[mapping_id] = handler
+        group.items_by_mapping[mapping_id] = (mapping_id, mapping_id)
+        manager.mapping_groups[mapping_id] = (SERVER_ID, PUBLISHING_INTERVAL_MS)
+        active[mapping_id] = (None, mapping_id, handler)
+    return group, manager, active
+
+
+def _build_table(mappings, node_ids):
+    group = SubscriptionGroup(SERVER_ID, PUBLISHING_INTERVAL_MS)
+    manager = SubscriptionManager()
+    active = {}
+    for mapping_id in range(1, mappings + 1):
+        route = MappingRoute(mapping_id, mapping_id, node_ids[mapping_id - 1], SERVER_ID)
+        group.add_route(mapping_id, route)
+        route.server_handle = mapping_id
+        group.items_by_mapping[mapping_id] = route
+        manager.mapping_groups[mapping_id] = (SERVER_ID, PUBLISHING_INTERVAL_MS)
+        active[mapping_id] = route
+    return group, manager, active
+
+
+def _make_notifications(mappings, batch, batches):
+    now = datetime.now(timezone.utc)
+    notifications = []
+    handle = 0
+    for i in range(batches):
+        notification = ua.DataChangeNotification()
+        for _ in range(batch):
+            handle = handle % mappings + 1
+            item = ua.MonitoredItemNotification()
+            item.ClientHandle = handle
+            item.Value = ua.DataValue(ua.Variant(float(i), ua.VariantType.Double), ua.StatusCode(ua.StatusCodes.Good),
+                                      SourceTimestamp=now, ServerTimestamp=now)
+            notification.MonitoredItems.append(item)
+        notifications.append(notification)
+    return notifications
+
+
+async def _run(args, node_ids):
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    if args.mode == 'legacy':
+        state = _build_legacy(args.mappings, node_ids, asyncio.get_running_loop())
+    else:
+        state = _build_table(args.mappings, node_ids)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    group = state[0]
+
+    subscription = Subscription(None, ua.CreateSubscriptionParameters(), group)
+    for client_handle in range(1, args.mappings + 1):
+        data = SubscriptionItemData()
+        data.client_handle = client_handle
+        subscription._monitored_items[client_handle] = data
+
+    # Dựng sẵn một vòng notification để chỉ đo phần asyncua phân phối + định tuyến + xử lý
+    batches = max(1, args.count // args.batch)
+    notifications = _make_notifications(args.mappings, args.batch, min(batches, 50))
+    start = time.perf_counter()
+    for i in range(batches):
+        await subscription._call_datachange(notifications[i % len(notifications)])
+    elapsed = time.perf_counter() - start
+    return after - before, elapsed, batches * args.batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='table', choices=['legacy', 'table'])
+    parser.add_argument('--mappings', type=int, default=100000)
+    parser.add_argument('--count', type=int, default=200000, help="Số notification giả lập")
+    parser.add_argument('--batch', type=int, default=1000, help="Số item trong một DataChangeNotification")
+    parser.add_argument('--json', dest='json_path', help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    node_ids = [f"ns=2;s=Sim.Var{i}" for i in range(args.mappings)] # Chuỗi NodeId có sẵn từ DB ở cả hai chế độ
+    stub = StubApiServer().start()
+    delivery_pipeline.api_url = stub.url
+    delivery_pipeline.max_queue_size = max(args.count, 1)
+    delivery_pipeline.start()
+    try:
+        state_bytes, elapsed, notifications = asyncio.run(_run(args, node_ids))
+    finally:
+        delivery_pipeline.stop()
+        stub.stop()
+
+    results = {
+        "mode": args.mode,
+        "mappings": args.mappings,
+        "state_bytes": state_bytes,
+        "bytes_per_mapping": round(state_bytes / args.mappings, 1) if args.mappings else None,
+        "notifications": notifications,
+        "batch": args.batch,
+        "elapsed_s": round(elapsed, 3),
+        "us_per_notification": round(elapsed / notifications * 1e6, 2) if notifications else None,
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.json_path:
+        write_results(args.json_path, "routing", results)
+
+
+if __name__ == '__main__':
+    main()
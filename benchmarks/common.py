@@ -0,0 +1,43 @@
+# benchmarks/common.py
+import json
+import os
+import platform
+import time
+
+
+def percentile(sorted_values, pct):
+    """Percentile theo nearest-rank trên một list đã sắp xếp."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def latency_summary_ms(latencies_s):
+    """Tóm tắt một list độ trễ (giây) thành dict p50/p99/max (ms)."""
+    values = sorted(latencies_s)
+    if not values:
+        return {"count": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def write_results(path, name, results):
+    """Ghi kết quả benchmark ra file JSON (đọc được bằng máy) kèm thông tin môi trường."""
+    document = {
+        "benchmark": name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2, ensure_ascii=False)
+    return document
@@ -0,0 +1,191 @@
+# benchmarks/iec104_master.py
+"""
+Master (controlling station) IEC 60870-5-104 tối giản để kiểm tra outstation của ứng dụng (app/iec104.py)
+và làm đầu nhận trong benchmark end-to-end: STARTDT, general interrogation, nhận dữ liệu tự phát,
+xác nhận bằng S-frame sau mỗi w I-frame. Độ trễ được tính từ CP56Time2a (SourceTimestamp) tới lúc nhận.
+
+    python -m benchmarks.iec104_master --host 127.0.0.1 --port 2404 --duration 10
+"""
+import asyncio
+import json
+import struct
+import threading
+import time
+
+from app.iec104 import (
+    ASDU_HEADER_LENGTH, C_IC_NA_1, COT_ACTIVATION, COT_ACTIVATION_CON, COT_ACTIVATION_TERM, COT_INTERROGATED_STATION,
+    M_ME_NC_1, M_ME_TF_1, M_SP_NA_1, M_SP_TB_1, QOI_STATION, SEQ_MODULO, START_BYTE, STARTDT_ACT, STARTDT_CON,
+    TESTFR_ACT, TESTFR_CON, asdu_header, decode_cp56time2a, i_frame, s_frame, u_frame,
+)
+from benchmarks.common import latency_summary_ms
+
+_OBJECT_LAYOUT = { # type -> (kích thước phần tử sau IOA, có CP56Time2a)
+    M_SP_NA_1: (1, False),
+    M_SP_TB_1: (8, True),
+    M_ME_NC_1: (5, False),
+    M_ME_TF_1: (12, True),
+}
+_FLOAT = struct.Struct("<f")
+
+
+class Iec104Master:
+    def __init__(self, host="127.0.0.1", port=2404, common_address=1, w=8):
+        self.host = host
+        self.port = port
+        self.common_address = common_address
+        self.w = w
+        self.items = [] # (thời điểm nhận perf_counter, {ioa, value, quality, cot, source_ts})
+        self.asdus = 0
+        self.interrogation_objects = 0
+        self.lock = threading.Lock()
+        self._loop = None
+        self._writer = None
+        self._send_seq = 0
+        self._recv_seq = 0
+        self._recv_unacked = 0
+        self._started = threading.Event()
+        self._gi_done = threading.Event()
+        self._stop_event = None
+        self._thread = None
+        self._error = None
+
+    def start(self, timeout_s=10):
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="iec104-master", daemon=True)
+        self._thread.start()
+        if not self._started.wait(timeout_s):
+            raise TimeoutError(f"Không STARTDT được với outstation {self.host}:{self.port}: {self._error}")
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread is not None:
+            self._thread.join(10)
+
+    def interrogate(self, timeout_s=60):
+        """Gửi general interrogation và chờ ACT_TERM. Trả về số object nhận được với COT 20."""
+        self._gi_done.clear()
+        with self.lock:
+            before = self.interrogation_objects
+        asdu = asdu_header(C_IC_NA_1, 1, COT_ACTIVATION, self.common_address) + bytes((0, 0, 0, QOI_STATION))
+        self._loop.call_soon_threadsafe(self._send_i_frame, asdu)
+        if not self._gi_done.wait(timeout_s):
+            raise TimeoutError("Không nhận được ACT_TERM của general interrogation.")
+        with self.lock:
+            return self.interrogation_objects - before
+
+    def _send_i_frame(self, asdu):
+        self._writer.write(i_frame(asdu, self._send_seq, self._recv_seq))
+        self._send_seq = (self._send_seq + 1) % SEQ_MODULO
+        self._recv_unacked = 0
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        try:
+            reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            self._error = e
+            return
+        self._writer.write(u_frame(STARTDT_ACT))
+        receiver = asyncio.create_task(self._receive(reader))
+        acker = asyncio.create_task(self._ack_loop())
+        await self._stop_event.wait()
+        receiver.cancel()
+        acker.cancel()
+        self._writer.close()
+
+    async def _ack_loop(self):
+        while True:
+            await asyncio.sleep(0.05)
+            if self._recv_unacked:
+                self._writer.write(s_frame(self._recv_seq))
+                self._recv_unacked = 0
+
+    async def _receive(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(2)
+                if header[0] != START_BYTE:
+                    raise ValueError(f"APDU không hợp lệ: {header.hex()}")
+                body = await reader.readexactly(header[1])
+                control = body[0]
+                if control & 0x01 == 0:
+                    self._recv_seq = (self._recv_seq + 1) % SEQ_MODULO
+                    self._recv_unacked += 1
+                    self._handle_asdu(body[4:], time.perf_counter())
+                    if self._recv_unacked >= self.w:
+                        self._writer.write(s_frame(self._recv_seq))
+                        self._recv_unacked = 0
+                elif control == STARTDT_CON:
+                    self._started.set()
+                elif control == TESTFR_ACT:
+                    self._writer.write(u_frame(TESTFR_CON))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._error = e
+
+    def _handle_asdu(self, asdu, received_at):
+        type_id, count, cot = asdu[0], asdu[1] & 0x7F, asdu[2] & 0x3F
+        if type_id == C_IC_NA_1:
+            if cot == COT_ACTIVATION_TERM:
+                self._gi_done.set()
+            elif cot != COT_ACTIVATION_CON or asdu[2] & 0x40:
+                self._error = f"General interrogation bị từ chối (COT {asdu[2]})"
+                self._gi_done.set()
+            return
+        layout = _OBJECT_LAYOUT.get(type_id)
+        if layout is None or asdu[1] & 0x80:
+            return
+        element_size, has_time = layout
+        objects = []
+        offset = ASDU_HEADER_LENGTH
+        for _ in range(count):
+            ioa = asdu[offset] | (asdu[offset + 1] << 8) | (asdu[offset + 2] << 16)
+            element = asdu[offset + 3:offset + 3 + element_size]
+            if type_id in (M_SP_NA_1, M_SP_TB_1):
+                value, quality = bool(element[0] & 0x01), element[0] & 0xF0
+            else:
+                value, quality = _FLOAT.unpack_from(element)[0], element[4]
+            source_ts = decode_cp56time2a(element[-7:]) if has_time else None
+            objects.append((received_at, {"ioa": ioa, "value": value, "quality": quality, "cot": cot, "source_ts": source_ts}))
+            offset += 3 + element_size
+        with self.lock:
+            self.asdus += 1
+            if cot == COT_INTERROGATED_STATION:
+                self.interrogation_objects += len(objects)
+            self.items.extend(objects)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2404)
+    parser.add_argument('--common-address', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.0, help="Thời gian nhận dữ liệu tự phát (giây)")
+    args = parser.parse_args()
+
+    master = Iec104Master(args.host, args.port, args.common_address).start()
+    try:
+        gi_objects = master.interrogate()
+        epoch_offset = time.time() - time.perf_counter()
+        with master.lock:
+            start = len(master.items)
+        time.sleep(args.duration)
+        with master.lock:
+            window = master.items[start:]
+            asdus = master.asdus
+    finally:
+        master.stop()
+    latencies = [received_at + epoch_offset - item["source_ts"] for received_at, item in window if item["source_ts"]]
+    print(json.dumps({
+        "interrogation_objects": gi_objects,
+        "objects": len(window),
+        "objects_per_s": round(len(window) / args.duration, 1),
+        "asdus_total": asdus,
+        "latency": latency_summary_ms(latencies),
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# benchmarks/sim_server.py
+"""
+Server OPC UA mô phỏng (asyncua) chạy trên một thread riêng, dùng cho benchmark end-to-end.
+Address space: cây Object dưới Objects với `depth` mức, mỗi Object có `fanout` Object con;
+`variables` Variable (Double, NodeId dạng chuỗi "Sim.Var<i>") được chia đều cho các Object ở mức sâu nhất.
+Mỗi Variable được ghi `change_rate_hz` lần/giây, giá trị là thời điểm ghi (epoch giây) để tính độ trễ end-to-end.
+
+    python -m benchmarks.sim_server --port 48400 --depth 3 --fanout 5 --variables 1000 --change-rate-hz 1
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from asyncua import Server, ua
+
+logger = logging.getLogger(__name__)
+
+VARIABLE_PREFIX = "Sim.Var"
+
+
+class SimulationServer:
+    def __init__(self, host="127.0.0.1", port=48400, depth=3, fanout=5, variables=1000, change_rate_hz=1.0):
+        self.endpoint_url = f"opc.tcp://{host}:{port}/sim"
+        self.depth = max(1, depth)
+        self.fanout = max(1, fanout)
+        self.variable_count = variables
+        self.change_rate_hz = change_rate_hz
+        self.variable_node_ids = [] # NodeId (chuỗi) của các Variable, theo thứ tự Sim.Var0..N-1
+        self.object_count = 0
+        self.changes_written = 0 # Tổng số lần ghi giá trị, để tính tốc độ thay đổi thực tế
+        self._variable_nodeids = []
+        self._loop = None
+        self._stop_event = None
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = None
+
+    def start(self, timeout_s=300):
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="sim-opcua-server", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout_s):
+            raise TimeoutError(f"Server mô phỏng không sẵn sàng sau {timeout_s}s.")
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread is not None:
+            self._thread.join(30)
+
+    async def _build(self, server, idx):
+        leaves = [server.nodes.objects]
+        for level in range(self.depth):
+            next_level = []
+            for parent_position, parent in enumerate(leaves):
+                for child in range(self.fanout):
+                    next_level.append(await parent.add_object(idx, f"L{level}_{parent_position}_{child}"))
+            leaves = next_level
+            self.object_count += len(next_level)
+
+        for i in range(self.variable_count):
+            parent = leaves[i % len(leaves)]
+            variable = await parent.add_variable(ua.NodeId(f"{VARIABLE_PREFIX}{i}", idx), f"{VARIABLE_PREFIX}{i}", 0.0,
+                                                 varianttype=ua.VariantType.Double)
+            self._variable_nodeids.append(variable.nodeid)
+            self.variable_node_ids.append(variable.nodeid.to_string())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        try:
+            server = Server()
+            await server.init()
+            server.set_endpoint(self.endpoint_url)
+            idx = await server.register_namespace("urn:opcua-client-maxelectric:sim")
+            await self._build(server, idx)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+
+        async with server:
+            logger.info(f"Server mô phỏng sẵn sàng tại {self.endpoint_url}: {self.object_count} object, "
+                        f"{self.variable_count} variable, {self.change_rate_hz} thay đổi/giây mỗi variable.")
+            self._ready.set()
+            interval = 1.0 / self.change_rate_hz if self.change_rate_hz > 0 else None
+            next_tick = time.perf_counter()
+            while not self._stop_event.is_set():
+                if interval is None:
+                    await self._stop_event.wait()
+                    break
+                await self._write_all(server)
+                next_tick += interval
+                delay = next_tick - time.perf_counter()
+                if delay < 0: # Không theo kịp tốc độ yêu cầu: ghi liên tục, không dồn các tick bị trễ
+                    next_tick = time.perf_counter()
+                    delay = 0
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _write_all(self, server):
+        for nodeid in self._variable_nodeids:
+            now = datetime.now(timezone.utc)
+            data_value = ua.DataValue(ua.Variant(time.time(), ua.VariantType.Double), ua.StatusCode(ua.StatusCodes.Good),
+                                      SourceTimestamp=now, ServerTimestamp=now)
+            await server.write_attribute_value(nodeid, data_value)
+        self.changes_written += len(self._variable_nodeids)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=48400)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=5)
+    parser.add_argument('--variables', type=int, default=1000)
+    parser.add_argument('--change-rate-hz', type=float, default=1.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sim = SimulationServer(args.host, args.port, args.depth, args.fanout, args.variables, args.change_rate_hz).start()
+    print(f"Server mô phỏng đang chạy tại {sim.endpoint_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sim.stop()
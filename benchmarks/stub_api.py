@@ -0,0 +1,99 @@
+# benchmarks/stub_api.py
+"""
+Stub cục bộ cho API datapoint (http://localhost:5001/api/v1/datapoint-value).
+Chấp nhận PUT/POST với body là một object {ioa, value} hoặc list các object đó,
+ghi lại thời điểm nhận để script benchmark tính throughput/latency.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Hỗ trợ keep-alive
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b""
+        stub = self.server
+        received_at = time.perf_counter()
+
+        if stub.delay_ms:
+            time.sleep(stub.delay_ms / 1000.0)
+
+        if stub.fail:
+            self._reply(503, b'{"error": "stub unavailable"}')
+            return
+
+        try:
+            payload = json.loads(body or b"null")
+        except ValueError:
+            self._reply(400, b'{"error": "invalid json"}')
+            return
+        items = payload if isinstance(payload, list) else [payload]
+        with stub.lock:
+            stub.requests += 1
+            stub.connections.add(self.client_address)
+            for item in items:
+                stub.items.append((received_at, item))
+        self._reply(200, b'{"status": "ok"}')
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass # Không in access log để không ảnh hưởng số đo
+
+
+class StubApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, delay_ms=0):
+        super().__init__((host, port), _StubHandler)
+        self.delay_ms = delay_ms
+        self.fail = False # Bật để giả lập API downstream bị lỗi
+        self.lock = threading.Lock()
+        self.items = [] # list (thời điểm nhận, item)
+        self.requests = 0
+        self.connections = set() # Các (host, port) phía client đã thấy, ~ số TCP connection
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v1/datapoint-value"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="stub-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def item_count(self):
+        with self.lock:
+            return len(self.items)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Chạy stub API datapoint cục bộ.")
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--delay-ms', type=int, default=0)
+    args = parser.parse_args()
+    server = StubApiServer(port=args.port, delay_ms=args.delay_ms)
+    print(f"Stub API đang lắng nghe tại {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
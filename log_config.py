@@ -1,11 +1,99 @@
 # log_config.py
+import atexit
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
 
-def setup_logger(name):
+FILE_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None # QueueListener dùng chung (một hàng đợi cho mọi logger), ghi file/console trên thread nền
+_listener_lock = threading.Lock()
+
+
+def setup_logger(name, config=None):
+    """
+    Gắn QueueHandler cho logger `name`: thread gọi log (event loop của AsyncWorker, request Flask) chỉ đưa
+    record vào hàng đợi, việc format và ghi file xoay vòng theo dung lượng (RotatingFileHandler) cùng console
+    do một QueueListener trên thread nền đảm nhận. Gọi nhiều lần (nhiều create_app) không gắn thêm handler.
+    config: dict cấu hình (app.config), dùng các key LOG_*; không có thì dùng mặc định.
+    """
+    global _listener
+    config = config or {}
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    handler = logging.FileHandler('opcua_client_maxelectric.txt',  encoding='utf-8')
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    logger.setLevel(config.get('LOG_LEVEL', 'INFO'))
+    log_rate_limiter.interval_s = float(config.get('LOG_RATE_LIMIT_INTERVAL_S', log_rate_limiter.interval_s))
+
+    with _listener_lock:
+        if any(isinstance(h, logging.handlers.QueueHandler) for h in logger.handlers):
+            return logger
+        if _listener is None:
+            _listener = _start_listener(config)
+        logger.addHandler(logging.handlers.QueueHandler(_listener.queue))
     return logger
+
+
+def _start_listener(config):
+    handlers = []
+    file_handler = logging.handlers.RotatingFileHandler(
+        config.get('LOG_FILE', 'opcua_client_maxelectric.txt'),
+        maxBytes=int(config.get('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        backupCount=int(config.get('LOG_BACKUP_COUNT', 5)),
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+    handlers.append(file_handler)
+    if config.get('LOG_TO_CONSOLE', True):
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(console_handler)
+
+    # Hàng đợi không giới hạn: put() không bao giờ chặn thread gọi log
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _stop_listener():
+    # Ghi nốt các record còn trong hàng đợi khi tiến trình thoát
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+class LogRateLimiter:
+    """
+    Giới hạn log lặp lại trên đường dữ liệu: mỗi key (ví dụ (loại thông báo, mapping_id)) chỉ được log
+    tối đa một lần mỗi interval_s giây, các lần bị bỏ được đếm và báo kèm lần log tiếp theo.
+    allow() chỉ tra một dict và so sánh thời gian, đủ rẻ để gọi cho mọi notification.
+    """
+    def __init__(self, interval_s: float = 10.0):
+        self.interval_s = interval_s
+        self._state = {} # key -> [thời điểm log gần nhất (monotonic), số lần bị bỏ từ đó]
+
+    def allow(self, key):
+        """Trả về None nếu phải bỏ qua, ngược lại là số lần đã bỏ qua kể từ lần log trước (có thể 0)."""
+        now = time.monotonic()
+        state = self._state.get(key)
+        if state is None:
+            self._state[key] = [now, 0]
+            return 0
+        if now - state[0] < self.interval_s:
+            state[1] += 1
+            return None
+        suppressed = state[1]
+        state[0] = now
+        state[1] = 0
+        return suppressed
+
+
+# Instance global cho log trên đường dữ liệu (MappingRoute), interval lấy từ LOG_RATE_LIMIT_INTERVAL_S
+log_rate_limiter = LogRateLimiter()
@@ -1,10 +1,17 @@
 # run.py
 from app import create_app, db # Import create_app và db từ package app
 import logging
+import os
 
 
-# Tạo instance của ứng dụng sử dụng Application Factory
-app = create_app()
+USE_RELOADER = True # Werkzeug reloader khi chạy trực tiếp run.py (debug)
+
+# Tạo instance của ứng dụng sử dụng Application Factory.
+# Với reloader, tiến trình cha chỉ theo dõi file và khởi động lại tiến trình con (WERKZEUG_RUN_MAIN=true):
+# runtime OPC UA (outbox, outstation IEC-104, subscription) chỉ chạy trong tiến trình con phục vụ request.
+# Khi được import (gunicorn run:app) runtime luôn chạy.
+serving_process = __name__ != '__main__' or not USE_RELOADER or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+app = create_app(start_runtime=serving_process)
 
 
 
@@ -13,4 +20,4 @@ if __name__ == '__main__':
     # Chế độ debug sẽ tự động tải lại server khi có thay đổi code
     # và hiển thị thông báo lỗi chi tiết hơn.
     # KHÔNG BAO GIỜ chạy ở chế độ debug trong môi trường production.
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True, use_reloader=USE_RELOADER)
\ No newline at end of file
@@ -0,0 +1,39 @@
+# run_collector.py
+# Tiến trình collector: giữ toàn bộ session/subscription OPC UA và pipeline gửi dữ liệu, không có giao diện web.
+# Giao diện Flask (run.py, hoặc gunicorn nhiều worker) chạy với cùng COLLECTOR_SOCKET sẽ điều khiển collector
+# qua Unix socket, nên reload/scale giao diện không làm gián đoạn luồng dữ liệu.
+#   COLLECTOR_SOCKET=/run/opcua/collector.sock python run_collector.py
+#   COLLECTOR_SOCKET=/run/opcua/collector.sock gunicorn -w 4 run:app
+import signal
+import threading
+
+from app import create_app
+from app.config import CollectorConfig
+from app.collector import collector
+from app.delivery import delivery_pipeline
+from app.iec104 import iec104_outstation
+from async_worker import async_worker
+
+
+app = create_app(CollectorConfig)
+
+
+if __name__ == '__main__':
+    socket_path = app.config['COLLECTOR_SOCKET']
+    if not socket_path:
+        raise SystemExit("Cần đặt biến môi trường COLLECTOR_SOCKET (đường dẫn Unix socket) để chạy collector.")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    ipc_server = collector.serve(socket_path)
+    try:
+        stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.logger.info("Đang dừng collector...")
+        ipc_server.shutdown()
+        ipc_server.server_close()
+        delivery_pipeline.stop() # Ghi nốt hàng đợi xuống outbox và lưu offset đã gửi
+        iec104_outstation.stop()
+        async_worker.stop()